@@ -0,0 +1,58 @@
+import os
+
+import pytest
+from synthetic import write_mailbox, write_transactions
+
+from receiptaggregator.eml_loader import parse_directory
+
+
+def pytest_addoption(parser: pytest.Parser) -> None:
+    """Add the options for sizing the synthetic data."""
+    parser.addoption(
+        "--bench-rows",
+        default="10000",
+        help="Comma separated transaction csv sizes to benchmark, e.g. 10000,100000,1000000.",
+    )
+    parser.addoption(
+        "--bench-emails",
+        type=int,
+        default=300,
+        help="How many emails to put in the synthetic mailbox.",
+    )
+
+
+def pytest_generate_tests(metafunc: pytest.Metafunc) -> None:
+    """Parametrize every benchmark that takes `rows` with the requested csv sizes."""
+    if "rows" in metafunc.fixturenames:
+        sizes = [
+            int(size) for size in metafunc.config.getoption("bench_rows").split(",")
+        ]
+        metafunc.parametrize("rows", sizes, scope="session")
+
+
+@pytest.fixture(scope="session")
+def mailbox(
+    tmp_path_factory: pytest.TempPathFactory, pytestconfig: pytest.Config
+) -> tuple[str, list[dict]]:
+    """Write a directory of synthetic emails and their labels."""
+    directory = str(tmp_path_factory.mktemp("mailbox"))
+    labels = write_mailbox(directory, pytestconfig.getoption("bench_emails"))
+    return directory, labels
+
+
+@pytest.fixture(scope="session")
+def parsed_emails(mailbox: tuple[str, list[dict]]) -> list[dict]:
+    """Parse the synthetic mailbox once for every benchmark."""
+    emails, _ = parse_directory(mailbox[0])
+    return emails
+
+
+@pytest.fixture(scope="session")
+def transactions_csv(
+    tmp_path_factory: pytest.TempPathFactory, mailbox: tuple[str, list[dict]], rows: int
+) -> str:
+    """Write a synthetic Monarch csv with a matching transaction for every synthetic receipt."""
+    csv_path = os.path.join(str(tmp_path_factory.mktemp("transactions")), f"{rows}.csv")
+    receipts = [label["receipt"] for label in mailbox[1] if label["is_receipt"]]
+    write_transactions(csv_path, rows, receipts=receipts)
+    return csv_path
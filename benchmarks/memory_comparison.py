@@ -0,0 +1,68 @@
+"""Compare the memory and lookup cost of the Monarch frame against the compact TransactionIndex and the full matcher.
+
+python benchmarks/memory_comparison.py --rows 1000000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+import polars as pl
+from synthetic import write_transactions
+
+from receiptaggregator.batch_matcher import BatchReceiptMatcher
+from receiptaggregator.transaction_index import TransactionIndex, to_day
+
+
+def main(rows: int) -> None:
+    """Load a synthetic csv both ways and print how they compare.
+    :param rows: How many transactions to generate.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, "transactions.csv")
+        write_transactions(csv_path, rows)
+        df = pl.read_csv(csv_path, try_parse_dates=True).with_row_index("temp_id")
+    index = TransactionIndex.from_frame(df)
+    rss_before = _rss_mb()
+    matcher = BatchReceiptMatcher(df, index)
+    rss_after = _rss_mb()
+    lookup_columns = df.select("Date", "Amount", "temp_id")
+    print(f"rows:                          {rows:,}")
+    print(f"full frame:                    {df.estimated_size('mb'):.1f} MB")
+    print(
+        f"Date/Amount/temp_id columns:   {lookup_columns.estimated_size('mb'):.1f} MB"
+    )
+    print(f"TransactionIndex arrays:       {index.nbytes / 1024**2:.1f} MB")
+    print(f"BatchReceiptMatcher:           {matcher.nbytes / 1024**2:.1f} MB")
+    print(f"RSS with frame and index:      {rss_before:.1f} MB")
+    print(f"RSS with the matcher too:      {rss_after:.1f} MB")
+
+    samples = df.sample(200, seed=0).select("Date", "Amount").rows()
+    start = time.perf_counter()
+    for day, amount in samples:
+        df.filter(
+            (pl.col("Date") >= day - timedelta(days=5))
+            & (pl.col("Date") <= day + timedelta(days=5))
+            & (pl.col("Amount") == amount)
+        )
+    frame_time = (time.perf_counter() - start) / len(samples)
+    start = time.perf_counter()
+    for day, amount in samples:
+        index.lookup(round(amount * 100), to_day(day), window_days=5)
+    index_time = (time.perf_counter() - start) / len(samples)
+    print(f"frame filter per lookup:       {frame_time * 1e3:.3f} ms")
+    print(f"index lookup per lookup:       {index_time * 1e3:.3f} ms")
+
+
+def _rss_mb() -> float:
+    # The resident set size right now, Linux only.
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    main(parser.parse_args().rows)
@@ -0,0 +1,369 @@
+"""Generators for synthetic mailboxes and Monarch transaction exports.
+
+Run as a script to write them to disk, e.g.
+    python benchmarks/synthetic.py mailbox eml_files --count 3000
+    python benchmarks/synthetic.py transactions monarch_csv.csv --rows 1000000
+"""
+
+import argparse
+import json
+import os
+import random
+from datetime import UTC, date, datetime, timedelta
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+import numpy as np
+import polars as pl
+
+MERCHANTS = [
+    "Bombas",
+    "Target",
+    "Café Rouge",
+    "Trader Joe's",
+    "Best Buy",
+    "Chipotle",
+    "REI Co-op",
+    "Crème de la Crumb",
+    "Home Depot",
+    "Uniqlo",
+    "Delta Air Lines",
+    "Marriott Hotels",
+    "Whole Foods",
+    "Apple",
+    "Etsy",
+    "Doordash",
+]
+ITEMS = [
+    ("Men's Running Ankle Sock 6-Pack", "Color: Navy, Size: L"),
+    ("Crème brûlée", None),
+    ("USB-C Cable 2m", "Color: White"),
+    ("Organic Bananas", None),
+    ("Rain Jacket", "Color: Forest Green, Size: M"),
+    ("Burrito Bowl", "Extra guac"),
+    ("Cordless Drill", None),
+    ("Wool Sweater", "Size: S"),
+    ("Espresso Beans 1lb", None),
+    ("Hotel Night - King Room", "Check-in: 2 nights"),
+]
+NON_RECEIPT_SUBJECTS = [
+    "Your order has shipped!",
+    "Limited time offer: 30% off everything",
+    "Your package is on the way",
+    "Your order was delivered",
+    "Coming soon: our fall collection",
+    "Start your return",
+]
+CATEGORIES = ["Shopping", "Groceries", "Restaurants & Bars", "Travel", "Electronics"]
+ACCOUNTS = ["Visa (...5478)", "Mastercard (...7213)", "Amex (...1004)"]
+CHARSETS = ["utf-8", "iso-8859-1", "windows-1252"]
+
+
+def make_receipt(rng: random.Random, merchant: str, sent: datetime) -> dict:
+    """Make up the contents of a receipt.
+    :param rng: The random number generator to use.
+    :param merchant: The merchant the receipt is from.
+    :param sent: When the receipt was sent.
+    """
+    items = []
+    for name, description in rng.sample(ITEMS, rng.randint(1, 4)):
+        items.append(
+            {
+                "item_name": name,
+                "item_cost": round(rng.uniform(2, 150), 2),
+                "item_description": description,
+                "item_quantity": rng.randint(1, 3),
+            }
+        )
+    total_cost = round(
+        sum(item["item_cost"] * item["item_quantity"] for item in items), 2
+    )
+    total_billed = round(total_cost * 1.08, 2)
+    return {
+        "merchant": merchant,
+        "total_cost": total_cost,
+        "total_billed": total_billed,
+        "payment_method": rng.choice(["5478", "7213", "1004"]),
+        "items": items,
+        "date": sent.date().isoformat(),
+    }
+
+
+def minimal_pdf(lines: list[str]) -> bytes:
+    """Render lines of text as a one page pdf with a text layer.
+    :param lines: The lines of text, latin-1 only.
+    """
+    text = "".join(
+        "({}) Tj T* ".format(
+            line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+        )
+        for line in lines
+    )
+    content = f"BT /F1 11 Tf 14 TL 72 740 Td {text}ET".encode("latin-1")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    return pdf
+
+
+def receipt_email(
+    receipt: dict,
+    sent: datetime,
+    charset: str = "utf-8",
+    forwarded: bool = False,
+    multipart: bool = True,
+    pdf: bool = False,
+) -> EmailMessage:
+    """Render a receipt as an email.
+    :param receipt: The receipt, as made by make_receipt.
+    :param sent: When the email was sent.
+    :param charset: The charset to encode the body with.
+    :param forwarded: If the receipt should be wrapped in a forwarded message.
+    :param multipart: If the email should have a html part as well as a plain text one.
+    :param pdf: If the receipt should only be in a pdf attachment, like airline and utility invoices.
+    """
+    lines = [f"Thanks for your order from {receipt['merchant']}!", "Order # 48213"]
+    rows = []
+    for item in receipt["items"]:
+        lines.append(item["item_name"])
+        if item["item_description"]:
+            lines.append(item["item_description"])
+        lines.append(f"Quantity: {item['item_quantity']}  ${item['item_cost']:.2f}")
+        rows.append(
+            f"<tr><td>{item['item_name']}</td><td>{item['item_quantity']}</td>"
+            f"<td>${item['item_cost']:.2f}</td></tr>"
+        )
+    lines += [
+        f"Subtotal: ${receipt['total_cost']:.2f}",
+        f"Total billed: ${receipt['total_billed']:.2f}",
+        f"Visa (ending in {receipt['payment_method']}): ${receipt['total_billed']:.2f}",
+        "Billing information on file. Unsubscribe at https://example.com/unsubscribe",
+    ]
+    text = "\n".join(lines)
+    subject = f"Your receipt from {receipt['merchant']}"
+    if pdf:
+        attachment = minimal_pdf(lines)
+        lines = [f"Thanks for your order from {receipt['merchant']}!"]
+        text = f"{lines[0]}\nYour invoice is attached."
+        rows = []
+    if forwarded:
+        text = (
+            "---------- Forwarded message ---------\n"
+            f"From: {receipt['merchant']} <orders@example.com>\n"
+            f"Date: {format_datetime(sent)}\n"
+            f"Subject: {subject}\n\n{text}"
+        )
+        subject = f"Fwd: {subject}"
+        sent = sent + timedelta(days=3)
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = "Me <me@example.com>" if forwarded else "orders@example.com"
+    msg["To"] = "me@example.com"
+    msg["Date"] = format_datetime(sent)
+    msg.set_content(text, charset=charset)
+    if multipart:
+        html = (
+            "<html><head><style>td {padding: 4px}</style><script>track()</script></head><body>"
+            f"<h1>{receipt['merchant']}</h1><p>{'<br>'.join(lines[:2])}</p>"
+            f"<table>{''.join(rows)}</table>"
+            f"<p>Subtotal: ${receipt['total_cost']:.2f}<br>Total billed: ${receipt['total_billed']:.2f}</p>"
+            '<a href="https://example.com/unsubscribe">Unsubscribe</a></body></html>'
+        )
+        msg.add_alternative(html, subtype="html", charset=charset)
+    if pdf:
+        msg.add_attachment(
+            attachment, maintype="application", subtype="pdf", filename="invoice.pdf"
+        )
+    return msg
+
+
+def non_receipt_email(
+    rng: random.Random, merchant: str, sent: datetime
+) -> EmailMessage:
+    """Make up an order related email that is not a receipt.
+    :param rng: The random number generator to use.
+    :param merchant: The merchant the email is from.
+    :param sent: When the email was sent.
+    """
+    subject = rng.choice(NON_RECEIPT_SUBJECTS)
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = f"{merchant} <news@example.com>"
+    msg["To"] = "me@example.com"
+    msg["Date"] = format_datetime(sent)
+    msg.set_content(
+        f"{subject}\nTracking number: 1Z999AA10123456784\n"
+        "Limited time: save on your next order.\nUnsubscribe"
+    )
+    msg.add_alternative(
+        f"<html><body><h2>{subject}</h2><p>Shop the offer today</p></body></html>",
+        subtype="html",
+    )
+    return msg
+
+
+def write_mailbox(
+    directory: str,
+    count: int,
+    receipt_ratio: float = 0.3,
+    seed: int = 0,
+    duplicate_ratio: float = 0.0,
+    pdf_ratio: float = 0.0,
+) -> list[dict]:
+    """Write a mailbox of synthetic emails as eml files.
+    A labels.json is written next to them with the truth for every file.
+    :param directory: The directory to write the emails to.
+    :param count: How many emails to write.
+    :param receipt_ratio: The share of emails that are receipts.
+    :param seed: The seed for the random number generator.
+    :param duplicate_ratio: The share of emails that are forwarded or re-sent copies of an earlier receipt.
+    :param pdf_ratio: The share of receipts that only come as a pdf attachment.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    start = datetime(2024, 1, 1, 9, tzinfo=UTC)
+    labels = []
+    originals = []
+    for i in range(count):
+        merchant = rng.choice(MERCHANTS)
+        sent = start + timedelta(minutes=rng.randint(0, 60 * 24 * 365))
+        file = f"{i:07d}.eml"
+        if duplicate_ratio and originals and rng.random() < duplicate_ratio:
+            original_file, receipt, original_sent = rng.choice(originals)
+            msg = receipt_email(
+                receipt,
+                original_sent,
+                forwarded=rng.random() < 0.5,
+                multipart=False,
+            )
+            msg.replace_header(
+                "Date",
+                format_datetime(original_sent + timedelta(days=rng.randint(0, 30))),
+            )
+            labels.append(
+                {
+                    "file": file,
+                    "is_receipt": True,
+                    "receipt": receipt,
+                    "duplicate_of": original_file,
+                }
+            )
+        elif rng.random() < receipt_ratio:
+            receipt = make_receipt(rng, merchant, sent)
+            msg = receipt_email(
+                receipt,
+                sent,
+                charset=rng.choice(CHARSETS),
+                forwarded=rng.random() < 0.1,
+                multipart=rng.random() < 0.8,
+                pdf=bool(pdf_ratio) and rng.random() < pdf_ratio,
+            )
+            labels.append({"file": file, "is_receipt": True, "receipt": receipt})
+            originals.append((file, receipt, sent))
+        else:
+            msg = non_receipt_email(rng, merchant, sent)
+            labels.append({"file": file, "is_receipt": False, "receipt": None})
+        with open(os.path.join(directory, file), "wb") as f:
+            f.write(msg.as_bytes())
+    with open(os.path.join(directory, "labels.json"), "w") as f:
+        json.dump(labels, f)
+    return labels
+
+
+def make_transactions(
+    rows: int, seed: int = 0, receipts: list[dict] | None = None
+) -> pl.DataFrame:
+    """Make a frame of transactions in the format Monarch exports.
+    :param rows: How many transactions to make.
+    :param seed: The seed for the random number generator.
+    :param receipts: Receipts, as made by make_receipt, that should each have a matching transaction.
+    """
+    np_rng = np.random.default_rng(seed)
+    merchants = np.array(MERCHANTS + [f"Merchant {i}" for i in range(500)])
+    start = np.datetime64("2024-01-01")
+    df = pl.DataFrame(
+        {
+            "Date": start + np_rng.integers(0, 366, rows).astype("timedelta64[D]"),
+            "Merchant": merchants[np_rng.integers(0, len(merchants), rows)],
+            "Category": np.array(CATEGORIES)[np_rng.integers(0, len(CATEGORIES), rows)],
+            "Account": np.array(ACCOUNTS)[np_rng.integers(0, len(ACCOUNTS), rows)],
+            "Original Statement": "",
+            "Notes": "",
+            "Amount": -np.round(np_rng.lognormal(3, 1, rows), 2),
+            "Tags": "",
+        }
+    )
+    df = df.with_columns(
+        pl.col("Merchant").str.to_uppercase().alias("Original Statement")
+    )
+    if receipts:
+        planted = pl.DataFrame(
+            {
+                "Date": [
+                    date.fromisoformat(receipt["date"]) + timedelta(days=1)
+                    for receipt in receipts
+                ],
+                "Merchant": [receipt["merchant"] for receipt in receipts],
+                "Category": "Shopping",
+                "Account": [
+                    f"Visa (...{receipt['payment_method']})" for receipt in receipts
+                ],
+                "Original Statement": [
+                    receipt["merchant"].upper() for receipt in receipts
+                ],
+                "Notes": "",
+                "Amount": [-receipt["total_billed"] for receipt in receipts],
+                "Tags": "",
+            },
+            schema=df.schema,
+        )
+        df = pl.concat([df, planted]).sort("Date")
+    return df
+
+
+def write_transactions(
+    csv_path: str, rows: int, seed: int = 0, receipts: list[dict] | None = None
+) -> None:
+    """Write a Monarch style transaction csv.
+    :param csv_path: Where to write the csv.
+    :param rows: How many transactions to write.
+    :param seed: The seed for the random number generator.
+    :param receipts: Receipts, as made by make_receipt, that should each have a matching transaction.
+    """
+    make_transactions(rows, seed, receipts).write_csv(csv_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    mailbox = commands.add_parser("mailbox")
+    mailbox.add_argument("directory")
+    mailbox.add_argument("--count", type=int, default=1000)
+    mailbox.add_argument("--receipt-ratio", type=float, default=0.3)
+    mailbox.add_argument("--seed", type=int, default=0)
+    transactions = commands.add_parser("transactions")
+    transactions.add_argument("csv_path")
+    transactions.add_argument("--rows", type=int, default=10_000)
+    transactions.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.command == "mailbox":
+        write_mailbox(args.directory, args.count, args.receipt_ratio, args.seed)
+    else:
+        write_transactions(args.csv_path, args.rows, args.seed)
@@ -0,0 +1,89 @@
+import os
+from email.message import EmailMessage
+
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+from synthetic import minimal_pdf, write_mailbox
+
+from receiptaggregator.eml_loader import parse_emls, read_message
+from receiptaggregator.metrics import metrics
+
+pytest.importorskip("pypdf")
+
+from receiptaggregator.attachments import AttachmentExtractor, pdf_parts  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def pdf_mailbox(
+    tmp_path_factory: pytest.TempPathFactory,
+) -> tuple[list[str], list[dict]]:
+    """Write a mailbox where half the receipts only come as a pdf."""
+    directory = str(tmp_path_factory.mktemp("pdf_mailbox"))
+    labels = write_mailbox(directory, 200, receipt_ratio=0.5, pdf_ratio=0.5)
+    return [os.path.join(directory, label["file"]) for label in labels], labels
+
+
+def test_pdf_receipts_reach_the_body(
+    benchmark: BenchmarkFixture,
+    pdf_mailbox: tuple[list[str], list[dict]],
+    tmp_path: str,
+) -> None:
+    """Read every pdf attachment in a pool, then read them all again from the cache."""
+    paths, labels = pdf_mailbox
+    with_pdf = [
+        (path, label)
+        for path, label in zip(paths, labels, strict=True)
+        if pdf_parts(read_message(path))
+    ]
+    assert with_pdf
+    without = parse_emls([path for path, _ in with_pdf])
+    assert not any("Total billed" in email["Body"] for email in without)
+
+    cache_dir = os.path.join(tmp_path, "cache")
+    attachments = AttachmentExtractor(cache_dir, max_workers=2)
+    emails = benchmark.pedantic(
+        parse_emls, args=(paths, attachments), rounds=1, iterations=1
+    )
+    attachments.close()
+    for path, label in with_pdf:
+        body = emails[paths.index(path)]["Body"]
+        assert f"Total billed: ${label['receipt']['total_billed']:.2f}" in body
+    assert len(os.listdir(cache_dir)) == len(with_pdf)
+
+    # A fresh extractor on the same cache never starts the pool, however the emails are batched.
+    rerun = AttachmentExtractor(cache_dir)
+    assert parse_emls(paths, rerun, batch_bytes=16 * 1024) == emails
+    assert rerun._pool is None
+
+
+def test_bad_and_large_attachments_are_skipped(tmp_path: str) -> None:
+    """Keep going past a pdf that cannot be read, one that cannot be decoded and one that is over the size limit."""
+    msg = EmailMessage()
+    msg["Subject"] = "Your invoice"
+    msg.set_content("Invoice attached")
+    msg.add_attachment(b"%PDF-1.4 not really", maintype="application", subtype="pdf")
+    msg.add_attachment(
+        minimal_pdf(["Total: $12.00"]) + b"\0" * 4096,
+        maintype="application",
+        subtype="pdf",
+    )
+    msg.add_attachment(
+        minimal_pdf(["Total: $56.00"]), maintype="application", subtype="pdf"
+    )
+    msg.get_payload()[-1].set_payload("A===\n")
+    msg.add_attachment(
+        minimal_pdf(["Total: $34.00"]), maintype="application", subtype="pdf"
+    )
+    metrics.enabled, enabled = True, metrics.enabled
+    metrics.reset()
+    attachments = AttachmentExtractor(str(tmp_path), max_bytes=2048, max_workers=1)
+    try:
+        text = attachments.text(msg)
+    finally:
+        attachments.close()
+        counters = metrics.to_dict()["counters"]
+        metrics.enabled = enabled
+    assert "$34.00" in text
+    assert "$12.00" not in text
+    assert counters["attachments.too_large"] == 1
+    assert counters["attachments.failed"] == 2
@@ -0,0 +1,34 @@
+import os
+
+from pytest_benchmark.fixture import BenchmarkFixture
+from sklearn.metrics import roc_auc_score
+
+from receiptaggregator.eml_loader import parse_eml
+from receiptaggregator.invoice_classification import (
+    RuleBasedClassifier,
+    TrainedClassifier,
+)
+
+
+def test_rule_based_classifier(
+    benchmark: BenchmarkFixture, parsed_emails: list[dict]
+) -> None:
+    """Score every email in the synthetic mailbox."""
+    classifier = RuleBasedClassifier()
+    scores = benchmark(
+        lambda: [classifier.score_email(email) for email in parsed_emails]
+    )
+    assert len(scores) == len(parsed_emails)
+
+
+def test_trained_classifier(
+    benchmark: BenchmarkFixture, mailbox: tuple[str, list[dict]]
+) -> None:
+    """Train on half the synthetic mailbox and score the other half in one batch."""
+    directory, labels = mailbox
+    emails = [parse_eml(os.path.join(directory, label["file"])) for label in labels]
+    receipts = [label["is_receipt"] for label in labels]
+    half = len(emails) // 2
+    classifier = TrainedClassifier().fit(emails[:half], receipts[:half])
+    scores = benchmark(classifier.score_emails, emails[half:])
+    assert roc_auc_score(receipts[half:], scores) > 0.95
@@ -0,0 +1,289 @@
+import asyncio
+import os
+import shutil
+import time
+
+import polars as pl
+import pytest
+
+from receiptaggregator.daemon import DirectorySource, ImapSource, ReceiptDaemon
+from receiptaggregator.eml_loader import parse_eml
+from receiptaggregator.models import MatchResult, ParsedReceipt
+from receiptaggregator.receipt_matcher import CsvReceiptMatcher
+from receiptaggregator.state_store import PipelineStateStore
+
+
+class LabelModel:
+    """Classify and extract emails straight from the synthetic labels."""
+
+    def __init__(self, directory: str, labels: list[dict]) -> None:
+        """Initialize the LabelModel.
+        :param directory: The synthetic mailbox.
+        :param labels: Its labels.
+        """
+        self._labels = {}
+        for label in labels:
+            email = parse_eml(os.path.join(directory, label["file"]))
+            if email is not None:
+                self._labels[email["Body"]] = label
+
+    def classify_email(self, email: dict) -> bool:
+        """Look up whether an email is a receipt."""
+        return self._labels[email["Body"]]["is_receipt"]
+
+    def extract_data(self, receipt: dict) -> ParsedReceipt:
+        """Look up the labeled receipt for an email."""
+        return ParsedReceipt.model_validate(self._labels[receipt["Body"]]["receipt"])
+
+
+class FakeImap:
+    """Serve a fixed set of messages the way imaplib does."""
+
+    def __init__(self, messages: dict[int, bytes], uidvalidity: int = 7) -> None:
+        """Initialize the FakeImap.
+        :param messages: The raw messages by UID.
+        :param uidvalidity: The UIDVALIDITY of the mailbox.
+        """
+        self.messages = messages
+        self.uidvalidity = uidvalidity
+        self.fetched: list[int] = []
+
+    def login(self, user: str, password: str) -> None:
+        """Log in, any credentials are accepted."""
+
+    def select(self, mailbox: str, readonly: bool = False) -> None:
+        """Select a mailbox, there is only one."""
+
+    def status(self, mailbox: str, names: str) -> tuple[str, list[bytes]]:
+        """Report the UIDVALIDITY of the mailbox."""
+        return "OK", [f"{mailbox} (UIDVALIDITY {self.uidvalidity})".encode()]
+
+    def uid(self, command: str, *args: object) -> tuple[str, list]:
+        """Answer UID SEARCH and UID FETCH."""
+        if command == "SEARCH":
+            low = int(args[1].split()[1].split(":")[0])
+            # Like a real server, "n:*" always includes the newest message.
+            uids = [uid for uid in self.messages if uid >= low] or [max(self.messages)]
+            return "OK", [" ".join(map(str, sorted(uids))).encode()]
+        self.fetched.append(int(args[0]))
+        return "OK", [(f"{args[0]} (RFC822)".encode(), self.messages[int(args[0])])]
+
+    def logout(self) -> None:
+        """Log out."""
+
+
+def test_daemon_processes_new_mail(
+    mailbox: tuple[str, list[dict]], transactions_csv: str, tmp_path: str
+) -> None:
+    """Drop mail into a watched directory in two bursts and time how long each takes to be written."""
+    directory, labels = mailbox
+    model = LabelModel(directory, labels)
+    watched = os.path.join(tmp_path, "inbox")
+    os.makedirs(watched)
+    state = PipelineStateStore(os.path.join(tmp_path, "state.db"))
+    output_csv = os.path.join(tmp_path, "updated.csv")
+    daemon = ReceiptDaemon(
+        state,
+        [DirectorySource(watched, poll_seconds=0, use_watchdog=False)],
+        model,
+        CsvReceiptMatcher(transactions_csv),
+        classifier=model,
+        tick_seconds=0.05,
+        debounce_seconds=0.2,
+        csv_path=output_csv,
+    )
+    stop = asyncio.Event()
+    files = [label["file"] for label in labels]
+    bursts = [files[: len(files) // 2], files[len(files) // 2 :]]
+
+    async def scenario() -> list[float]:
+        task = asyncio.create_task(daemon.run(stop))
+        latencies = []
+        for burst in bursts:
+            started = time.monotonic()
+            for file in burst:
+                shutil.copy(os.path.join(directory, file), watched)
+            seen = daemon.processed + len(burst)
+            while daemon.processed < seen:
+                assert time.monotonic() - started < 30, "timed out"
+                await asyncio.sleep(0.05)
+            latencies.append(time.monotonic() - started)
+        stop.set()
+        await task
+        return latencies
+
+    latencies = asyncio.run(scenario())
+    print(f"burst latencies: {', '.join(f'{latency:.2f}s' for latency in latencies)}")
+    counts = state.counts()
+    assert sum(counts.values()) == len(files)
+    originals = [
+        label for label in labels if label["is_receipt"] and "duplicate_of" not in label
+    ]
+    assert counts["written"] == len(originals)
+    tagged = pl.read_csv(output_csv).filter(pl.col("Tags") == "ReceiptAggregator")
+    assert len(tagged) == len(originals)
+    state.close()
+
+
+class FlakyMatcher:
+    """Fail every match until it is told Monarch is back."""
+
+    def __init__(self) -> None:
+        """Initialize the FlakyMatcher."""
+        self.up = False
+        self.logins = 0
+
+    async def login(self) -> None:
+        """Log in."""
+        self.logins += 1
+
+    async def match_receipts(self, receipts: list) -> list[MatchResult]:
+        """Match every receipt to a made up transaction, or fail if Monarch is down."""
+        if not self.up:
+            raise ConnectionError("Monarch is down")
+        return [MatchResult(transaction_id=str(i)) for i in range(len(receipts))]
+
+
+def test_failed_match_is_retried(
+    mailbox: tuple[str, list[dict]], tmp_path: str
+) -> None:
+    """Keep receipts extracted when Monarch is down, and retry them later only while they are recent."""
+    directory, labels = mailbox
+    model = LabelModel(directory, labels)
+    files = [
+        os.path.join(directory, label["file"])
+        for label in labels
+        if label["is_receipt"] and "duplicate_of" not in label
+    ][:5]
+    state = PipelineStateStore(os.path.join(tmp_path, "state.db"))
+    matcher = FlakyMatcher()
+    daemon = ReceiptDaemon(state, [], model, matcher, classifier=model)
+    asyncio.run(daemon.process(files))
+    assert matcher.logins == 1
+    assert state.counts()["extracted"] == len(files)
+
+    matcher.up = True
+    # The synthetic mail is from 2024, far older than the retry window.
+    assert daemon._to_retry() == []
+    daemon = ReceiptDaemon(
+        state, [], model, matcher, classifier=model, max_retry_days=10_000
+    )
+    asyncio.run(daemon._match(daemon._to_retry()))
+    assert state.counts()["written"] == len(files)
+    state.close()
+
+
+class FlakyModel(LabelModel):
+    """Fail every extraction until it is told Ollama is back."""
+
+    def __init__(self, directory: str, labels: list[dict]) -> None:
+        """Initialize the FlakyModel.
+        :param directory: The synthetic mailbox.
+        :param labels: Its labels.
+        """
+        super().__init__(directory, labels)
+        self.up = False
+
+    def extract_data(self, receipt: dict) -> ParsedReceipt:
+        """Look up the labeled receipt for an email, or fail if Ollama is down."""
+        if not self.up:
+            raise ConnectionError("Ollama is down")
+        return super().extract_data(receipt)
+
+
+def test_failed_extraction_is_retried(
+    mailbox: tuple[str, list[dict]], tmp_path: str
+) -> None:
+    """Extract receipts again once Ollama is back, on restart and in the retry loop, up to max_attempts."""
+    directory, labels = mailbox
+    model = FlakyModel(directory, labels)
+    files = [
+        os.path.join(directory, label["file"])
+        for label in labels
+        if label["is_receipt"] and "duplicate_of" not in label
+    ][:3]
+    state = PipelineStateStore(os.path.join(tmp_path, "state.db"))
+    matcher = FlakyMatcher()
+    matcher.up = True
+    daemon = ReceiptDaemon(state, [], model, matcher, classifier=model)
+    asyncio.run(daemon.process(files))
+    assert state.counts()["classified"] == len(files)
+    # Still down for the retry, which uses up another attempt.
+    asyncio.run(daemon._retry())
+    assert state.counts()["classified"] == len(files)
+
+    # A restart with Ollama back picks them up before waiting for new mail.
+    model.up = True
+    stop = asyncio.Event()
+    stop.set()
+    asyncio.run(ReceiptDaemon(state, [], model, matcher, classifier=model).run(stop))
+    assert state.counts()["written"] == len(files)
+
+    # Once an email has failed max_attempts times it is left alone.
+    other = PipelineStateStore(os.path.join(tmp_path, "other.db"))
+    model.up = False
+    daemon = ReceiptDaemon(other, [], model, matcher, classifier=model, max_attempts=1)
+    asyncio.run(daemon.process(files))
+    model.up = True
+    asyncio.run(daemon._retry())
+    assert other.counts()["classified"] == len(files)
+    other.close()
+    state.close()
+
+
+def test_csv_matcher_needs_a_path(transactions_csv: str, tmp_path: str) -> None:
+    """Refuse a csv matcher with nowhere to save its matches."""
+    state = PipelineStateStore(os.path.join(tmp_path, "state.db"))
+    with pytest.raises(ValueError):
+        ReceiptDaemon(state, [], LabelModel, CsvReceiptMatcher(transactions_csv))
+    state.close()
+
+
+def test_directory_source_polls_only_new_files(tmp_path: str) -> None:
+    """Report each file once when polling without watchdog."""
+    source = DirectorySource(str(tmp_path), poll_seconds=0, use_watchdog=False)
+    assert source.poll() == []
+    open(os.path.join(tmp_path, "a.eml"), "w").close()
+    open(os.path.join(tmp_path, "notes.txt"), "w").close()
+    assert source.poll() == [os.path.join(tmp_path, "a.eml")]
+    old = time.time() - 60
+    os.utime(os.path.join(tmp_path, "a.eml"), (old, old))
+    open(os.path.join(tmp_path, "b.eml"), "w").close()
+    assert source.poll() == [os.path.join(tmp_path, "b.eml")]
+
+
+@pytest.mark.parametrize("restart", [False, True])
+def test_imap_source_fetches_each_uid_once(
+    mailbox: tuple[str, list[dict]], tmp_path: str, restart: bool
+) -> None:
+    """Fetch only the messages above the last UID seen, across polls and restarts."""
+    directory, labels = mailbox
+    raw = []
+    for label in labels[:5]:
+        with open(os.path.join(directory, label["file"]), "rb") as f:
+            raw.append(f.read())
+    server = FakeImap({uid: raw[uid - 1] for uid in (1, 2, 3)})
+    spool = os.path.join(tmp_path, "spool")
+
+    def make_source() -> ImapSource:
+        return ImapSource(
+            "imap", "user", "pw", spool, poll_seconds=0, factory=lambda host: server
+        )
+
+    source = make_source()
+    assert [os.path.basename(path) for path in source.poll()] == [
+        "7-1.eml",
+        "7-2.eml",
+        "7-3.eml",
+    ]
+    assert source.poll() == []
+    server.messages.update({4: raw[3], 5: raw[4]})
+    if restart:
+        source = make_source()
+    paths = source.poll()
+    assert [os.path.basename(path) for path in paths] == ["7-4.eml", "7-5.eml"]
+    with open(paths[-1], "rb") as f:
+        assert f.read() == raw[4]
+    assert server.fetched == [1, 2, 3, 4, 5]
+    server.uidvalidity = 8
+    assert len(source.poll()) == 5
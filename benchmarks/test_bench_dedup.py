@@ -0,0 +1,34 @@
+import os
+
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+from synthetic import write_mailbox
+
+from receiptaggregator.dedup import EmailDeduplicator
+from receiptaggregator.eml_loader import parse_eml
+
+
+def test_deduplicate_mailbox(
+    benchmark: BenchmarkFixture,
+    tmp_path_factory: pytest.TempPathFactory,
+    pytestconfig: pytest.Config,
+) -> None:
+    """Group a mailbox where a tenth of the emails are copies of earlier receipts."""
+    directory = str(tmp_path_factory.mktemp("duplicates"))
+    labels = write_mailbox(
+        directory, pytestconfig.getoption("bench_emails"), duplicate_ratio=0.1
+    )
+    bodies = [
+        (label["file"], parse_eml(os.path.join(directory, label["file"]))["Body"])
+        for label in labels
+    ]
+
+    def deduplicate() -> dict[str, str]:
+        dedup = EmailDeduplicator()
+        return {file: dedup.add(file, body) for file, body in bodies}
+
+    groups = benchmark(deduplicate)
+    expected = {
+        label["file"]: label.get("duplicate_of", label["file"]) for label in labels
+    }
+    assert groups == expected
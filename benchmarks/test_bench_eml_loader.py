@@ -0,0 +1,32 @@
+import os
+import random
+from datetime import UTC, datetime
+
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+from synthetic import CHARSETS, make_receipt, receipt_email
+
+from receiptaggregator.eml_loader import parse_directory, parse_eml
+
+
+@pytest.mark.parametrize("charset", CHARSETS)
+@pytest.mark.parametrize("forwarded", [False, True])
+def test_parse_eml(
+    benchmark: BenchmarkFixture, tmp_path: str, charset: str, forwarded: bool
+) -> None:
+    """Parse a single multipart receipt."""
+    sent = datetime(2025, 6, 2, 10, tzinfo=UTC)
+    receipt = make_receipt(random.Random(0), "Café Rouge", sent)
+    path = os.path.join(tmp_path, "receipt.eml")
+    with open(path, "wb") as f:
+        f.write(receipt_email(receipt, sent, charset, forwarded).as_bytes())
+    email = benchmark(parse_eml, path)
+    assert f"{receipt['total_billed']:.2f}" in email["Body"]
+
+
+def test_parse_directory(
+    benchmark: BenchmarkFixture, mailbox: tuple[str, list[dict]]
+) -> None:
+    """Parse the whole synthetic mailbox."""
+    emails, _ = benchmark.pedantic(parse_directory, args=(mailbox[0],), rounds=3)
+    assert len(emails) == len(mailbox[1])
@@ -0,0 +1,112 @@
+import os
+
+import pytest
+
+from receiptaggregator.evaluation import (
+    RecordedOllamaClient,
+    ResponseRecorder,
+    evaluate_extractor,
+    score_receipt,
+)
+from receiptaggregator.models import ParsedReceipt, ReceiptItem
+from receiptaggregator.receipt_extractor import OllamaReceiptExtractor
+
+EXPECTED = ParsedReceipt(
+    merchant="Bombas",
+    total_cost=30.0,
+    total_billed=32.4,
+    payment_method="5478",
+    items=[
+        ReceiptItem(item_name="Ankle Sock 6-Pack", item_cost=20.0),
+        ReceiptItem(item_name="Crew Sock", item_cost=10.0),
+    ],
+)
+
+
+class LiveClient:
+    """Answer every chat with the same receipt and count the calls, standing in for a model."""
+
+    def __init__(self, receipt: ParsedReceipt) -> None:
+        """Initialize the LiveClient.
+        :param receipt: The receipt to answer with.
+        """
+        self._receipt = receipt
+        self.calls = 0
+
+    def chat(self, model: str, messages: list[dict], **kwargs: object) -> dict:
+        """Answer a chat."""
+        self.calls += 1
+        return {
+            "message": {"content": self._receipt.model_dump_json()},
+            "prompt_eval_count": 100,
+            "eval_count": 40,
+        }
+
+
+def test_exact_match_scores_one() -> None:
+    """Score every field as right when the receipt is extracted exactly."""
+    assert score_receipt(EXPECTED, EXPECTED.model_copy()) == {
+        "merchant": 1.0,
+        "total_cost": 1.0,
+        "total_billed": 1.0,
+        "payment_method": 1.0,
+        "items": 1.0,
+    }
+    assert set(score_receipt(EXPECTED, None).values()) == {0.0}
+
+
+def test_missing_item_lowers_recall() -> None:
+    """Give an F1 of 2/3 when one of two items is missing."""
+    actual = EXPECTED.model_copy(update={"items": EXPECTED.items[:1]})
+    scores = score_receipt(EXPECTED, actual)
+    assert scores["items"] == pytest.approx(2 / 3)
+    assert scores["total_billed"] == 1.0
+
+
+def test_duplicate_item_names_match_once_each() -> None:
+    """Only let each extracted item match one expected item, even when the names repeat."""
+    expected = EXPECTED.model_copy(
+        update={
+            "items": [
+                ReceiptItem(item_name="Crew Sock", item_cost=10.0),
+                ReceiptItem(item_name="Crew Sock", item_cost=10.0),
+            ]
+        }
+    )
+    once = expected.model_copy(update={"items": expected.items[:1]})
+    assert score_receipt(expected, once)["items"] == pytest.approx(2 / 3)
+    assert score_receipt(expected, expected)["items"] == 1.0
+    # A repeated name at a different price is a different item.
+    wrong_price = expected.model_copy(
+        update={
+            "items": [
+                ReceiptItem(item_name="Crew Sock", item_cost=10.0),
+                ReceiptItem(item_name="Crew Sock", item_cost=12.0),
+            ]
+        }
+    )
+    assert score_receipt(expected, wrong_price)["items"] == pytest.approx(0.5)
+
+
+def test_replay_needs_no_model(tmp_path: str) -> None:
+    """Record a response once, then replay it from the file with no live client."""
+    path = os.path.join(tmp_path, "recorded.jsonl")
+    email = {"Subject": "Your receipt", "From": "Bombas", "Body": "Total: $32.40"}
+    live = LiveClient(EXPECTED)
+    recorder = ResponseRecorder(path)
+    extractor = OllamaReceiptExtractor(RecordedOllamaClient(recorder, live), "m")
+    first = evaluate_extractor("m", extractor, recorder, [(email, EXPECTED)])
+    assert live.calls == 1
+
+    replay_recorder = ResponseRecorder(path)
+    replay = OllamaReceiptExtractor(RecordedOllamaClient(replay_recorder), "m")
+    report = evaluate_extractor("m", replay, replay_recorder, [(email, EXPECTED)])
+    assert live.calls == 1
+    assert report == first
+    assert report["failures"] == 0
+    assert report["items"] == 1.0
+
+    # Anything that was never recorded fails instead of reaching a model.
+    other = {**email, "Body": "Total: $1.00"}
+    report = evaluate_extractor("m", replay, replay_recorder, [(other, EXPECTED)])
+    assert report["failures"] == 1
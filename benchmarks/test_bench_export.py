@@ -0,0 +1,168 @@
+import os
+import sqlite3
+
+import polars as pl
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+
+from receiptaggregator.eml_loader import parse_eml
+from receiptaggregator.export import ReceiptExporter
+from receiptaggregator.models import MatchResult, ParsedReceipt
+from receiptaggregator.state_store import PipelineStateStore, Stage
+
+
+@pytest.fixture
+def extracted_state(
+    mailbox: tuple[str, list[dict]], tmp_path: str
+) -> tuple[PipelineStateStore, list[tuple[str, dict]]]:
+    """Record the synthetic mailbox in a state store as if every receipt had been extracted."""
+    directory, labels = mailbox
+    state = PipelineStateStore(os.path.join(tmp_path, "state.db"))
+    receipts = []
+    for label in labels:
+        path = os.path.join(directory, label["file"])
+        email_id = state.hash_file(path)
+        state.record_parsed(email_id, path, parse_eml(path))
+        state.record_classified(email_id, label["is_receipt"])
+        if label["is_receipt"]:
+            state.record_extracted(
+                email_id, ParsedReceipt.model_validate(label["receipt"])
+            )
+            receipts.append((email_id, label["receipt"]))
+    yield state, receipts
+    state.close()
+
+
+def test_export_is_incremental(
+    benchmark: BenchmarkFixture,
+    extracted_state: tuple[PipelineStateStore, list[tuple[str, dict]]],
+    tmp_path: str,
+) -> None:
+    """Export receipts, then only their matches once they are matched, then nothing."""
+    state, receipts = extracted_state
+    exporter = ReceiptExporter(os.path.join(tmp_path, "dataset"))
+    written = benchmark.pedantic(
+        exporter.export, args=(state, "run1"), rounds=1, iterations=1
+    )
+    item_count = sum(len(receipt["items"]) for _, receipt in receipts)
+    assert written == {
+        "receipts": len(receipts),
+        "items": item_count,
+        "matches": 0,
+    }
+
+    matched = receipts[::2]
+    for email_id, _ in matched:
+        state.record_matched(
+            email_id,
+            MatchResult(
+                transaction_id=f"t-{email_id}", score=0.9, candidates=2, tier=0
+            ),
+        )
+    assert exporter.export(state, "run2") == {
+        "receipts": 0,
+        "items": 0,
+        "matches": len(matched),
+    }
+    assert exporter.export(state, "run3") == {"receipts": 0, "items": 0, "matches": 0}
+
+    assert exporter.scan("receipts").select(pl.len()).collect().item() == len(receipts)
+    items = exporter.scan("items").collect()
+    assert items.height == item_count
+    assert items["amount"].sum() == pytest.approx(
+        sum(
+            item["item_cost"] * item["item_quantity"]
+            for _, receipt in receipts
+            for item in receipt["items"]
+        ),
+        abs=0.01 * item_count,
+    )
+    matches = exporter.scan("matches").collect()
+    assert sorted(matches["email_id"]) == sorted(email_id for email_id, _ in matched)
+    assert set(matches["run_id"]) == {"run2"}
+    # The plain hive scan sees the same rows, year included.
+    plain = pl.scan_parquet(
+        os.path.join(tmp_path, "dataset", "items"), hive_partitioning=True
+    ).collect()
+    assert plain.height == item_count
+    assert set(plain["year"]) == {2024}
+
+
+def test_item_spend_scan(
+    benchmark: BenchmarkFixture,
+    extracted_state: tuple[PipelineStateStore, list[tuple[str, dict]]],
+    tmp_path: str,
+) -> None:
+    """Sum item-level spend by year and merchant straight from the parquet files."""
+    state, receipts = extracted_state
+    exporter = ReceiptExporter(os.path.join(tmp_path, "dataset"))
+    exporter.export(state)
+
+    def spend() -> pl.DataFrame:
+        return (
+            exporter.scan("items")
+            .group_by("year", "merchant")
+            .agg(pl.col("amount").sum(), pl.len())
+            .collect()
+        )
+
+    by_merchant = benchmark(spend)
+    assert by_merchant["len"].sum() == sum(
+        len(receipt["items"]) for _, receipt in receipts
+    )
+
+
+def test_match_outcomes_are_exported_and_compacted(
+    extracted_state: tuple[PipelineStateStore, list[tuple[str, dict]]],
+    tmp_path: str,
+) -> None:
+    """Export an unmatched result, export it again once it matches, then compact down to the latest outcome."""
+    state, receipts = extracted_state
+    exporter = ReceiptExporter(os.path.join(tmp_path, "dataset"))
+    exporter.export(state, "run1")
+    email_id, _ = receipts[0]
+
+    state.record_matched(email_id, MatchResult(candidates=3))
+    assert exporter.export(state, "run2")["matches"] == 1
+    # The same outcome again is nothing new.
+    state.record_matched(email_id, MatchResult(candidates=3))
+    assert exporter.export(state, "run3")["matches"] == 0
+    state.record_matched(
+        email_id, MatchResult(transaction_id="t-1", score=0.9, candidates=3, tier=0)
+    )
+    assert exporter.export(state, "run4")["matches"] == 1
+
+    matches = exporter.scan("matches").sort("run_id").collect()
+    assert matches["transaction_id"].to_list() == [None, "t-1"]
+    item_count = sum(len(receipt["items"]) for _, receipt in receipts)
+    assert exporter.compact() == {
+        "receipts": len(receipts),
+        "items": item_count,
+        "matches": 1,
+    }
+    assert exporter.scan("matches").collect()["transaction_id"].to_list() == ["t-1"]
+    assert exporter.scan("receipts").collect().height == len(receipts)
+    for year in os.listdir(os.path.join(tmp_path, "dataset", "receipts")):
+        assert len(os.listdir(os.path.join(tmp_path, "dataset", "receipts", year))) == 1
+
+
+def test_invalid_stored_receipt_is_skipped(
+    extracted_state: tuple[PipelineStateStore, list[tuple[str, dict]]],
+    tmp_path: str,
+) -> None:
+    """Record a stored receipt that no longer validates as a failure and export everything else."""
+    state, receipts = extracted_state
+    bad_id, _ = receipts[0]
+    with sqlite3.connect(os.path.join(tmp_path, "state.db")) as conn:
+        conn.execute(
+            "UPDATE emails SET receipt = ? WHERE email_id = ?",
+            ('{"merchant": "Bombas"}', bad_id),
+        )
+    exporter = ReceiptExporter(os.path.join(tmp_path, "dataset"))
+    assert exporter.export(state, "run1")["receipts"] == len(receipts) - 1
+    assert bad_id not in exporter.scan("receipts").collect()["email_id"].to_list()
+    # It is not tried again on the next export.
+    assert exporter.export(state, "run2")["receipts"] == 0
+    assert state.emails_at(Stage.EXTRACTED, max_attempts=1) == [
+        row for row in state.emails_at(Stage.EXTRACTED) if row[0] != bad_id
+    ]
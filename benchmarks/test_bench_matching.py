@@ -0,0 +1,292 @@
+import asyncio
+import os
+from datetime import UTC, datetime
+from email.utils import format_datetime
+
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+from synthetic import MERCHANTS
+
+from receiptaggregator.models import ParsedReceipt, ReceiptItem
+from receiptaggregator.receipt_matcher import ApiReceiptMatcher, CsvReceiptMatcher
+from receiptaggregator.string_similarity import jaro_distance
+from receiptaggregator.transaction_index import to_day
+
+
+def test_jaro_distance(benchmark: BenchmarkFixture) -> None:
+    """Compare every synthetic merchant against every other one."""
+    pairs = [(a.lower(), b.lower()) for a in MERCHANTS for b in MERCHANTS]
+    scores = benchmark(lambda: [jaro_distance(a, b) for a, b in pairs])
+    assert max(scores) == 1.0
+
+
+def _receipts(labels: list[dict]) -> list[tuple[ParsedReceipt, str]]:
+    receipts = []
+    for label in labels:
+        if label["is_receipt"]:
+            receipt = label["receipt"]
+            parsed = ParsedReceipt(
+                merchant=receipt["merchant"],
+                total_cost=receipt["total_cost"],
+                total_billed=receipt["total_billed"],
+                payment_method=receipt["payment_method"],
+                items=[ReceiptItem(**item) for item in receipt["items"]],
+            )
+            sent = datetime.fromisoformat(receipt["date"]).replace(hour=9, tzinfo=UTC)
+            receipts.append((parsed, format_datetime(sent)))
+    return receipts
+
+
+def test_csv_matcher_load(benchmark: BenchmarkFixture, transactions_csv: str) -> None:
+    """Load a Monarch csv."""
+    matcher = benchmark.pedantic(CsvReceiptMatcher, args=(transactions_csv,), rounds=3)
+    assert len(matcher.df) > 0
+
+
+@pytest.mark.parametrize("receipt_count", [50])
+def test_csv_matcher_match(
+    benchmark: BenchmarkFixture,
+    transactions_csv: str,
+    mailbox: tuple[str, list[dict]],
+    receipt_count: int,
+) -> None:
+    """Match a batch of receipts against a Monarch csv, one at a time."""
+    receipts = _receipts(mailbox[1])[:receipt_count]
+
+    def match_all(matcher: CsvReceiptMatcher) -> list:
+        return [matcher.match_receipt(receipt, date) for receipt, date in receipts]
+
+    # Matching adds notes to the csv, so every round gets a freshly loaded one and only the matching is timed.
+    results = benchmark.pedantic(
+        match_all,
+        setup=lambda: ((CsvReceiptMatcher(transactions_csv),), {}),
+        rounds=3,
+    )
+    assert any(result.transaction_id is not None for result in results)
+
+
+def test_transaction_index_lookup(
+    benchmark: BenchmarkFixture,
+    transactions_csv: str,
+    mailbox: tuple[str, list[dict]],
+) -> None:
+    """Look up the candidate transactions for every receipt in the compact index."""
+    index = CsvReceiptMatcher(transactions_csv).index
+    receipts = [
+        (
+            -receipt.total_billed_cents,
+            to_day(datetime.strptime(date, "%a, %d %b %Y %H:%M:%S %z").date()),
+        )
+        for receipt, date in _receipts(mailbox[1])
+    ]
+    found = benchmark(
+        lambda: [index.lookup(cents, day, window_days=5) for cents, day in receipts]
+    )
+    assert all(len(rows) for rows in found)
+
+
+def test_csv_matcher_match_batch(
+    benchmark: BenchmarkFixture,
+    transactions_csv: str,
+    mailbox: tuple[str, list[dict]],
+) -> None:
+    """Assign every synthetic receipt to a transaction in one batch."""
+    receipts = _receipts(mailbox[1])
+    results = benchmark.pedantic(
+        lambda matcher: matcher.match_receipts(receipts),
+        setup=lambda: ((CsvReceiptMatcher(transactions_csv),), {}),
+        rounds=3,
+    )
+    assert (
+        sum(result.transaction_id is not None for result in results)
+        >= len(receipts) * 0.9
+    )
+
+
+def _monarch_csv(path: str, rows: list[tuple[str, str, float, str, str]]) -> str:
+    """Write a Monarch csv of (date, merchant, amount, tags, notes) rows."""
+    with open(path, "w") as f:
+        f.write("Date,Merchant,Category,Account,Original Statement,Notes,Amount,Tags\n")
+        for date, merchant, amount, tags, notes in rows:
+            f.write(
+                f'{date},{merchant},Shopping,Card (...5478),{merchant},"{notes}",{amount},{tags}\n'
+            )
+    return path
+
+
+def _receipt(merchant: str, total: float, day: str) -> tuple[ParsedReceipt, str]:
+    sent = datetime.fromisoformat(day).replace(hour=9, tzinfo=UTC)
+    receipt = ParsedReceipt(
+        merchant=merchant,
+        total_cost=total,
+        total_billed=total,
+        payment_method="5478",
+        items=[ReceiptItem(item_name="Coffee", item_cost=total)],
+    )
+    return receipt, format_datetime(sent)
+
+
+def test_same_day_purchases_get_distinct_transactions(tmp_path: str) -> None:
+    """Give two $5 purchases at the same shop on the same day a transaction each."""
+    csv = _monarch_csv(
+        os.path.join(tmp_path, "transactions.csv"),
+        [
+            ("2025-03-04", "Blue Bottle", -5.0, "", ""),
+            ("2025-03-04", "Blue Bottle", -5.0, "", ""),
+        ],
+    )
+    receipts = [_receipt("Blue Bottle", 5.0, "2025-03-04")] * 2
+    results = CsvReceiptMatcher(csv).match_receipts(receipts)
+    ids = [result.transaction_id for result in results]
+    assert None not in ids
+    assert len(set(ids)) == 2
+
+
+def test_tiers_are_searched_in_order(tmp_path: str) -> None:
+    """Take the nearest transaction in the first tier, and only widen for receipts that found nothing."""
+    csv = _monarch_csv(
+        os.path.join(tmp_path, "transactions.csv"),
+        [
+            ("2025-03-06", "Bombas", -30.0, "", ""),
+            ("2025-03-24", "Bombas", -30.0, "", ""),
+            ("2025-03-24", "Blue Bottle", -12.0, "", ""),
+            ("2025-06-12", "Allbirds", -95.0, "", ""),
+        ],
+    )
+    results = CsvReceiptMatcher(csv).match_receipts(
+        [
+            _receipt("Bombas", 30.0, "2025-03-04"),
+            _receipt("Blue Bottle", 12.0, "2025-03-04"),
+            _receipt("Allbirds", 95.0, "2025-03-04"),
+        ]
+    )
+    assert [(result.transaction_id, result.tier) for result in results] == [
+        ("0", 0),
+        ("2", 1),
+        ("3", 2),
+    ]
+
+
+def test_tier_thresholds(tmp_path: str) -> None:
+    """Ask for a closer merchant name in each wider tier."""
+    # 0.75 is enough within five days, but not for the 0.85 the thirty day tier needs.
+    assert 0.75 <= jaro_distance("bombas", "bmbas llc") < 0.85
+    # 0.85 is enough within thirty days, but not for the 0.92 any date needs.
+    assert 0.85 <= jaro_distance("blue bottle", "blue bottle coffee") < 0.92
+    csv = _monarch_csv(
+        os.path.join(tmp_path, "transactions.csv"),
+        [
+            ("2025-03-06", "Bmbas LLC", -30.0, "", ""),
+            ("2025-03-20", "Bmbas LLC", -40.0, "", ""),
+            ("2025-03-20", "Blue Bottle Coffee", -12.0, "", ""),
+            ("2025-06-12", "Blue Bottle Coffee", -15.0, "", ""),
+        ],
+    )
+    results = CsvReceiptMatcher(csv).match_receipts(
+        [
+            _receipt("Bombas", 30.0, "2025-03-04"),
+            _receipt("Bombas", 40.0, "2025-03-04"),
+            _receipt("Blue Bottle", 12.0, "2025-03-04"),
+            _receipt("Blue Bottle", 15.0, "2025-03-04"),
+        ]
+    )
+    assert [(result.transaction_id, result.tier) for result in results] == [
+        ("0", 0),
+        (None, None),
+        ("2", 1),
+        (None, None),
+    ]
+
+
+def test_transactions_with_a_receipt_are_skipped(tmp_path: str) -> None:
+    """Leave tagged transactions and ones with another receipt's note alone, but find a receipt's own note again."""
+    written = _receipt("Blue Bottle", 5.0, "2025-03-04")[0].to_str()
+    other = _receipt("Blue Bottle", 5.0, "2025-03-01")[0].model_copy(
+        update={"items": [ReceiptItem(item_name="Latte", item_cost=5.0)]}
+    )
+    csv = _monarch_csv(
+        os.path.join(tmp_path, "transactions.csv"),
+        [
+            ("2025-03-04", "Blue Bottle", -5.0, "Retail Sync", ""),
+            ("2025-03-04", "Blue Bottle", -5.0, "", other.to_str()),
+            ("2025-03-06", "Blue Bottle", -5.0, "", ""),
+            ("2025-03-02", "Blue Bottle", -5.0, "ReceiptAggregator", written),
+        ],
+    )
+    matcher = CsvReceiptMatcher(csv)
+    results = matcher.match_receipts(
+        [
+            _receipt("Blue Bottle", 5.0, "2025-03-04"),
+            _receipt("Blue Bottle", 5.0, "2025-03-05"),
+        ]
+    )
+    assert [result.transaction_id for result in results] == ["3", "2"]
+    # The rows this batch wrote to are taken for the next one.
+    mocha = other.model_copy(
+        update={"items": [ReceiptItem(item_name="Mocha", item_cost=5.0)]}
+    )
+    again = matcher.match_receipt(mocha, _receipt("Blue Bottle", 5.0, "2025-03-05")[1])
+    assert again.transaction_id is None
+
+
+class FakeMonarch:
+    """Serve a fixed list of transactions the way Monarch's api would and record every write."""
+
+    def __init__(self, transactions: list[dict]) -> None:
+        """Initialize the FakeMonarch.
+        :param transactions: The transactions to serve.
+        """
+        self.transactions = transactions
+        self.queries: list[dict] = []
+        self.writes: list[str] = []
+
+    async def get_transactions(self, offset: int = 0, **kwargs: object) -> dict:
+        """Serve every transaction in one page."""
+        self.queries.append(kwargs)
+        page = self.transactions if offset == 0 else []
+        return {
+            "allTransactions": {
+                "results": page,
+                "totalCount": len(self.transactions),
+            }
+        }
+
+    async def set_transaction_tags(self, transaction_id: str, tags: list) -> None:
+        """Record a write."""
+        self.writes.append(transaction_id)
+
+    async def update_transaction(self, transaction_id: str, notes: str) -> None:
+        """Record a write."""
+        self.writes.append(transaction_id)
+
+
+def _transaction(transaction_id: str, day: str, tags: list[str]) -> dict:
+    return {
+        "id": transaction_id,
+        "date": day,
+        "amount": -5.0,
+        "merchant": {"name": "Blue Bottle"},
+        "account": {"displayName": "Card (...5478)"},
+        "tags": [{"name": tag, "id": tag} for tag in tags],
+        "notes": "",
+    }
+
+
+def test_api_matcher_skips_tagged_transactions() -> None:
+    """Leave a receipt unmatched rather than claim a transaction that already has one, within the horizon."""
+    matcher = ApiReceiptMatcher(horizon_days=30)
+    matcher.api = FakeMonarch([_transaction("t1", "2025-03-04", ["Retail Sync"])])
+    result = asyncio.run(
+        matcher.match_receipt(*_receipt("Blue Bottle", 5.0, "2025-03-04"))
+    )
+    assert result.transaction_id is None
+    assert matcher.api.writes == []
+    assert matcher.api.queries[0]["start_date"] == "2025-02-02"
+    assert matcher.api.queries[0]["end_date"] == "2025-04-03"
+
+    matcher.api.transactions.append(_transaction("t2", "2025-03-05", []))
+    result = asyncio.run(
+        matcher.match_receipt(*_receipt("Blue Bottle", 5.0, "2025-03-04"))
+    )
+    assert result.transaction_id == "t2"
+    assert matcher.api.writes == ["t2", "t2"]
@@ -0,0 +1,114 @@
+import asyncio
+import json
+
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+
+from receiptaggregator.metrics import Histogram, Metrics
+
+
+def test_disabled_timer_overhead(benchmark: BenchmarkFixture) -> None:
+    """Time a block with metrics turned off, which is what every pipeline stage pays by default."""
+    off = Metrics()
+
+    def timed_block() -> None:
+        with off.timer("stage"):
+            pass
+
+    benchmark(timed_block)
+    assert off.to_dict() == {"counters": {}, "timers": {}}
+
+
+def test_disabled_metrics_record_nothing() -> None:
+    """Record nothing from counters, timers or decorated functions while disabled."""
+    off = Metrics()
+
+    @off.timed("call")
+    def call() -> int:
+        return 1
+
+    @off.timed("async_call")
+    async def async_call() -> int:
+        return 2
+
+    off.increment("emails")
+    off.observe("stage", 0.1)
+    with off.timer("block"):
+        pass
+    assert call() == 1
+    assert asyncio.run(async_call()) == 2
+    assert off.to_dict() == {"counters": {}, "timers": {}}
+    assert off.to_prometheus() == "\n"
+
+
+def test_timed_records_sync_and_async_calls() -> None:
+    """Time both kinds of function, including calls that raise."""
+    on = Metrics(enabled=True)
+
+    @on.timed("call")
+    def call() -> int:
+        return 1
+
+    @on.timed("async_call")
+    async def async_call() -> int:
+        await asyncio.sleep(0.01)
+        return 2
+
+    @on.timed("failing")
+    def failing() -> None:
+        raise ValueError("boom")
+
+    assert call() == 1
+    assert asyncio.run(async_call()) == 2
+    with pytest.raises(ValueError):
+        failing()
+    timers = on.to_dict()["timers"]
+    assert timers["call"]["count"] == 1
+    assert timers["async_call"]["count"] == 1
+    assert timers["async_call"]["min"] >= 0.01
+    assert timers["failing"]["count"] == 1
+
+
+def test_histogram_buckets() -> None:
+    """Put each observation in the first bucket it fits, and anything larger in +Inf."""
+    histogram = Histogram(buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.observe(value)
+    assert histogram.to_dict() == {
+        "count": 4,
+        "sum": 2.65,
+        "mean": 2.65 / 4,
+        "min": 0.05,
+        "max": 2,
+        "buckets": {"0.1": 2, "1": 1, "+Inf": 1},
+    }
+
+
+def test_exports() -> None:
+    """Export counters and timers as JSON and in the Prometheus text format, with cumulative buckets."""
+    on = Metrics(enabled=True)
+    on.increment("match.tier0", 2)
+    on.increment("match.tier0")
+    for seconds in (0.0002, 0.003, 100):
+        on.observe("parse_eml", seconds)
+
+    exported = json.loads(on.to_json())
+    assert exported["counters"] == {"match.tier0": 3}
+    assert exported["timers"]["parse_eml"]["count"] == 3
+
+    lines = on.to_prometheus().splitlines()
+    assert "# TYPE receiptaggregator_match_tier0_total counter" in lines
+    assert "receiptaggregator_match_tier0_total 3" in lines
+    assert "# TYPE receiptaggregator_parse_eml_seconds histogram" in lines
+    buckets = [line for line in lines if "_bucket" in line]
+    assert buckets[0] == 'receiptaggregator_parse_eml_seconds_bucket{le="0.0005"} 1'
+    assert 'receiptaggregator_parse_eml_seconds_bucket{le="0.005"} 2' in buckets
+    assert buckets[-2] == 'receiptaggregator_parse_eml_seconds_bucket{le="60"} 2'
+    assert buckets[-1] == 'receiptaggregator_parse_eml_seconds_bucket{le="+Inf"} 3'
+    counts = [int(line.rsplit(" ", 1)[1]) for line in buckets]
+    assert counts == sorted(counts)
+    assert "receiptaggregator_parse_eml_seconds_count 3" in lines
+    assert "receiptaggregator_parse_eml_seconds_sum 100.0032" in lines
+
+    on.reset()
+    assert on.to_dict() == {"counters": {}, "timers": {}}
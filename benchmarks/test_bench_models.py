@@ -0,0 +1,49 @@
+import json
+import random
+from datetime import UTC, datetime
+
+from pytest_benchmark.fixture import BenchmarkFixture
+from synthetic import MERCHANTS, make_receipt
+
+from receiptaggregator.models import ParsedReceipt, ReceiptBatch
+
+
+def _responses(count: int) -> list[str]:
+    rng = random.Random(0)
+    sent = datetime(2025, 1, 1, tzinfo=UTC)
+    responses = []
+    for _ in range(count):
+        receipt = make_receipt(rng, rng.choice(MERCHANTS), sent)
+        del receipt["date"]
+        responses.append(json.dumps(receipt))
+    return responses
+
+
+def test_validate_one_by_one(benchmark: BenchmarkFixture) -> None:
+    """Validate extraction responses one at a time."""
+    responses = _responses(2000)
+    receipts = benchmark(
+        lambda: [ParsedReceipt.model_validate_json(response) for response in responses]
+    )
+    assert len(receipts) == len(responses)
+
+
+def test_validate_many(benchmark: BenchmarkFixture) -> None:
+    """Validate extraction responses in a single pass."""
+    responses = _responses(2000)
+    receipts = benchmark(lambda: ParsedReceipt.validate_many(responses))
+    assert None not in receipts
+
+
+def test_receipt_batch_round_trip(benchmark: BenchmarkFixture) -> None:
+    """Pack receipts into a ReceiptBatch and rebuild them."""
+    receipts = ParsedReceipt.validate_many(_responses(2000))
+    rebuilt = benchmark(lambda: ReceiptBatch.from_receipts(receipts).to_receipts())
+    assert rebuilt == receipts
+
+
+def test_validate_many_keeps_responses_aligned() -> None:
+    """Fall back to one by one when a response holds several values, so no receipt lands on the wrong response."""
+    first, second = _responses(2)
+    receipts = ParsedReceipt.validate_many([first + "," + first, second, ""])
+    assert receipts == [None, ParsedReceipt.model_validate_json(second), None]
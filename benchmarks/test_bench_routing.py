@@ -0,0 +1,61 @@
+import os
+
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+
+from receiptaggregator.eml_loader import parse_eml
+from receiptaggregator.models import ParsedReceipt
+from receiptaggregator.receipt_extractor import RoutingReceiptExtractor
+
+
+class LabelExtractor:
+    """Extract receipts straight from the synthetic labels, getting total_billed wrong for some of them."""
+
+    def __init__(self, receipts: dict[str, dict], wrong_every: int = 0) -> None:
+        """Initialize the LabelExtractor.
+        :param receipts: The labeled receipt for each email body.
+        :param wrong_every: Get total_billed wrong for every nth receipt, 0 to always get it right.
+        """
+        self._receipts = receipts
+        self._wrong_every = wrong_every
+        self.calls = 0
+
+    def extract_data(self, receipt: dict) -> ParsedReceipt:
+        """Look up the labeled receipt for an email."""
+        self.calls += 1
+        parsed = ParsedReceipt.model_validate(self._receipts[receipt["Body"]])
+        if self._wrong_every and self.calls % self._wrong_every == 0:
+            parsed.total_billed = round(parsed.total_billed + 1.37, 2)
+        return parsed
+
+
+def test_routing_extractor(
+    benchmark: BenchmarkFixture, mailbox: tuple[str, list[dict]]
+) -> None:
+    """Route the synthetic receipts through a model that is wrong for every fifth one and one that never is."""
+    directory, labels = mailbox
+    emails = []
+    receipts = {}
+    for label in labels:
+        if label["is_receipt"]:
+            email = parse_eml(os.path.join(directory, label["file"]))
+            emails.append(email)
+            receipts[email["Body"]] = label["receipt"]
+
+    def route() -> RoutingReceiptExtractor:
+        router = RoutingReceiptExtractor(
+            [LabelExtractor(receipts, wrong_every=5), LabelExtractor(receipts)]
+        )
+        for email in emails:
+            router.extract_data(email)
+        return router
+
+    router = benchmark(route)
+    assert router.escalations == len(emails) // 5
+    assert router.extractors[1].calls == router.escalations
+
+
+def test_routing_needs_an_extractor() -> None:
+    """Refuse to build a router with nothing to route to."""
+    with pytest.raises(ValueError):
+        RoutingReceiptExtractor([])
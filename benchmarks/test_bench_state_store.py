@@ -0,0 +1,131 @@
+import os
+import shutil
+
+import polars as pl
+from test_bench_work_queue import CountingLabelModel
+
+from receiptaggregator.eml_loader import parse_eml
+from receiptaggregator.models import MatchResult, ParsedReceipt
+from receiptaggregator.receipt_matcher import CsvReceiptMatcher
+from receiptaggregator.state_store import PipelineStateStore, Stage
+
+
+def _run(
+    db_path: str,
+    directory: str,
+    model: CountingLabelModel,
+    csv_path: str,
+    output_csv: str,
+    extract_limit: int | None = None,
+) -> None:
+    """Take a mailbox through the pipeline the way testing.py does, stopping after extract_limit extractions."""
+    state = PipelineStateStore(db_path)
+    for email_id, path in state.new_files(directory):
+        state.record_parsed(email_id, path, parse_eml(path))
+    for email_id, email in state.emails_at(Stage.PARSED):
+        state.record_classified(email_id, model.classify_email(email))
+    for email_id, email in state.emails_at(Stage.CLASSIFIED)[:extract_limit]:
+        state.record_extracted(email_id, model.extract_data(email))
+    if extract_limit is None:
+        matcher = CsvReceiptMatcher(
+            output_csv if os.path.exists(output_csv) else csv_path
+        )
+        to_match = state.emails_at(Stage.EXTRACTED) + state.emails_at(Stage.MATCHED)
+        email_ids, receipts = state.receipts_to_match(to_match)
+        for email_id, match in zip(
+            email_ids, matcher.match_receipts(receipts), strict=True
+        ):
+            state.record_matched(email_id, match)
+        matcher.update_csv(output_csv)
+        state.record_written(
+            [email_id for email_id, _ in state.emails_at(Stage.MATCHED)]
+        )
+    state.close()
+
+
+def test_rerun_resumes_where_it_stopped(
+    mailbox: tuple[str, list[dict]], transactions_csv: str, tmp_path: str
+) -> None:
+    """Stop partway through extraction, reopen the store and finish, then rerun, without redoing anything."""
+    directory, labels = mailbox
+    receipts = [label for label in labels if label["is_receipt"]]
+    model = CountingLabelModel(directory, labels)
+    db_path = os.path.join(tmp_path, "state.db")
+    output_csv = os.path.join(tmp_path, "updated.csv")
+
+    # Ollama falls over after a few receipts.
+    _run(db_path, directory, model, transactions_csv, output_csv, extract_limit=5)
+    assert len(model.extracted) == 5
+    state = PipelineStateStore(db_path)
+    assert state.counts()["extracted"] == 5
+    state.close()
+
+    _run(db_path, directory, model, transactions_csv, output_csv)
+    assert len(model.extracted) == len(set(model.extracted)) == len(receipts)
+    state = PipelineStateStore(db_path)
+    assert state.counts()["written"] == len(receipts)
+    state.close()
+
+    # A rerun over the same mailbox parses, extracts and writes nothing.
+    written = pl.read_csv(output_csv)
+    _run(db_path, directory, model, transactions_csv, output_csv)
+    assert len(model.extracted) == len(receipts)
+    assert pl.read_csv(output_csv).equals(written)
+    notes = "\n".join(written["Notes"].drop_nulls())
+    for label in receipts:
+        receipt = ParsedReceipt.model_validate(label["receipt"])
+        assert notes.count(receipt.to_str().strip()) == 1
+
+
+def test_stages_only_move_forward(
+    mailbox: tuple[str, list[dict]], tmp_path: str
+) -> None:
+    """Ignore stale updates, skip known files and give up on emails that keep failing."""
+    directory, labels = mailbox
+    receipt_label = next(label for label in labels if label["is_receipt"])
+    other_label = next(
+        label
+        for label in labels
+        if label["is_receipt"] and label["file"] != receipt_label["file"]
+    )
+    state = PipelineStateStore(os.path.join(tmp_path, "state.db"))
+    recorded = {}
+    for label in (receipt_label, other_label):
+        path = os.path.join(directory, label["file"])
+        recorded[label["file"]] = email_id = state.hash_file(path)
+        state.record_parsed(email_id, path, parse_eml(path))
+        state.record_classified(email_id, True)
+    email_id, other_id = recorded[receipt_label["file"]], recorded[other_label["file"]]
+
+    # Only matched emails can be written, and a stage that was already passed is not gone back to.
+    state.record_written([email_id])
+    assert state.stage(email_id) == Stage.CLASSIFIED
+    state.record_extracted(
+        email_id, ParsedReceipt.model_validate(receipt_label["receipt"])
+    )
+    state.record_classified(email_id, True)
+    assert state.stage(email_id) == Stage.EXTRACTED
+    state.record_matched(email_id, MatchResult(transaction_id="1"))
+    state.record_written([email_id])
+    state.record_matched(email_id, MatchResult())
+    assert state.stage(email_id) == Stage.WRITTEN
+
+    # Copies of known files are not new, whatever they are called.
+    copies = os.path.join(tmp_path, "copies")
+    os.makedirs(copies)
+    shutil.copy(
+        os.path.join(directory, receipt_label["file"]),
+        os.path.join(copies, "copy.eml"),
+    )
+    shutil.copy(os.path.join(directory, other_label["file"]), copies)
+    assert state.new_files(copies) == []
+
+    # An email that has failed max_attempts times is left out.
+    assert state.emails_at(Stage.CLASSIFIED) == [
+        (other_id, parse_eml(os.path.join(directory, other_label["file"])))
+    ]
+    for _ in range(3):
+        state.record_failure(other_id, "ollama down")
+    assert state.emails_at(Stage.CLASSIFIED) == []
+    assert len(state.emails_at(Stage.CLASSIFIED, max_attempts=4)) == 1
+    state.close()
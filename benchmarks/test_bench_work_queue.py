@@ -0,0 +1,209 @@
+import os
+import threading
+import time
+
+import polars as pl
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+from synthetic import write_mailbox, write_transactions
+from test_bench_daemon import LabelModel
+
+from receiptaggregator.models import ParsedReceipt
+from receiptaggregator.receipt_matcher import CsvReceiptMatcher
+from receiptaggregator.state_store import PipelineStateStore
+from receiptaggregator.work_queue import RedisWorkQueue, SqliteWorkQueue
+from receiptaggregator.worker import PipelineWorker, WorkCoordinator
+
+
+class CountingLabelModel(LabelModel):
+    """Classify and extract emails from the synthetic labels, remembering every body it extracts."""
+
+    def __init__(self, directory: str, labels: list[dict]) -> None:
+        """Initialize the CountingLabelModel.
+        :param directory: The synthetic mailbox.
+        :param labels: Its labels.
+        """
+        super().__init__(directory, labels)
+        self.extracted: list[str] = []
+
+    def extract_data(self, receipt: dict) -> ParsedReceipt:
+        """Look up the labeled receipt for an email and remember it was extracted."""
+        self.extracted.append(receipt["Body"])
+        return super().extract_data(receipt)
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def make_queue(request: pytest.FixtureRequest, tmp_path: str) -> object:
+    """Make a factory for queues that all share one backing store, like workers on different machines would."""
+    if request.param == "sqlite":
+        path = os.path.join(tmp_path, "queue.db")
+        return lambda **kwargs: SqliteWorkQueue(path, **kwargs)
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    return lambda **kwargs: RedisWorkQueue(fakeredis.FakeRedis(server=server), **kwargs)
+
+
+def test_queue_round_trip(benchmark: BenchmarkFixture, make_queue: object) -> None:
+    """Queue, lease, complete and collect a batch of emails."""
+
+    def round_trip() -> int:
+        queue = make_queue()
+        queue.put([(f"{i:05d}", {"path": f"{i:05d}.eml"}) for i in range(200)])
+        while leases := queue.lease("worker", 20):
+            for lease in leases:
+                queue.complete(lease, {"email": None})
+        results = queue.collect(1000)
+        queue.mark_collected([item_id for item_id, _, _ in results])
+        return len(results)
+
+    collected = benchmark.pedantic(round_trip, rounds=1)
+    assert collected == 200
+
+
+def test_expired_lease_is_retried_once(make_queue: object) -> None:
+    """Give an item to a second worker when the first goes quiet, and only keep one result."""
+    queue = make_queue(lease_seconds=0.2, max_attempts=2)
+    queue.put([("email", {"path": "email.eml"})])
+    (first,) = queue.lease("first")
+    assert queue.lease("second") == []
+    time.sleep(0.3)
+    (second,) = queue.lease("second")
+    assert second.attempts == 2
+    assert queue.complete(second, {"email": None})
+    assert not queue.complete(first, {"email": None})
+    assert len(queue.collect()) == 1
+    queue.mark_collected(["email"])
+    assert queue.collect() == []
+    assert queue.put([("email", {"path": "email.eml"})]) == 0
+
+
+def test_failures_give_up_after_max_attempts(make_queue: object) -> None:
+    """Retry a failing item until it has had max_attempts."""
+    queue = make_queue(max_attempts=2)
+    queue.put([("email", {"path": "email.eml"})])
+    queue.fail(queue.lease("worker")[0], "ollama down")
+    queue.fail(queue.lease("worker")[0], "ollama down")
+    assert queue.lease("worker") == []
+    assert queue.counts()["failed"] == 1
+    # The next enqueue gives it another round.
+    assert queue.requeue_failed() == 1
+    assert queue.lease("worker")[0].attempts == 1
+
+
+class SlowExtractor:
+    """Take longer than a lease to extract anything."""
+
+    def classify_email(self, email: dict) -> bool:
+        """Treat every email as a receipt."""
+        return True
+
+    def extract_data(self, receipt: dict) -> ParsedReceipt:
+        """Sleep, then extract an empty receipt."""
+        time.sleep(0.6)
+        return ParsedReceipt(merchant="Bombas", total_cost=0, total_billed=0, items=[])
+
+
+def test_heartbeat_keeps_a_slow_lease(make_queue: object) -> None:
+    """Keep extending the lease while an extraction outlasts lease_seconds, so no other worker takes the email."""
+    queue = make_queue(lease_seconds=0.2)
+    email = {"Subject": "Receipt", "From": "Bombas", "Date": "", "Body": "$1.00"}
+    queue.put([("email", {"path": "email.eml", "source": "email.eml", "email": email})])
+    processed = []
+
+    def work() -> None:
+        extractor = SlowExtractor()
+        worker = PipelineWorker(
+            make_queue(lease_seconds=0.2),
+            extractor,
+            classifier=extractor,
+            heartbeat_seconds=0.05,
+        )
+        worker.run_once()
+        processed.append(worker.processed)
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    time.sleep(0.4)
+    assert queue.lease("other") == []
+    thread.join()
+    assert processed == [1]
+    assert len(queue.collect()) == 1
+
+
+class HungExtractor(SlowExtractor):
+    """Never come back from an extraction, like a hung Ollama host, until released."""
+
+    def __init__(self) -> None:
+        """Initialize the HungExtractor."""
+        self.release = threading.Event()
+
+    def extract_data(self, receipt: dict) -> ParsedReceipt:
+        """Wait until released."""
+        self.release.wait()
+        return super().extract_data(receipt)
+
+
+def test_hung_extraction_gives_up_the_lease(make_queue: object) -> None:
+    """Stop extending the lease once max_process_seconds is up and hand the email back to the queue."""
+    queue = make_queue(lease_seconds=0.2)
+    email = {"Subject": "Receipt", "From": "Bombas", "Date": "", "Body": "$1.00"}
+    queue.put([("email", {"path": "email.eml", "source": "email.eml", "email": email})])
+    extractor = HungExtractor()
+    worker = PipelineWorker(
+        queue,
+        extractor,
+        classifier=extractor,
+        heartbeat_seconds=0.05,
+        max_process_seconds=0.3,
+    )
+    started = time.monotonic()
+    assert worker.run_once() == 1
+    assert time.monotonic() - started < 5
+    assert worker.failed == 1
+    # Another worker gets it straight away.
+    assert queue.lease("other")[0].attempts == 2
+    extractor.release.set()
+
+
+def test_two_workers_write_back_once(make_queue: object, tmp_path: str) -> None:
+    """Share a mailbox with copies in it between two workers and write each receipt back exactly once."""
+    directory = os.path.join(tmp_path, "mailbox")
+    labels = write_mailbox(directory, 60, receipt_ratio=0.5, duplicate_ratio=0.2)
+    originals = [
+        label for label in labels if label["is_receipt"] and "duplicate_of" not in label
+    ]
+    csv_path = os.path.join(tmp_path, "transactions.csv")
+    write_transactions(
+        csv_path, 200, receipts=[label["receipt"] for label in originals]
+    )
+    model = CountingLabelModel(directory, labels)
+    state = PipelineStateStore(os.path.join(tmp_path, "state.db"))
+    coordinator = WorkCoordinator(state, make_queue())
+    coordinator.enqueue(directory)
+
+    def work(worker_id: str) -> None:
+        # Every worker opens its own connection to the queue, as it would on its own machine.
+        worker = PipelineWorker(
+            make_queue(), model, classifier=model, worker_id=worker_id
+        )
+        worker.run(exit_when_empty=True)
+
+    workers = [threading.Thread(target=work, args=(name,)) for name in ("a", "b")]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    counts = coordinator.wait(poll_seconds=0.05, timeout=30)
+    assert counts["failed"] == 0
+
+    output_csv = os.path.join(tmp_path, "updated.csv")
+    written = coordinator.write_back_csv(CsvReceiptMatcher(csv_path), output_csv)
+    assert len(written) == len(originals)
+    assert coordinator.write_back_csv(CsvReceiptMatcher(output_csv), output_csv) == []
+    # Copies were dropped before they were queued, so no receipt was extracted twice.
+    assert len(model.extracted) == len(set(model.extracted)) == len(originals)
+    notes = "\n".join(pl.read_csv(output_csv)["Notes"].drop_nulls())
+    for label in originals:
+        receipt = ParsedReceipt.model_validate(label["receipt"])
+        assert notes.count(receipt.to_str().strip()) == 1
+    state.close()
@@ -0,0 +1,59 @@
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = (
+    "lxml",
+    "pydantic",
+    "numpy",
+    "polars",
+    "scipy",
+    "ollama",
+    "google.genai",
+    "monarchmoney",
+    "gql",
+    "dotenv",
+)
+# Microseconds the lightweight imports may take, generous so a slow machine does not flake.
+IMPORT_BUDGET_US = 250_000
+
+
+def _import_time(statement: str) -> tuple[int, list[str]]:
+    """Run an import in a fresh interpreter and return its cumulative import time and the heavy modules it loaded."""
+    check = (
+        f"import sys; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"{statement}; {check}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Top level imports are not indented, their cumulative time covers everything they pulled in.
+        if not name.startswith("  ") and cumulative.strip().isdigit():
+            total += int(cumulative)
+    loaded = [module for module in result.stdout.strip().split(",") if module]
+    return total, loaded
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        "import receiptaggregator",
+        "from receiptaggregator import parse_eml, RuleBasedClassifier",
+        "from receiptaggregator import PipelineStateStore, Stage",
+    ],
+)
+def test_lightweight_import(statement: str) -> None:
+    """Parsing, rule classification and the state store should not pull in any heavy dependency."""
+    total, loaded = _import_time(statement)
+    expected = ["pydantic"] if "PipelineStateStore" in statement else []
+    assert loaded == expected
+    if not expected:
+        assert total < IMPORT_BUDGET_US, f"{statement} took {total / 1000:.1f}ms"
@@ -0,0 +1,67 @@
+import asyncio
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+from matplotlib import pyplot as plt
+from sklearn.metrics import roc_auc_score, roc_curve
+from sklearn.model_selection import StratifiedKFold
+
+from receiptaggregator.eml_loader import parse_directory
+from receiptaggregator.invoice_classification import (
+    GeminiClassifier,
+    RuleBasedClassifier,
+    TrainedClassifier,
+)
+
+# Gemini labels are cached, so once the mailbox has been labeled this runs offline. Set GEMINI_API_KEY to label any
+# emails that are not in the cache yet.
+load_dotenv()
+gemini_key = os.getenv("GEMINI_API_KEY")
+gemini = GeminiClassifier(gemini_key or "", cache_path="gemini_labels.jsonl")
+if gemini_key:
+    emails, _ = parse_directory("eml_files")
+
+    async def label_all() -> None:
+        """Label every email in the mailbox with gemini."""
+        await asyncio.gather(*(gemini.gemini_classification(email) for email in emails))
+
+    asyncio.run(label_all())
+labeled = gemini.cached_labels()
+emails = [email for email, _ in labeled]
+labels = np.array([is_receipt for _, is_receipt in labeled], dtype=int)
+
+# Every email is scored by a model that was trained without it.
+trained_scores = np.zeros(len(emails))
+for train, test in StratifiedKFold(5, shuffle=True, random_state=0).split(
+    emails, labels
+):
+    classifier = TrainedClassifier().fit(
+        [emails[i] for i in train], labels[train].tolist()
+    )
+    trained_scores[test] = classifier.score_emails([emails[i] for i in test])
+rule_classifier = RuleBasedClassifier()
+rule_scores = [rule_classifier.score_email(email) for email in emails]
+
+plt.figure(figsize=(8, 6))
+for name, scores, color in (
+    ("Rule based", rule_scores, "darkorange"),
+    ("Trained", trained_scores, "green"),
+):
+    fpr, tpr, _ = roc_curve(labels, scores)
+    auc = roc_auc_score(labels, scores)
+    print(f"{name} AUC: {auc:.3f}")
+    plt.plot(fpr, tpr, color=color, lw=2, label=f"{name} (area = {auc:.2f})")
+plt.plot([0, 1], [0, 1], color="navy", lw=2, linestyle="--")
+plt.xlim([0.0, 1.0])
+plt.ylim([0.0, 1.05])
+plt.xlabel("False Positive Rate")
+plt.ylabel("True Positive Rate")
+plt.title("Receiver Operating Characteristic (ROC) Curve")
+plt.legend(loc="lower right")
+plt.grid(True)
+plt.savefig("classifier_roc_curve.png")
+plt.show()
+
+# The model that gets used is trained on everything.
+TrainedClassifier().fit(emails, labels.tolist()).save("receipt_classifier.joblib")
@@ -0,0 +1,46 @@
+import os
+
+import ollama
+from dotenv import load_dotenv
+from google.genai import Client
+
+from receiptaggregator.evaluation import (
+    RecordedGeminiClient,
+    RecordedOllamaClient,
+    ResponseRecorder,
+    comparison_table,
+    evaluate_extractor,
+    load_labeled_set,
+)
+from receiptaggregator.receipt_extractor import (
+    GeminiReceiptExtractor,
+    OllamaReceiptExtractor,
+)
+
+# Dollars per million input and output tokens, local models only cost electricity.
+OLLAMA_MODELS = ["gemma3:4b", "mistral:7b", "qwen3:30b-a3b"]
+GEMINI_MODELS = {"gemini-2.5-flash": (0.30, 2.50)}
+
+# Responses are replayed from the recording, so once every model has been run against the labeled set this works
+# fully offline. Set OLLAMA_URL or GEMINI_API_KEY to fill in anything that has not been recorded yet.
+load_dotenv()
+labeled = load_labeled_set("labeled_receipts.jsonl")
+recorder = ResponseRecorder("recorded_responses.jsonl")
+ollama_url = os.getenv("OLLAMA_URL")
+gemini_key = os.getenv("GEMINI_API_KEY")
+
+reports = []
+ollama_client = RecordedOllamaClient(
+    recorder, ollama.Client(host=ollama_url) if ollama_url else None
+)
+for model in OLLAMA_MODELS:
+    extractor = OllamaReceiptExtractor(ollama_client, model)
+    reports.append(evaluate_extractor(model, extractor, recorder, labeled))
+gemini_client = RecordedGeminiClient(
+    recorder, Client(api_key=gemini_key) if gemini_key else None
+)
+for model, price in GEMINI_MODELS.items():
+    extractor = GeminiReceiptExtractor("", model, client=gemini_client)
+    reports.append(evaluate_extractor(model, extractor, recorder, labeled, price))
+
+print(comparison_table(reports))
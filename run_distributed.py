@@ -0,0 +1,78 @@
+import argparse
+import os
+
+import ollama
+
+from receiptaggregator.attachments import AttachmentExtractor
+from receiptaggregator.receipt_extractor import (
+    OllamaReceiptExtractor,
+    RoutingReceiptExtractor,
+)
+from receiptaggregator.receipt_matcher import CsvReceiptMatcher
+from receiptaggregator.state_store import PipelineStateStore
+from receiptaggregator.work_queue import RedisWorkQueue, SqliteWorkQueue
+from receiptaggregator.worker import PipelineWorker, WorkCoordinator
+
+
+def make_queue(args: argparse.Namespace) -> SqliteWorkQueue | RedisWorkQueue:
+    """Open the shared queue, Redis if a url was given and otherwise SQLite on the shared volume."""
+    if args.redis_url:
+        import redis
+
+        return RedisWorkQueue(redis.Redis.from_url(args.redis_url))
+    return SqliteWorkQueue(args.queue_db)
+
+
+def coordinate(args: argparse.Namespace) -> None:
+    """Queue the mailbox, collect results as workers finish them, then match and write them back."""
+    state = PipelineStateStore("pipeline_state.db")
+    try:
+        attachments = AttachmentExtractor("attachment_cache")
+    except ImportError:
+        attachments = None
+    coordinator = WorkCoordinator(state, make_queue(args), attachments)
+    print(f"Queued {coordinator.enqueue(args.mailbox)} emails")
+    if attachments is not None:
+        attachments.close()
+    print(coordinator.wait())
+    output_csv = "monarch_csv_updated.csv"
+    matcher = CsvReceiptMatcher(
+        output_csv if os.path.exists(output_csv) else "monarch_csv.csv"
+    )
+    coordinator.write_back_csv(matcher, output_csv)
+    print(state.counts())
+    print(state.dedup_summary())
+    state.close()
+
+
+def work(args: argparse.Namespace) -> None:
+    """Work through the queue against this machine's Ollama host."""
+    client = ollama.Client(host=args.ollama_url)
+    extractor = RoutingReceiptExtractor(
+        [OllamaReceiptExtractor(client, model) for model in args.models.split(",")]
+    )
+    worker = PipelineWorker(make_queue(args), extractor, batch_size=args.batch_size)
+    worker.run(exit_when_empty=args.exit_when_empty)
+    print(f"{worker.worker_id}: {worker.processed} processed, {worker.failed} failed")
+
+
+# Start one coordinator, then a worker on every machine with an Ollama host. The mailbox must be at the same path on
+# every machine, e.g. a shared volume, and so must the queue database unless --redis-url is used.
+parser = argparse.ArgumentParser(
+    description="Run the pipeline across several machines."
+)
+parser.add_argument("role", choices=["coordinator", "worker"])
+parser.add_argument("--mailbox", default="eml_files")
+parser.add_argument("--queue-db", default="work_queue.db")
+parser.add_argument("--redis-url")
+parser.add_argument("--ollama-url", default=os.getenv("OLLAMA_URL"))
+parser.add_argument("--models", default="gemma3:4b,qwen3:30b-a3b")
+parser.add_argument("--batch-size", type=int, default=1)
+parser.add_argument("--exit-when-empty", action="store_true")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.role == "coordinator":
+        coordinate(args)
+    else:
+        work(args)
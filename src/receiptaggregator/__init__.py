@@ -1,19 +1,104 @@
-from .eml_loader import parse_directory, parse_eml
-from .invoice_classification import GeminiClassifier, RuleBasedClassifier
-from .models import ParsedReceipt, ReceiptItem
-from .receipt_extractor import OllamaReceiptExtractor
-from .receipt_matcher import ApiReceiptMatcher, CsvReceiptMatcher
-from .string_similarity import jaro_distance
+import importlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .attachments import AttachmentExtractor
+    from .daemon import DirectorySource, ImapSource, ReceiptDaemon
+    from .dedup import EmailDeduplicator
+    from .eml_loader import parse_directory, parse_eml, parse_emls
+    from .export import ReceiptExporter
+    from .invoice_classification import (
+        GeminiClassifier,
+        RuleBasedClassifier,
+        TrainedClassifier,
+    )
+    from .metrics import Metrics
+    from .models import MatchResult, ParsedReceipt, ReceiptBatch, ReceiptItem
+    from .receipt_extractor import (
+        GeminiReceiptExtractor,
+        OllamaReceiptExtractor,
+        RoutingReceiptExtractor,
+    )
+    from .receipt_matcher import ApiReceiptMatcher, CsvReceiptMatcher
+    from .state_store import PipelineStateStore, Stage
+    from .string_similarity import jaro_distance
+    from .work_queue import RedisWorkQueue, SqliteWorkQueue
+    from .worker import PipelineWorker, WorkCoordinator
+
+# Everything is loaded on first access, so a script that only parses and classifies emails never pays for importing
+# polars, ollama, google-genai or monarchmoney.
+_exports = {
+    "ParsedReceipt": ".models",
+    "ReceiptItem": ".models",
+    "MatchResult": ".models",
+    "ReceiptBatch": ".models",
+    "parse_eml": ".eml_loader",
+    "parse_directory": ".eml_loader",
+    "parse_emls": ".eml_loader",
+    "AttachmentExtractor": ".attachments",
+    "OllamaReceiptExtractor": ".receipt_extractor",
+    "GeminiReceiptExtractor": ".receipt_extractor",
+    "RoutingReceiptExtractor": ".receipt_extractor",
+    "CsvReceiptMatcher": ".receipt_matcher",
+    "ApiReceiptMatcher": ".receipt_matcher",
+    "jaro_distance": ".string_similarity",
+    "GeminiClassifier": ".invoice_classification",
+    "RuleBasedClassifier": ".invoice_classification",
+    "TrainedClassifier": ".invoice_classification",
+    "PipelineStateStore": ".state_store",
+    "Stage": ".state_store",
+    "Metrics": ".metrics",
+    "EmailDeduplicator": ".dedup",
+    "SqliteWorkQueue": ".work_queue",
+    "RedisWorkQueue": ".work_queue",
+    "PipelineWorker": ".worker",
+    "WorkCoordinator": ".worker",
+    "ReceiptDaemon": ".daemon",
+    "DirectorySource": ".daemon",
+    "ImapSource": ".daemon",
+    "ReceiptExporter": ".export",
+}
 
 __all__ = [
     "ParsedReceipt",
     "ReceiptItem",
+    "MatchResult",
+    "ReceiptBatch",
     "parse_eml",
     "parse_directory",
+    "parse_emls",
+    "AttachmentExtractor",
     "OllamaReceiptExtractor",
+    "GeminiReceiptExtractor",
+    "RoutingReceiptExtractor",
     "CsvReceiptMatcher",
     "ApiReceiptMatcher",
     "jaro_distance",
     "GeminiClassifier",
     "RuleBasedClassifier",
+    "TrainedClassifier",
+    "PipelineStateStore",
+    "Stage",
+    "Metrics",
+    "EmailDeduplicator",
+    "SqliteWorkQueue",
+    "RedisWorkQueue",
+    "PipelineWorker",
+    "WorkCoordinator",
+    "ReceiptDaemon",
+    "DirectorySource",
+    "ImapSource",
+    "ReceiptExporter",
 ]
+
+
+def __getattr__(name: str) -> object:
+    if name not in _exports:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,242 @@
+import binascii
+import hashlib
+import importlib.util
+import multiprocessing
+import os
+import signal
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from email.message import Message
+
+from receiptaggregator.metrics import metrics
+
+PDF_TYPES = {"application/pdf", "application/x-pdf"}
+# Base64 lines are 76 characters plus a newline, so this decodes about 48KB at a time.
+_CHUNK = 77 * 1024
+
+
+def pdf_parts(msg: Message) -> list[Message]:
+    """Get the parts of an email that are pdf files.
+    :param msg: The parsed email.
+    """
+    return [
+        part
+        for part in msg.walk()
+        if part.get_content_type() in PDF_TYPES
+        or (
+            part.get_content_type() == "application/octet-stream"
+            and (part.get_filename() or "").lower().endswith(".pdf")
+        )
+    ]
+
+
+def pdf_text(path: str, max_pages: int = 50, timeout_seconds: float = 30) -> str:
+    """Get the text layer of a pdf, this runs in the pool's worker processes.
+    :param path: The path to the pdf.
+    :param max_pages: Only read this many pages.
+    :param timeout_seconds: Give up on the file after this long.
+    """
+    from pypdf import PdfReader
+
+    # pypdf is pure python, so an alarm can interrupt it wherever it is stuck. Without SIGALRM the pool's own deadline
+    # is the only limit.
+    alarm = hasattr(signal, "setitimer")
+    if alarm:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout_seconds)
+    try:
+        reader = PdfReader(path)
+        return "\n".join(page.extract_text() or "" for page in reader.pages[:max_pages])
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _raise_timeout(signum: int, frame: object) -> None:
+    raise TimeoutError("pdf took too long to read")
+
+
+class AttachmentExtractor:
+    """Pull the text out of the pdf attachments of emails, so invoices that only come as a pdf reach the pipeline.
+
+    Each attachment is decoded a chunk at a time into a temporary file and hashed on the way, then read with pypdf in a
+    pool of worker processes, so a slow or malformed pdf only ties up one worker and never the process that called it.
+    Text is cached on disk by the hash of the attachment, so with a cache_dir the same pdf is only ever read once,
+    across emails and reruns. Without one, only copies within a batch share a read.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str | None = None,
+        max_bytes: int = 20 * 1024 * 1024,
+        max_pages: int = 50,
+        timeout_seconds: float = 30,
+        max_workers: int | None = None,
+    ) -> None:
+        """Initialize the AttachmentExtractor.
+        :param cache_dir: A directory to keep the text of every attachment in, attachments already in it are not read
+            again. Nothing is kept in memory between batches, so this is the only cache.
+        :param max_bytes: Skip attachments bigger than this.
+        :param max_pages: Only read this many pages of each attachment.
+        :param timeout_seconds: Give up on an attachment after this long.
+        :param max_workers: The number of worker processes, the number of cpus by default.
+        """
+        if importlib.util.find_spec("pypdf") is None:
+            raise ImportError(
+                "Reading pdf attachments needs pypdf, install it with `pip install receiptaggregator[pdf]`"
+            )
+        self._cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._max_pages = max_pages
+        self._timeout_seconds = timeout_seconds
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._pool: ProcessPoolExecutor | None = None
+
+    def text(self, msg: Message) -> str:
+        """Get the text of every pdf attached to an email.
+        :param msg: The parsed email.
+        """
+        return self.texts([msg])[0]
+
+    @metrics.timed("attachments.texts")
+    def texts(self, messages: list[Message]) -> list[str]:
+        """Get the text of every pdf attached to each of a batch of emails, reading all of them in parallel.
+        :param messages: The parsed emails.
+        """
+        with tempfile.TemporaryDirectory() as spool_dir:
+            hashes = []
+            found: dict[str, str] = {}
+            to_read: dict[str, str] = {}
+            for msg in messages:
+                message_hashes = []
+                for part in pdf_parts(msg):
+                    spooled = self._spool(part, spool_dir)
+                    if spooled is None:
+                        continue
+                    digest, path = spooled
+                    message_hashes.append(digest)
+                    if digest in found or digest in to_read:
+                        metrics.increment("attachments.cache_hit")
+                        continue
+                    cached = self._cached(digest)
+                    if cached is None:
+                        to_read[digest] = path
+                    else:
+                        metrics.increment("attachments.cache_hit")
+                        found[digest] = cached
+                hashes.append(message_hashes)
+            found.update(self._read(to_read))
+        return [
+            "\n".join(found.get(digest, "") for digest in message_hashes)
+            for message_hashes in hashes
+        ]
+
+    def _spool(self, part: Message, spool_dir: str) -> tuple[str, str] | None:
+        """Decode an attachment into a file in the spool directory, hashing it on the way.
+        Returns the hash and the path, or None if the attachment is too big or can not be decoded.
+        """
+        payload = part.get_payload()
+        base64 = part.get("Content-Transfer-Encoding", "").lower() == "base64"
+        if (
+            not isinstance(payload, str)
+            or len(payload) * (3 / 4 if base64 else 1) > self._max_bytes
+        ):
+            metrics.increment("attachments.too_large")
+            return None
+        digest = hashlib.sha256()
+        fd, path = tempfile.mkstemp(suffix=".pdf", dir=spool_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if base64:
+                    # Only decode whole groups of four characters, whatever is left over goes in front of the next
+                    # chunk.
+                    leftover = ""
+                    for start in range(0, len(payload), _CHUNK):
+                        encoded = leftover + "".join(
+                            payload[start : start + _CHUNK].split()
+                        )
+                        usable = len(encoded) - len(encoded) % 4
+                        leftover = encoded[usable:]
+                        chunk = binascii.a2b_base64(encoded[:usable])
+                        digest.update(chunk)
+                        f.write(chunk)
+                else:
+                    chunk = part.get_payload(decode=True)
+                    digest.update(chunk)
+                    f.write(chunk)
+        except (binascii.Error, TypeError):
+            # Broken base64, or nothing to decode. The rest of the email's attachments are still read.
+            metrics.increment("attachments.failed")
+            os.remove(path)
+            return None
+        return digest.hexdigest(), path
+
+    def _cached(self, digest: str) -> str | None:
+        if self._cache_dir is None:
+            return None
+        path = os.path.join(self._cache_dir, f"{digest}.txt")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+
+    def _store(self, digest: str, text: str) -> None:
+        if self._cache_dir is not None:
+            path = os.path.join(self._cache_dir, f"{digest}.txt")
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(path + ".tmp", path)
+
+    def _read(self, to_read: dict[str, str]) -> dict[str, str]:
+        """Read a batch of spooled attachments in the pool and cache their text.
+        Returns the text of every attachment that was read, by its hash.
+        """
+        texts: dict[str, str] = {}
+        if not to_read:
+            return texts
+        if self._pool is None:
+            # spawn rather than fork, the callers may have threads of their own running.
+            self._pool = ProcessPoolExecutor(
+                self._max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        futures: dict[Future, str] = {
+            self._pool.submit(
+                pdf_text, path, self._max_pages, self._timeout_seconds
+            ): digest
+            for digest, path in to_read.items()
+        }
+        # Each file has its own alarm in the worker, this is a backstop for a worker that stops answering entirely.
+        rounds = -(-len(futures) // self._max_workers)
+        done, not_done = wait(futures, timeout=rounds * self._timeout_seconds + 10)
+        for future in done:
+            try:
+                text = future.result()
+            except BrokenProcessPool:
+                # A worker died, most likely on a pdf that ate all its memory. Try again on the next run.
+                metrics.increment("attachments.failed")
+                continue
+            except Exception:
+                # Encrypted, malformed or too slow. Reading it again would fail the same way, so cache it as empty.
+                metrics.increment("attachments.failed")
+                text = ""
+            else:
+                metrics.increment("attachments.extracted")
+            texts[futures[future]] = text
+            self._store(futures[future], text)
+        if not_done or any(isinstance(f.exception(), BrokenProcessPool) for f in done):
+            metrics.increment("attachments.timed_out", len(not_done))
+            # A hung worker never picks up the shutdown, so kill the processes rather than leave them running.
+            for process in list((self._pool._processes or {}).values()):
+                process.kill()
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        return texts
+
+    def close(self) -> None:
+        """Shut down the worker processes."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -0,0 +1,314 @@
+import re
+from datetime import datetime
+
+import numpy as np
+import polars as pl
+from scipy.optimize import linear_sum_assignment
+
+from receiptaggregator.models import MatchResult, ParsedReceipt
+from receiptaggregator.string_similarity import jaro_distance
+from receiptaggregator.transaction_index import TransactionIndex, to_day
+
+last_four_regex = re.compile(r"(\d{4})\D*$")
+receipt_note_regex = re.compile(r"Total Cost: \S+ - Total Billed: ")
+
+# A transaction with one of these tags already has a receipt on it, from this tool or from Monarch's own retail sync.
+RECEIPT_TAGS = ("ReceiptAggregator", "Retail Sync")
+
+# Anything that is not a candidate gets this cost, so the solver only picks it when it has no other choice.
+_NOT_A_CANDIDATE = 1e9
+
+# Each tier is a window of days either side of the receipt (None for any date) and the merchant similarity a
+# transaction needs within it. Hotels and pre-orders get charged weeks after the receipt, so receipts the normal window
+# misses are searched again with wider windows, asking for a closer merchant name each time to make up for it.
+DEFAULT_TIERS: tuple[tuple[int | None, float], ...] = (
+    (5, 0.75),
+    (30, 0.85),
+    (None, 0.92),
+)
+
+
+class BatchReceiptMatcher:
+    """Assign a whole run of receipts to transactions at once, one receipt per transaction.
+
+    Every receipt is paired with the transactions near its amount and date, each pair gets a cost from the date
+    distance, amount difference, merchant similarity and card last four, and the pairs are then solved as an assignment
+    problem for each group of receipts that compete for the same transactions. Two $5 purchases at the same shop a few
+    days apart each end up with the transaction closest to their own date.
+
+    Receipts left unmatched go through the wider tiers in turn. Every tier is a range lookup on the same index, so
+    widening never goes back to the frame or the api.
+
+    Transactions that already have a receipt, by tag or by a receipt note, are never candidates. The one exception is a
+    transaction whose notes already hold this very receipt, which is where an earlier run wrote it.
+    """
+
+    def __init__(
+        self,
+        df: pl.DataFrame,
+        index: TransactionIndex | None = None,
+        tolerance_cents: int = 0,
+        tiers: tuple[tuple[int | None, float], ...] = DEFAULT_TIERS,
+        weights: tuple[float, float, float, float] = (1.0, 1.0, 2.0, 1.0),
+    ) -> None:
+        """Initialize the BatchReceiptMatcher.
+        :param df: The transactions, with Date, Amount, Merchant and optionally Account, Tags and Notes columns. temp_id
+            must be the row position.
+        :param index: An index already built over df.
+        :param tolerance_cents: How many cents a transaction's amount may differ from the receipt by.
+        :param tiers: The windows of days to search in turn and the merchant similarity each needs.
+        :param weights: How much date distance, amount difference, merchant dissimilarity and a card mismatch each cost.
+        """
+        self.index = index if index is not None else TransactionIndex.from_frame(df)
+        # Columns stay as polars series, values are only pulled out for the candidates of a receipt.
+        self._merchants = (
+            df["Merchant"].cast(pl.String).str.to_lowercase().fill_null("")
+        )
+        self._last_fours = (
+            df["Account"].cast(pl.String).str.extract(last_four_regex.pattern, 1)
+            if "Account" in df.columns
+            else pl.repeat(None, len(df), dtype=pl.String, eager=True)
+        )
+        self._notes = (
+            df["Notes"].cast(pl.String).fill_null("")
+            if "Notes" in df.columns
+            else pl.repeat("", len(df), dtype=pl.String, eager=True)
+        )
+        # Notes written during this run, rather than rewriting the notes column for every one.
+        self._written_notes: dict[int, str] = {}
+        has_receipt = pl.repeat(False, len(df), eager=True)
+        if "Tags" in df.columns:
+            has_receipt |= (
+                df["Tags"]
+                .cast(pl.String)
+                .str.split(",")
+                .list.eval(pl.element().str.strip_chars().is_in(RECEIPT_TAGS))
+                .list.any()
+                .fill_null(False)
+            )
+        if "Notes" in df.columns:
+            has_receipt |= (
+                df["Notes"]
+                .cast(pl.String)
+                .str.contains(receipt_note_regex.pattern)
+                .fill_null(False)
+            )
+        self._has_receipt = has_receipt.to_numpy().copy()
+        self._tolerance_cents = tolerance_cents
+        self.tiers = tiers
+        self._weights = weights
+
+    def mark_written(self, row_id: int, note: str) -> None:
+        """Record that a receipt was written to a transaction, so later batches leave it alone.
+        :param row_id: The row of the transaction.
+        :param note: The receipt note that was added to it.
+        """
+        self._has_receipt[row_id] = True
+        if note.strip() not in self._note(row_id):
+            self._written_notes[row_id] = self._note(row_id) + "\n" + note
+
+    @property
+    def nbytes(self) -> int:
+        """Get the memory used by the index and the transaction columns the matcher keeps."""
+        return (
+            self.index.nbytes
+            + self._merchants.estimated_size()
+            + self._last_fours.estimated_size()
+            + self._notes.estimated_size()
+            + self._has_receipt.nbytes
+        )
+
+    def candidates(
+        self,
+        receipt: ParsedReceipt,
+        day: int,
+        window_days: int | None,
+        min_similarity: float,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Find the candidate transactions for a receipt and what pairing with each would cost.
+        Returns the row ids, costs and merchant similarities of the candidates.
+        :param receipt: The receipt.
+        :param day: The day number of the receipt.
+        :param window_days: How many days either side of the receipt to look, None for any date.
+        :param min_similarity: The lowest merchant similarity a transaction can have and still be a candidate.
+        """
+        positions = self.index.positions(
+            -receipt.total_billed_cents, day, window_days, self._tolerance_cents
+        )
+        row_ids = self.index.row_ids[positions]
+        free = ~self._has_receipt[row_ids]
+        positions, row_ids = positions[free], row_ids[free]
+        merchant = receipt.merchant.lower()
+        similarities = np.array(
+            [
+                jaro_distance(merchant, candidate)
+                for candidate in self._merchants.gather(row_ids)
+            ],
+            dtype=np.float64,
+        )
+        keep = similarities >= min_similarity
+        positions, row_ids, similarities = (
+            positions[keep],
+            row_ids[keep],
+            similarities[keep],
+        )
+        date_weight, amount_weight, merchant_weight, card_weight = self._weights
+        if receipt.payment_method is None:
+            card_mismatch = np.zeros(len(row_ids))
+        else:
+            card_mismatch = (
+                self._last_fours.gather(row_ids)
+                .ne(receipt.payment_method[-4:])
+                .fill_null(False)
+                .to_numpy()
+                .astype(np.float64)
+            )
+        costs = (
+            date_weight
+            * np.abs(self.index.days[positions] - day)
+            / (window_days or 365)
+            + amount_weight
+            * np.abs(self.index.amount_cents[positions] + receipt.total_billed_cents)
+            / (self._tolerance_cents + 1)
+            + merchant_weight * (1 - similarities)
+            + card_weight * card_mismatch
+        )
+        return row_ids, costs, similarities
+
+    def assign(self, receipts: list[tuple[ParsedReceipt, str]]) -> list[MatchResult]:
+        """Assign receipts to transactions so the total cost over the whole run is lowest.
+        :param receipts: The receipts and the date of the email each came from.
+        """
+        days = [
+            to_day(datetime.strptime(date_str, "%a, %d %b %Y %H:%M:%S %z").date())
+            for _, date_str in receipts
+        ]
+        results = [MatchResult() for _ in receipts]
+        claimed: set[int] = set()
+        # A run that stopped after writing but before recording it finds its receipts where it left them.
+        for i, (receipt, _) in enumerate(receipts):
+            position = self._written_position(receipt, claimed)
+            if position is None:
+                continue
+            row_id = int(self.index.row_ids[position])
+            similarity = jaro_distance(
+                receipt.merchant.lower(), self._merchants[row_id]
+            )
+            results[i] = MatchResult(
+                transaction_id=str(row_id),
+                score=similarity,
+                candidates=1,
+                tier=self._tier_of(
+                    abs(int(self.index.days[position]) - days[i]), similarity
+                ),
+            )
+            claimed.add(row_id)
+        pending = [i for i in range(len(receipts)) if results[i].transaction_id is None]
+        for tier, (window_days, min_similarity) in enumerate(self.tiers):
+            edges: list[tuple[int, int, float, float]] = []
+            for i in pending:
+                row_ids, costs, similarities = self.candidates(
+                    receipts[i][0], days[i], window_days, min_similarity
+                )
+                results[i].candidates = len(row_ids)
+                edges += [
+                    edge
+                    for edge in zip(
+                        [i] * len(row_ids),
+                        row_ids.tolist(),
+                        costs.tolist(),
+                        similarities.tolist(),
+                        strict=True,
+                    )
+                    if edge[1] not in claimed
+                ]
+            for receipt_id, row_id, _, similarity in _solve(edges):
+                results[receipt_id].transaction_id = str(row_id)
+                results[receipt_id].score = similarity
+                results[receipt_id].tier = tier
+                claimed.add(row_id)
+            pending = [i for i in pending if results[i].transaction_id is None]
+            if not pending:
+                break
+        return results
+
+    def _written_position(
+        self, receipt: ParsedReceipt, claimed: set[int]
+    ) -> int | None:
+        """Find where in the index a transaction an earlier run already wrote this receipt to sits."""
+        note = receipt.to_str().strip()
+        for position in self.index.positions(
+            -receipt.total_billed_cents, 0, None, self._tolerance_cents
+        ).tolist():
+            row_id = int(self.index.row_ids[position])
+            if (
+                self._has_receipt[row_id]
+                and row_id not in claimed
+                and note in self._note(row_id)
+            ):
+                return position
+        return None
+
+    def _note(self, row_id: int) -> str:
+        return self._written_notes.get(row_id, self._notes[row_id])
+
+    def _tier_of(self, distance_days: int, similarity: float) -> int | None:
+        """Find the first tier a transaction this far away and this similar falls in."""
+        for tier, (window_days, min_similarity) in enumerate(self.tiers):
+            if (
+                window_days is None or distance_days <= window_days
+            ) and similarity >= min_similarity:
+                return tier
+        return None
+
+
+def _solve(
+    edges: list[tuple[int, int, float, float]],
+) -> list[tuple[int, int, float, float]]:
+    """Pick the cheapest one-to-one set of edges, solving each group that shares transactions on its own."""
+    chosen = []
+    for component in _components(edges):
+        if len(component) == 1:
+            chosen += component
+            continue
+        receipt_pos = {
+            receipt_id: i
+            for i, receipt_id in enumerate(sorted({edge[0] for edge in component}))
+        }
+        row_pos = {
+            row_id: j
+            for j, row_id in enumerate(sorted({edge[1] for edge in component}))
+        }
+        cost = np.full((len(receipt_pos), len(row_pos)), _NOT_A_CANDIDATE)
+        by_cell = {}
+        for edge in component:
+            cell = (receipt_pos[edge[0]], row_pos[edge[1]])
+            cost[cell] = edge[2]
+            by_cell[cell] = edge
+        chosen += [
+            by_cell[cell]
+            for cell in zip(*linear_sum_assignment(cost), strict=True)
+            if cell in by_cell
+        ]
+    return chosen
+
+
+def _components(
+    edges: list[tuple[int, int, float, float]],
+) -> list[list[tuple[int, int, float, float]]]:
+    """Split receipt to transaction edges into the groups that share transactions."""
+    parent: dict[tuple[str, int], tuple[str, int]] = {}
+
+    def find(node: tuple[str, int]) -> tuple[str, int]:
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for receipt_id, row_id, _, _ in edges:
+        parent[find(("receipt", receipt_id))] = find(("row", row_id))
+    components: dict[tuple[str, int], list] = {}
+    for edge in edges:
+        components.setdefault(find(("receipt", edge[0])), []).append(edge)
+    return list(components.values())
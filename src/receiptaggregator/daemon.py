@@ -0,0 +1,451 @@
+import asyncio
+import contextlib
+import imaplib
+import inspect
+import os
+import re
+import threading
+import time
+from collections.abc import Callable
+from datetime import UTC, datetime, timedelta
+from email.utils import parsedate_to_datetime
+
+from receiptaggregator.attachments import AttachmentExtractor
+from receiptaggregator.dedup import EmailDeduplicator, amounts
+from receiptaggregator.eml_loader import parse_eml
+from receiptaggregator.invoice_classification import RuleBasedClassifier
+from receiptaggregator.metrics import metrics
+from receiptaggregator.models import ParsedReceipt
+from receiptaggregator.receipt_extractor import ReceiptExtractor
+from receiptaggregator.state_store import PipelineStateStore, Stage
+
+uidvalidity_regex = re.compile(rb"UIDVALIDITY (\d+)")
+
+
+class DirectorySource:
+    """New eml files in a directory.
+
+    With watchdog installed, file events come from inotify (or the platform's equivalent) as they happen, after one
+    full listing at start for anything that arrived while nothing was watching. Without it, the directory is polled,
+    and only files modified since the last scan are reported, so a mailbox of any size costs the same to poll.
+    """
+
+    def __init__(
+        self, directory: str, poll_seconds: float = 5, use_watchdog: bool = True
+    ) -> None:
+        """Initialize the DirectorySource.
+        :param directory: The directory to watch.
+        :param poll_seconds: How often to scan the directory when watchdog is not available.
+        :param use_watchdog: Use watchdog if it is installed.
+        """
+        self.directory = directory
+        self._poll_seconds = poll_seconds
+        self._changed: set[str] = set()
+        self._lock = threading.Lock()
+        self._observer = None
+        self._scanned_until = 0.0
+        self._next_scan = 0.0
+        if use_watchdog:
+            try:
+                from watchdog.observers import Observer
+            except ImportError:
+                pass
+            else:
+                self._observer = Observer()
+                self._observer.schedule(self, directory)
+                self._observer.start()
+                # Listed after the observer starts, so nothing that lands in between is missed.
+                self._changed.update(self._list(0.0))
+
+    @property
+    def watching(self) -> bool:
+        """Check if file events are coming from watchdog rather than polling."""
+        return self._observer is not None
+
+    def dispatch(self, event: object) -> None:
+        """Take a file event from watchdog, called on its thread.
+        :param event: The watchdog event.
+        """
+        if event.is_directory:
+            return
+        path = getattr(event, "dest_path", None) or event.src_path
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        if path.endswith(".eml"):
+            with self._lock:
+                self._changed.add(path)
+
+    def poll(self) -> list[str]:
+        """Get the eml files that have appeared or changed since the last poll."""
+        if self._observer is not None:
+            with self._lock:
+                changed, self._changed = self._changed, set()
+            return sorted(changed)
+        now = time.time()
+        if now < self._next_scan:
+            return []
+        self._next_scan = now + self._poll_seconds
+        # Look back a little, mtimes are not always exact and a file may still have been being written at the last scan.
+        changed = self._list(self._scanned_until - 2)
+        self._scanned_until = now
+        return sorted(changed)
+
+    def _list(self, since: float) -> list[str]:
+        """List the eml files modified since a time."""
+        changed = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".eml") and entry.stat().st_mtime >= since:
+                    changed.append(os.path.join(self.directory, entry.name))
+        return changed
+
+    def close(self) -> None:
+        """Stop watching the directory."""
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+
+
+class ImapSource:
+    """New messages in an IMAP mailbox, saved as eml files in a spool directory.
+
+    The connection is kept open between polls. The last UID seen is kept in the spool directory, so a restart only
+    fetches what arrived while it was down.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        spool_dir: str,
+        mailbox: str = "INBOX",
+        poll_seconds: float = 60,
+        factory: Callable[[str], object] = imaplib.IMAP4_SSL,
+    ) -> None:
+        """Initialize the ImapSource.
+        :param host: The IMAP server.
+        :param user: The user to log in as.
+        :param password: The password to log in with.
+        :param spool_dir: The directory to save new messages to.
+        :param mailbox: The mailbox to watch.
+        :param poll_seconds: How often to check for new messages.
+        :param factory: Makes a connection to the host, imaplib.IMAP4_SSL by default. Swap in a stand-in for testing.
+        """
+        self._host = host
+        self._user = user
+        self._password = password
+        self._mailbox = mailbox
+        self._poll_seconds = poll_seconds
+        self._factory = factory
+        self._connection = None
+        self._next_poll = 0.0
+        self.spool_dir = spool_dir
+        os.makedirs(spool_dir, exist_ok=True)
+        self._state_path = os.path.join(
+            spool_dir, f".{re.sub(r'[^A-Za-z0-9]+', '_', mailbox)}.uid"
+        )
+
+    def _connect(self) -> object:
+        if self._connection is None:
+            connection = self._factory(self._host)
+            connection.login(self._user, self._password)
+            connection.select(self._mailbox, readonly=True)
+            self._connection = connection
+        return self._connection
+
+    def _last_seen(self) -> tuple[int, int]:
+        if not os.path.exists(self._state_path):
+            return 0, 0
+        with open(self._state_path) as f:
+            uidvalidity, uid = f.read().split()
+        return int(uidvalidity), int(uid)
+
+    def _save_last_seen(self, uidvalidity: int, uid: int) -> None:
+        with open(self._state_path + ".tmp", "w") as f:
+            f.write(f"{uidvalidity} {uid}")
+        os.replace(self._state_path + ".tmp", self._state_path)
+
+    def poll(self) -> list[str]:
+        """Save any new messages to the spool directory and get their paths."""
+        now = time.time()
+        if now < self._next_poll:
+            return []
+        self._next_poll = now + self._poll_seconds
+        try:
+            return self._fetch_new()
+        except (imaplib.IMAP4.abort, OSError):
+            # The server dropped the connection, reconnect on the next poll.
+            self._connection = None
+            metrics.increment("daemon.imap.reconnect")
+            return []
+
+    def _fetch_new(self) -> list[str]:
+        connection = self._connect()
+        _, status = connection.status(self._mailbox, "(UIDVALIDITY)")
+        uidvalidity = int(uidvalidity_regex.search(status[0]).group(1))
+        seen_validity, last_uid = self._last_seen()
+        if seen_validity != uidvalidity:
+            # The server renumbered the mailbox, so every UID has to be looked at again. The state store still
+            # recognizes the messages that were already processed by their content.
+            last_uid = 0
+        _, data = connection.uid("SEARCH", None, f"UID {last_uid + 1}:*")
+        # "n:*" always includes the newest message, even when its UID is below n.
+        uids = sorted(uid for uid in map(int, data[0].split()) if uid > last_uid)
+        paths = []
+        for uid in uids:
+            _, message = connection.uid("FETCH", str(uid), "(RFC822)")
+            path = os.path.join(self.spool_dir, f"{uidvalidity}-{uid}.eml")
+            with open(path + ".tmp", "wb") as f:
+                f.write(message[0][1])
+            os.replace(path + ".tmp", path)
+            self._save_last_seen(uidvalidity, uid)
+            paths.append(path)
+        return paths
+
+    def close(self) -> None:
+        """Log out of the server."""
+        if self._connection is not None:
+            with contextlib.suppress(imaplib.IMAP4.error, OSError):
+                self._connection.logout()
+            self._connection = None
+
+
+class ReceiptDaemon:
+    """Process new mail as it arrives, from parsing through to writing the match to Monarch.
+
+    Sources are polled every tick. When something new shows up, the daemon waits until the burst has died down for
+    debounce_seconds, then takes the whole batch through parsing, dedup, classification, extraction and one batched
+    match. The matcher is logged in and set up once at start, and the extractor's clients live as long as the daemon.
+    Everything about individual emails lives in the state store rather than in memory, so weeks of uptime do not make
+    the process any bigger.
+
+    Receipts that did not match are tried again every retry_seconds until they are max_retry_days old, since a card
+    can take a few days to post. Receipts whose extraction failed, because Ollama was down, are extracted again at
+    start and every retry_seconds until they have failed max_attempts times. Matches left unwritten by a crash are
+    redone once at start.
+    """
+
+    def __init__(
+        self,
+        state: PipelineStateStore,
+        sources: list[DirectorySource | ImapSource],
+        extractor: ReceiptExtractor,
+        matcher: object,
+        classifier: object | None = None,
+        tick_seconds: float = 0.5,
+        debounce_seconds: float = 2,
+        max_wait_seconds: float = 30,
+        retry_seconds: float = 3600,
+        max_retry_days: int = 14,
+        max_attempts: int = 3,
+        max_remembered: int = 10_000,
+        attachments: AttachmentExtractor | None = None,
+        csv_path: str | None = None,
+    ) -> None:
+        """Initialize the ReceiptDaemon.
+        :param state: The state store that holds the pipeline's progress.
+        :param sources: Where new mail comes from.
+        :param extractor: The extractor to run on receipts.
+        :param matcher: An ApiReceiptMatcher, a CsvReceiptMatcher, or anything with a match_receipts and optional login
+            and setup.
+        :param classifier: Anything with a classify_email method, a RuleBasedClassifier by default.
+        :param tick_seconds: How often to poll the sources.
+        :param debounce_seconds: How long the sources have to be quiet before a batch is processed.
+        :param max_wait_seconds: The longest a batch waits for a burst to end.
+        :param retry_seconds: How often receipts that did not match earlier are tried again.
+        :param max_retry_days: Stop retrying receipts from emails older than this many days.
+        :param max_attempts: Stop retrying the extraction of an email after it has failed this many times.
+        :param max_remembered: How many recent emails to check new ones against for duplicates.
+        :param attachments: Add the text of pdf attachments to the bodies with this.
+        :param csv_path: Where a CsvReceiptMatcher saves its csv after every match, it is needed for one.
+        """
+        if hasattr(matcher, "update_csv") and csv_path is None:
+            raise ValueError("A csv matcher needs a csv_path to save its matches to")
+        self.state = state
+        self.sources = sources
+        self._extractor = extractor
+        self._matcher = matcher
+        self._classifier = classifier or RuleBasedClassifier()
+        self._tick_seconds = tick_seconds
+        self._debounce_seconds = debounce_seconds
+        self._max_wait_seconds = max_wait_seconds
+        self._retry_seconds = retry_seconds
+        self._next_retry = time.monotonic() + retry_seconds
+        self._max_retry_days = max_retry_days
+        self._max_attempts = max_attempts
+        self._csv_path = csv_path
+        self._dedup = EmailDeduplicator(max_remembered=max_remembered)
+        self._attachments = attachments
+        for email_id, signature, money in state.signatures(max_remembered):
+            self._dedup.remember(email_id, signature, money)
+        self.processed = 0
+        self.batches = 0
+
+    async def start(self) -> None:
+        """Log the matcher in and fetch its tags, once for the life of the daemon."""
+        for step in ("login", "setup"):
+            method = getattr(self._matcher, step, None)
+            if method is not None:
+                await method()
+
+    async def run(self, stop: asyncio.Event | None = None) -> None:
+        """Process mail as it arrives until stopped.
+        :param stop: Set this to stop the daemon after the batch it is on.
+        """
+        stop = stop or asyncio.Event()
+        await self.start()
+        try:
+            await self._match(self.state.emails_at(Stage.MATCHED))
+            await self._retry()
+            while not stop.is_set():
+                paths = await self._gather(stop)
+                if paths:
+                    await self.process(paths)
+                if time.monotonic() >= self._next_retry:
+                    self._next_retry = time.monotonic() + self._retry_seconds
+                    await self._retry()
+        finally:
+            for source in self.sources:
+                source.close()
+            if self._attachments is not None:
+                self._attachments.close()
+
+    async def _retry(self) -> None:
+        """Extract the receipts whose extraction failed and match them along with the unmatched ones."""
+        to_match = self._to_retry()
+        to_match += await self._extract(
+            self.state.emails_at(Stage.CLASSIFIED, self._max_attempts)
+        )
+        await self._match(to_match)
+
+    def _to_retry(self) -> list[tuple[str, dict]]:
+        """Get the unmatched receipts that are still recent enough for their transaction to turn up."""
+        cutoff = datetime.now(UTC) - timedelta(days=self._max_retry_days)
+        recent = []
+        for email_id, email in self.state.emails_at(Stage.EXTRACTED):
+            try:
+                sent = parsedate_to_datetime(email["Date"])
+            except (TypeError, ValueError):
+                continue
+            if sent.tzinfo is None:
+                sent = sent.replace(tzinfo=UTC)
+            if sent >= cutoff:
+                recent.append((email_id, email))
+        return recent
+
+    async def _poll(self) -> list[str]:
+        paths = []
+        for source in self.sources:
+            paths += await asyncio.to_thread(source.poll)
+        return paths
+
+    async def _gather(self, stop: asyncio.Event) -> list[str]:
+        """Wait for new mail, then keep collecting until the burst is over."""
+        paths = dict.fromkeys(await self._poll())
+        if not paths:
+            await _sleep(stop, self._tick_seconds)
+            return []
+        started = last_new = time.monotonic()
+        while not stop.is_set():
+            now = time.monotonic()
+            if (
+                now - last_new >= self._debounce_seconds
+                or now - started >= self._max_wait_seconds
+            ):
+                break
+            await _sleep(stop, self._tick_seconds)
+            new = [path for path in await self._poll() if path not in paths]
+            if new:
+                paths.update(dict.fromkeys(new))
+                last_new = time.monotonic()
+        return list(paths)
+
+    async def process(self, paths: list[str]) -> None:
+        """Take a batch of new eml files through the whole pipeline.
+        :param paths: The paths of the files, ones that have already been recorded are skipped.
+        """
+        with metrics.timer("daemon.batch"):
+            to_extract = []
+            processed = 0
+            for path in paths:
+                if self.state.has_path(path) or not os.path.exists(path):
+                    continue
+                email_id = self.state.hash_file(path)
+                if self.state.stage(email_id) is not None:
+                    continue
+                email = parse_eml(path, self._attachments)
+                self.state.record_parsed(email_id, path, email)
+                processed += 1
+                if email is None or self._is_duplicate(email_id, email):
+                    continue
+                is_receipt = self._classifier.classify_email(email)
+                self.state.record_classified(email_id, is_receipt)
+                if is_receipt:
+                    to_extract.append((email_id, email))
+            await self._match(await self._extract(to_extract))
+        self.processed += processed
+        self.batches += 1
+        metrics.increment("daemon.emails", processed)
+
+    async def _extract(
+        self, to_extract: list[tuple[str, dict]]
+    ) -> list[tuple[str, dict]]:
+        """Extract the receipts from some emails, returning the ones that were extracted."""
+        extracted = []
+        for email_id, email in to_extract:
+            try:
+                receipt = await asyncio.to_thread(self._extractor.extract_data, email)
+            except Exception as err:
+                # Ollama is most likely down, the email stays classified and goes round again with the next retry.
+                self.state.record_failure(email_id, repr(err))
+                continue
+            self.state.record_extracted(email_id, receipt)
+            extracted.append((email_id, email))
+        return extracted
+
+    def _is_duplicate(self, email_id: str, email: dict) -> bool:
+        signature, money = self._dedup.signature(email["Body"]), amounts(email["Body"])
+        original = self._dedup.add(email_id, email["Body"], signature, money)
+        duplicate_of = None if original == email_id else original
+        self.state.record_deduplicated(
+            email_id, signature.tobytes(), money, duplicate_of
+        )
+        return duplicate_of is not None
+
+    async def _match(self, to_match: list[tuple[str, dict]]) -> None:
+        if not to_match:
+            return
+        email_ids, receipts = self.state.receipts_to_match(to_match)
+        if not receipts:
+            return
+        try:
+            matches = await self._match_receipts(receipts)
+        except Exception:
+            # The session most likely expired, log in again and give it one more try.
+            metrics.increment("daemon.relogin")
+            try:
+                await self.start()
+                matches = await self._match_receipts(receipts)
+            except Exception:
+                # Monarch is down, the receipts stay extracted and go round again with the next retry.
+                metrics.increment("daemon.match_failed")
+                return
+        matched = []
+        for email_id, match in zip(email_ids, matches, strict=True):
+            # Unmatched results are recorded too, so the matches dataset sees every outcome.
+            self.state.record_matched(email_id, match)
+            if match.transaction_id is not None:
+                matched.append(email_id)
+        if self._csv_path is not None:
+            self._matcher.update_csv(self._csv_path)
+        self.state.record_written(matched)
+
+    async def _match_receipts(self, receipts: list[tuple[ParsedReceipt, str]]) -> list:
+        matches = self._matcher.match_receipts(receipts)
+        return await matches if inspect.isawaitable(matches) else matches
+
+
+async def _sleep(stop: asyncio.Event, seconds: float) -> None:
+    with contextlib.suppress(TimeoutError):
+        await asyncio.wait_for(stop.wait(), seconds)
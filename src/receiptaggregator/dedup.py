@@ -0,0 +1,190 @@
+import hashlib
+import re
+import zlib
+
+import numpy as np
+
+from receiptaggregator.metrics import metrics
+
+# Lines a mail client adds when forwarding or replying, they differ between copies of the same receipt.
+forward_header_regex = re.compile(
+    r"^\s*(-+\s*forwarded message\s*-+|begin forwarded message:|-+\s*original message\s*-+"
+    r"|(from|sent|to|cc|date|subject):.*)$",
+    re.IGNORECASE | re.MULTILINE,
+)
+quote_regex = re.compile(r"^[\s>]+", re.MULTILINE)
+money_regex = re.compile(r"\$?\d+\.\d+|\$\d+")
+word_regex = re.compile(r"[a-z0-9]+")
+
+# Shingle hashes are 32 bits, so a and x stay below 2**31 and 2**32 and their product fits in a uint64.
+_PRIME = (1 << 31) - 1
+
+
+def normalize_body(body: str) -> str:
+    """Reduce an email body to the text that stays the same across forwarded, CC'd and re-sent copies.
+    :param body: The cleaned body of the email.
+    """
+    body = forward_header_regex.sub("", quote_regex.sub("", body))
+    return " ".join(word_regex.findall(body.lower()))
+
+
+def amounts(body: str) -> str:
+    """Get the money amounts in a body, two emails are only duplicates if these are the same.
+    Receipts from one merchant share most of their template, so this is what keeps two different orders apart.
+    :param body: The cleaned body of the email.
+    """
+    return ",".join(sorted({match.lstrip("$") for match in money_regex.findall(body)}))
+
+
+class EmailDeduplicator:
+    """Group copies of the same email so only one of each group goes to the LLM.
+
+    Exact copies are caught by hashing the normalized body. Near copies, such as forwards with a quoted header or
+    re-sent confirmations, are found with MinHash signatures over word shingles and LSH banding, then confirmed by the
+    estimated Jaccard similarity and by having the same money amounts.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.7,
+        num_perm: int = 128,
+        bands: int = 32,
+        shingle_size: int = 3,
+        seed: int = 0,
+        max_remembered: int | None = None,
+    ) -> None:
+        """Initialize the EmailDeduplicator.
+        :param threshold: The estimated Jaccard similarity two bodies need to be duplicates.
+        :param num_perm: The number of hash functions in a signature.
+        :param bands: The number of LSH bands, num_perm must be a multiple of it.
+        :param shingle_size: The number of words in each shingle.
+        :param seed: The seed for the hash functions.
+        :param max_remembered: Forget the oldest groups past this many, so a long running process stays the same size.
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _PRIME, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _PRIME, num_perm, dtype=np.uint64)
+        self.threshold = threshold
+        self._bands = bands
+        self._rows = num_perm // bands
+        self._shingle_size = shingle_size
+        self._exact: dict[str, str] = {}
+        self._buckets: dict[tuple, list[str]] = {}
+        self._signatures: dict[str, np.ndarray] = {}
+        self._money: dict[str, str] = {}
+        self._exact_of: dict[str, list[str]] = {}
+        self._max_remembered = max_remembered
+        self.seen = 0
+        self.duplicates = 0
+
+    def signature(self, body: str) -> np.ndarray:
+        """Build the MinHash signature of a body.
+        :param body: The cleaned body of the email.
+        """
+        words = normalize_body(body).split()
+        size = min(self._shingle_size, len(words)) or 1
+        shingles = {
+            zlib.crc32(" ".join(words[i : i + size]).encode())
+            for i in range(max(len(words) - size + 1, 1))
+        }
+        x = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        hashes = (self._a[:, None] * x[None, :] + self._b[:, None]) % _PRIME
+        return hashes.min(axis=1).astype(np.uint32)
+
+    def add(
+        self,
+        key: str,
+        body: str,
+        signature: np.ndarray | None = None,
+        money: str | None = None,
+    ) -> str:
+        """Add an email and find the group it belongs to.
+        Returns the key of the first email in the group, which is the email's own key if it is not a duplicate.
+        :param key: The id of the email.
+        :param body: The cleaned body of the email.
+        :param signature: The signature of the body, if it was already built.
+        :param money: The amounts in the body, if they were already found.
+        """
+        self.seen += 1
+        money = amounts(body) if money is None else money
+        if not money:
+            # Without any amounts there is nothing an extraction could get from it, and shipping or marketing mail
+            # is too often word for word the same to group safely.
+            return key
+        exact = hashlib.sha256(f"{money}\0{normalize_body(body)}".encode()).hexdigest()
+        if exact in self._exact:
+            metrics.increment("dedup.exact")
+            return self._duplicate(self._exact[exact])
+        signature = self.signature(body) if signature is None else signature
+        candidates = dict.fromkeys(
+            original
+            for band_key in self._band_keys(signature, money)
+            for original in self._buckets.get(band_key, ())
+        )
+        for original in candidates:
+            if np.mean(self._signatures[original] == signature) >= self.threshold:
+                metrics.increment("dedup.near")
+                self._exact[exact] = original
+                self._exact_of[original].append(exact)
+                return self._duplicate(original)
+        self.remember(key, signature, money)
+        self._exact[exact] = key
+        self._exact_of[key].append(exact)
+        return key
+
+    def remember(self, key: str, signature: np.ndarray | bytes, money: str) -> None:
+        """Add an email from an earlier run as the first of its group, without counting it as seen.
+        :param key: The id of the email.
+        :param signature: The signature of its body.
+        :param money: The amounts in its body.
+        """
+        if isinstance(signature, bytes):
+            signature = np.frombuffer(signature, dtype=np.uint32)
+        self._signatures[key] = signature
+        self._money[key] = money
+        self._exact_of[key] = []
+        for band_key in self._band_keys(signature, money):
+            self._buckets.setdefault(band_key, []).append(key)
+        if (
+            self._max_remembered is not None
+            and len(self._signatures) > self._max_remembered
+        ):
+            self._forget(next(iter(self._signatures)))
+
+    def _forget(self, key: str) -> None:
+        signature = self._signatures.pop(key)
+        for band_key in self._band_keys(signature, self._money.pop(key)):
+            bucket = self._buckets[band_key]
+            bucket.remove(key)
+            if not bucket:
+                del self._buckets[band_key]
+        for exact in self._exact_of.pop(key):
+            del self._exact[exact]
+
+    def _band_keys(self, signature: np.ndarray, money: str) -> list[tuple]:
+        # Only emails with the same amounts share buckets, so they are the only ones ever compared.
+        return [
+            (
+                money,
+                band,
+                signature[band * self._rows : (band + 1) * self._rows].tobytes(),
+            )
+            for band in range(self._bands)
+        ]
+
+    def __contains__(self, key: str) -> bool:
+        """Check if an email is the first of a group that is already known.
+        :param key: The id of the email.
+        """
+        return key in self._signatures
+
+    def _duplicate(self, original: str) -> str:
+        self.duplicates += 1
+        return original
+
+    @property
+    def dedup_ratio(self) -> float:
+        """Get the share of emails added that were duplicates."""
+        return self.duplicates / self.seen if self.seen else 0.0
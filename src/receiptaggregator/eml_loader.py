@@ -1,31 +1,103 @@
+import functools
 import os
 import re
+from email.message import EmailMessage
 from email.parser import BytesParser
 from email.policy import default
+from typing import TYPE_CHECKING
 
-from lxml.html.clean import Cleaner
+from receiptaggregator.metrics import metrics
+
+if TYPE_CHECKING:
+    from lxml.html.clean import Cleaner
+
+    from receiptaggregator.attachments import AttachmentExtractor
 
 link_regex = re.compile(r"https?://\S+|www\.\S+")
 html_regex = re.compile(r"<(!--)?(?!\s|>)[^>]*>")
-cleaner = Cleaner(
-    style=True,
-    scripts=True,
-    comments=True,
-    javascript=True,
-    page_structure=True,
-    safe_attrs_only=True,
-)
 
 
-def parse_eml(eml_file: str) -> dict | None:
-    """Parse an eml file and return a dictionary of the email.
+@functools.cache
+def get_cleaner() -> "Cleaner":
+    """Get the html cleaner, lxml is only imported the first time an email is parsed."""
+    from lxml.html.clean import Cleaner
+
+    return Cleaner(
+        style=True,
+        scripts=True,
+        comments=True,
+        javascript=True,
+        page_structure=True,
+        safe_attrs_only=True,
+    )
+
+
+def read_message(eml_file: str) -> EmailMessage:
+    """Read an eml file without doing anything else to it.
     :param eml_file: The path to the eml file.
     """
     with open(eml_file, "rb") as f:
-        msg = BytesParser(policy=default).parse(f)
+        return BytesParser(policy=default).parse(f)
+
+
+@metrics.timed("parse_eml")
+def parse_eml(
+    eml_file: str, attachments: "AttachmentExtractor | None" = None
+) -> dict | None:
+    """Parse an eml file and return a dictionary of the email.
+    :param eml_file: The path to the eml file.
+    :param attachments: Add the text of any pdf attachments to the body with this.
+    """
+    msg = read_message(eml_file)
+    return parse_message(msg, attachments.text(msg) if attachments is not None else "")
+
+
+def parse_emls(
+    eml_files: list[str],
+    attachments: "AttachmentExtractor | None" = None,
+    batch_bytes: int = 64 * 1024 * 1024,
+) -> list[dict | None]:
+    """Parse several eml files, reading the pdf attachments of each batch of them in parallel.
+    :param eml_files: The paths to the eml files.
+    :param attachments: Add the text of any pdf attachments to the bodies with this.
+    :param batch_bytes: Roughly how many bytes of email to hold in memory at once, a batch always has at least one.
+    """
+    if attachments is None:
+        return [parse_eml(eml_file) for eml_file in eml_files]
+    emails = []
+    batch: list[str] = []
+    size = 0
+    for eml_file in eml_files:
+        batch.append(eml_file)
+        size += os.path.getsize(eml_file)
+        if size >= batch_bytes:
+            emails += _parse_batch(batch, attachments)
+            batch, size = [], 0
+    if batch:
+        emails += _parse_batch(batch, attachments)
+    return emails
+
+
+def _parse_batch(
+    eml_files: list[str], attachments: "AttachmentExtractor"
+) -> list[dict | None]:
+    messages = [read_message(eml_file) for eml_file in eml_files]
+    emails = []
+    for msg, text in zip(messages, attachments.texts(messages), strict=True):
+        with metrics.timer("parse_eml"):
+            emails.append(parse_message(msg, text))
+    return emails
+
+
+def parse_message(msg: EmailMessage, attachment_text: str = "") -> dict | None:
+    """Turn a parsed email into a dictionary of the email.
+    :param msg: The parsed email.
+    :param attachment_text: The text of its attachments, cleaned along with the body.
+    """
     body = ""
 
-    # Note: Currently forwarded emails break the logic for datetime.
+    # Note: Currently forwarded emails break the logic for datetime. When the original is in the mailbox too, the
+    # dedup stage groups them and the group takes the original's date.
     if msg.is_multipart():
         for part in msg.walk():
             if part.get_content_type() == "text/plain":
@@ -44,10 +116,16 @@ def parse_eml(eml_file: str) -> dict | None:
         body = msg.get_payload(decode=True).decode(msg.get_content_charset() or "utf-8")
     # Remove all html that we can.
     email = {"Subject": msg["Subject"], "From": msg["From"], "Date": msg["Date"]}
-    if not body:
+    if not body and not attachment_text:
         return None
-    clean_body = cleaner.clean_html(body)
-    clean_body = html_regex.sub(r"", link_regex.sub(r"", clean_body))
+    clean_body = ""
+    if body:
+        with metrics.timer("parse_eml.clean_html"):
+            clean_body = get_cleaner().clean_html(body)
+        clean_body = html_regex.sub(r"", link_regex.sub(r"", clean_body))
+    if attachment_text:
+        # Attachment text is already plain, and a stray "<" in the body would swallow it if it went through the cleaner.
+        clean_body += "\n" + link_regex.sub(r"", attachment_text)
     # Remove big spaces left behind
     clean_body = re.sub(r"(\n\s*){2,}", "\n", clean_body)
     # Find the first thing that can be money and the last thing.
@@ -70,19 +148,24 @@ def parse_eml(eml_file: str) -> dict | None:
     return email
 
 
-def parse_directory(directory: str) -> list[dict]:
+def parse_directory(
+    directory: str, attachments: "AttachmentExtractor | None" = None
+) -> list[dict]:
     """Parse all of the emails in a directory and return a list of dictionaries of the emails.
     :param directory: The path of the  directory to parse.
+    :param attachments: Add the text of any pdf attachments to the bodies with this.
     """
     parsed_emails = []
     files = []
     total = 0
-    for file in os.listdir(directory):
-        if file.endswith(".eml"):
-            parsed_email = parse_eml(os.path.join(directory, file))
-            if parsed_email is not None:
-                total += len(parsed_email["Body"])
-                parsed_emails.append(parsed_email)
-                files.append(file)
+    eml_files = [file for file in os.listdir(directory) if file.endswith(".eml")]
+    parsed = parse_emls(
+        [os.path.join(directory, file) for file in eml_files], attachments
+    )
+    for file, parsed_email in zip(eml_files, parsed, strict=True):
+        if parsed_email is not None:
+            total += len(parsed_email["Body"])
+            parsed_emails.append(parsed_email)
+            files.append(file)
 
     return parsed_emails, files
@@ -0,0 +1,281 @@
+import hashlib
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from receiptaggregator.models import ParsedReceipt
+from receiptaggregator.string_similarity import jaro_distance
+
+
+class ResponseRecorder:
+    """Record model responses to a JSONL file and replay them, so evaluations can be rerun offline.
+
+    Responses are keyed by model and prompt. A key that has not been recorded is sent to the live client if there is
+    one, otherwise a KeyError is raised.
+    """
+
+    def __init__(self, recording_path: str) -> None:
+        """Initialize the ResponseRecorder.
+        :param recording_path: The JSONL file to read recorded responses from and append new ones to.
+        """
+        self._path = recording_path
+        self._responses: dict[str, dict] = {}
+        if os.path.exists(recording_path):
+            with open(recording_path) as f:
+                for line in f:
+                    record = json.loads(line)
+                    self._responses[record["key"]] = record
+        self.last: dict | None = None
+
+    @staticmethod
+    def key(model: str, prompt: str) -> str:
+        """Build the key a response is recorded under.
+        :param model: The model the prompt was sent to.
+        :param prompt: The prompt that was sent.
+        """
+        return hashlib.sha256(f"{model}\0{prompt}".encode()).hexdigest()
+
+    def get(self, key: str) -> dict | None:
+        """Get a recorded response and remember it as the last one used.
+        :param key: The key of the response.
+        """
+        self.last = self._responses.get(key)
+        return self.last
+
+    def record(
+        self,
+        key: str,
+        text: str,
+        latency: float,
+        input_tokens: int | None,
+        output_tokens: int | None,
+    ) -> dict:
+        """Record a response.
+        :param key: The key of the response.
+        :param text: The text the model responded with.
+        :param latency: How long the model took to respond, in seconds.
+        :param input_tokens: How many tokens were in the prompt.
+        :param output_tokens: How many tokens the model generated.
+        """
+        record = {
+            "key": key,
+            "text": text,
+            "latency": latency,
+            "input_tokens": input_tokens or 0,
+            "output_tokens": output_tokens or 0,
+        }
+        self._responses[key] = record
+        with open(self._path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.last = record
+        return record
+
+
+class RecordedOllamaClient:
+    """A stand in for ollama.Client that replays recorded chat responses."""
+
+    def __init__(
+        self, recorder: ResponseRecorder, client: object | None = None
+    ) -> None:
+        """Initialize the RecordedOllamaClient.
+        :param recorder: Where responses are recorded.
+        :param client: A live ollama client to use for anything that has not been recorded.
+        """
+        self.recorder = recorder
+        self._client = client
+
+    def chat(self, model: str, messages: list[dict], **kwargs: object) -> dict:
+        """Replay a recorded chat response, or record one from the live client.
+        :param model: The model to use.
+        :param messages: The messages to send.
+        """
+        key = self.recorder.key(model, messages[-1]["content"])
+        record = self.recorder.get(key)
+        if record is None:
+            if self._client is None:
+                raise KeyError(f"No recorded response for {model}")
+            start = time.perf_counter()
+            response = self._client.chat(model=model, messages=messages, **kwargs)
+            record = self.recorder.record(
+                key,
+                response["message"]["content"],
+                time.perf_counter() - start,
+                response.get("prompt_eval_count"),
+                response.get("eval_count"),
+            )
+        return {"message": {"content": record["text"]}}
+
+
+class RecordedGeminiClient:
+    """A stand in for google.genai.Client that replays recorded generate_content responses."""
+
+    def __init__(
+        self, recorder: ResponseRecorder, client: object | None = None
+    ) -> None:
+        """Initialize the RecordedGeminiClient.
+        :param recorder: Where responses are recorded.
+        :param client: A live gemini client to use for anything that has not been recorded.
+        """
+        self.recorder = recorder
+        self._client = client
+        self.models = self
+
+    def generate_content(
+        self, model: str, contents: list, **kwargs: object
+    ) -> SimpleNamespace:
+        """Replay a recorded response, or record one from the live client.
+        :param model: The model to use.
+        :param contents: The contents to send.
+        """
+        key = self.recorder.key(model, contents[-1].text)
+        record = self.recorder.get(key)
+        if record is None:
+            if self._client is None:
+                raise KeyError(f"No recorded response for {model}")
+            start = time.perf_counter()
+            response = self._client.models.generate_content(
+                model=model, contents=contents, **kwargs
+            )
+            usage = response.usage_metadata
+            record = self.recorder.record(
+                key,
+                response.text,
+                time.perf_counter() - start,
+                usage.prompt_token_count if usage else None,
+                usage.candidates_token_count if usage else None,
+            )
+        return SimpleNamespace(text=record["text"])
+
+
+def load_labeled_set(path: str) -> list[tuple[dict, ParsedReceipt]]:
+    """Load a labeled set of receipts.
+    Every line of the file is a JSON object with the parsed `email` and the `expected` ParsedReceipt.
+    :param path: The path to the JSONL file.
+    """
+    labeled = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                labeled.append(
+                    (record["email"], ParsedReceipt.model_validate(record["expected"]))
+                )
+    return labeled
+
+
+def score_receipt(expected: ParsedReceipt, actual: ParsedReceipt | None) -> dict:
+    """Score each field of an extracted receipt against what was expected, from 0 to 1.
+    :param expected: The correct receipt.
+    :param actual: The extracted receipt, or None if extraction failed.
+    """
+    if actual is None:
+        return dict.fromkeys(
+            ("merchant", "total_cost", "total_billed", "payment_method", "items"), 0.0
+        )
+    return {
+        "merchant": float(
+            jaro_distance(expected.merchant.lower(), actual.merchant.lower()) >= 0.85
+        ),
+        "total_cost": float(abs(expected.total_cost - actual.total_cost) < 0.005),
+        "total_billed": float(abs(expected.total_billed - actual.total_billed) < 0.005),
+        "payment_method": float(expected.payment_method == actual.payment_method),
+        "items": _items_f1(expected, actual),
+    }
+
+
+def _items_f1(expected: ParsedReceipt, actual: ParsedReceipt) -> float:
+    if not expected.items and not actual.items:
+        return 1.0
+    unmatched = list(actual.items)
+    hits = 0
+    for item in expected.items:
+        for candidate in unmatched:
+            if (
+                abs(item.item_cost - candidate.item_cost) < 0.005
+                and jaro_distance(item.item_name.lower(), candidate.item_name.lower())
+                >= 0.85
+            ):
+                unmatched.remove(candidate)
+                hits += 1
+                break
+    if hits == 0:
+        return 0.0
+    precision = hits / len(actual.items)
+    recall = hits / len(expected.items)
+    return 2 * precision * recall / (precision + recall)
+
+
+def evaluate_extractor(
+    name: str,
+    extractor: object,
+    recorder: ResponseRecorder,
+    labeled: list[tuple[dict, ParsedReceipt]],
+    price_per_million: tuple[float, float] = (0.0, 0.0),
+) -> dict:
+    """Run an extractor over a labeled set and summarize its accuracy, latency and cost.
+    :param name: The name to report the extractor under.
+    :param extractor: An OllamaReceiptExtractor or GeminiReceiptExtractor built on a recorded client.
+    :param recorder: The recorder behind the extractor's client, used for latencies and token counts.
+    :param labeled: The labeled receipts.
+    :param price_per_million: The price in dollars per million input and output tokens.
+    """
+    field_scores = []
+    latencies = []
+    input_tokens = 0
+    output_tokens = 0
+    failures = 0
+    for email, expected in labeled:
+        recorder.last = None
+        try:
+            actual = extractor.extract_data(email)
+        except Exception:
+            actual = None
+            failures += 1
+        field_scores.append(score_receipt(expected, actual))
+        if recorder.last is not None:
+            latencies.append(recorder.last["latency"])
+            input_tokens += recorder.last["input_tokens"]
+            output_tokens += recorder.last["output_tokens"]
+    latency = np.array(latencies or [0.0])
+    report = {
+        "model": name,
+        "receipts": len(labeled),
+        "failures": failures,
+    }
+    for field in ("merchant", "total_cost", "total_billed", "payment_method", "items"):
+        report[field] = float(np.mean([scores[field] for scores in field_scores]))
+    report["p50_s"], report["p90_s"], report["p99_s"] = (
+        float(value) for value in np.percentile(latency, [50, 90, 99])
+    )
+    report["tokens_per_s"] = output_tokens / latency.sum() if latency.sum() else 0.0
+    report["cost_usd"] = (
+        input_tokens * price_per_million[0] + output_tokens * price_per_million[1]
+    ) / 1_000_000
+    return report
+
+
+def comparison_table(reports: list[dict]) -> str:
+    """Format evaluation reports as a markdown table, cheapest first.
+    :param reports: Reports from evaluate_extractor.
+    """
+    reports = sorted(reports, key=lambda report: (report["cost_usd"], report["p50_s"]))
+    columns = list(reports[0]) if reports else []
+    lines = [
+        "| " + " | ".join(columns) + " |",
+        "|" + "---|" * len(columns),
+    ]
+    for report in reports:
+        lines.append(
+            "| "
+            + " | ".join(
+                f"{report[column]:.3f}"
+                if isinstance(report[column], float)
+                else str(report[column])
+                for column in columns
+            )
+            + " |"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,228 @@
+import os
+import uuid
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+
+import polars as pl
+
+from receiptaggregator.models import MatchResult, ParsedReceipt, ReceiptBatch
+from receiptaggregator.state_store import PipelineStateStore
+
+_DATE = pl.Datetime("us", "UTC")
+SCHEMAS = {
+    "receipts": {
+        "email_id": pl.String,
+        "run_id": pl.String,
+        "date": _DATE,
+        "subject": pl.String,
+        "sender": pl.String,
+        "merchant": pl.String,
+        "total_cost": pl.Float64,
+        "total_billed": pl.Float64,
+        "payment_method": pl.String,
+        "item_count": pl.Int64,
+    },
+    "items": {
+        "email_id": pl.String,
+        "run_id": pl.String,
+        "date": _DATE,
+        "merchant": pl.String,
+        "position": pl.Int64,
+        "item_name": pl.String,
+        "item_description": pl.String,
+        "item_cost": pl.Float64,
+        "item_quantity": pl.Int64,
+        "amount": pl.Float64,
+    },
+    "matches": {
+        "email_id": pl.String,
+        "run_id": pl.String,
+        "date": _DATE,
+        "transaction_id": pl.String,
+        "score": pl.Float64,
+        "candidates": pl.Int64,
+        "tier": pl.Int64,
+    },
+}
+# The columns that identify a row, so compaction can keep only the latest version of each.
+KEYS = {
+    "receipts": ["email_id"],
+    "items": ["email_id", "position"],
+    "matches": ["email_id"],
+}
+
+
+class ReceiptExporter:
+    """Export receipts, their items and their matches as parquet datasets for analytics.
+
+    Each dataset is partitioned by the year of the email (`receipts/year=2024/...`) and every export adds a new file
+    per year, so nothing already written is rewritten. The state store keeps track of what has been exported: a
+    receipt is exported once it is extracted, and its match outcome whenever it changes, matched or not, so a run only
+    writes what is new. The matches dataset therefore holds one row per outcome and the latest run_id for an email is
+    its current match. `compact` folds each year into a single file holding only those latest rows.
+    """
+
+    def __init__(self, root: str) -> None:
+        """Initialize the ReceiptExporter.
+        :param root: The directory the datasets are kept in.
+        """
+        self.root = root
+
+    def export(
+        self, state: PipelineStateStore, run_id: str | None = None
+    ) -> dict[str, int]:
+        """Export everything in the state store that has not been exported yet.
+        Returns how many rows were added to each dataset.
+        :param state: The state store to export from.
+        :param run_id: A name for this export, stored with every row and used for the file names. A timestamp by
+            default, so files sort in the order they were written.
+        """
+        run_id = run_id or f"{datetime.now(UTC):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        pending = state.to_export()
+        new_receipts = [row for row in pending if row[2] is not None]
+        new_matches = [row for row in pending if row[3] is not None]
+        new_receipts, receipts = _valid(
+            state,
+            new_receipts,
+            ParsedReceipt.validate_many([row[2] for row in new_receipts]),
+            "receipt",
+        )
+        new_matches, matches = _valid(
+            state,
+            new_matches,
+            MatchResult.validate_many([row[3] for row in new_matches]),
+            "match",
+        )
+        batch = ReceiptBatch.from_receipts(receipts)
+
+        receipt_dates = [_date(row[1]["Date"]) for row in new_receipts]
+        item_counts = [
+            end - start
+            for start, end in zip(batch.item_offsets, batch.item_offsets[1:])
+        ]
+        frames = {
+            "receipts": {
+                "email_id": [row[0] for row in new_receipts],
+                "run_id": [run_id] * len(batch),
+                "date": receipt_dates,
+                "subject": [row[1]["Subject"] for row in new_receipts],
+                "sender": [row[1]["From"] for row in new_receipts],
+                "merchant": batch.merchants,
+                "total_cost": batch.total_costs,
+                "total_billed": batch.total_billed,
+                "payment_method": batch.payment_methods,
+                "item_count": item_counts,
+            },
+            "items": {
+                "email_id": _repeat([row[0] for row in new_receipts], item_counts),
+                "run_id": [run_id] * len(batch.item_names),
+                "date": _repeat(receipt_dates, item_counts),
+                "merchant": _repeat(batch.merchants, item_counts),
+                "position": [i for count in item_counts for i in range(count)],
+                "item_name": batch.item_names,
+                "item_description": batch.item_descriptions,
+                "item_cost": batch.item_costs,
+                "item_quantity": batch.item_quantities,
+                "amount": [
+                    round(cost * quantity, 2)
+                    for cost, quantity in zip(batch.item_costs, batch.item_quantities)
+                ],
+            },
+            "matches": {
+                "email_id": [row[0] for row in new_matches],
+                "run_id": [run_id] * len(matches),
+                "date": [_date(row[1]["Date"]) for row in new_matches],
+                "transaction_id": [match.transaction_id for match in matches],
+                "score": [match.score for match in matches],
+                "candidates": [match.candidates for match in matches],
+                "tier": [match.tier for match in matches],
+            },
+        }
+        written = {}
+        for dataset, columns in frames.items():
+            frame = pl.DataFrame(columns, schema=SCHEMAS[dataset])
+            self._write(dataset, frame, run_id)
+            written[dataset] = frame.height
+        # The files are all in place before anything is marked exported, so an interrupted export is redone in full.
+        # Rows that no longer validate are marked exported too, they were recorded as failures rather than written.
+        state.record_exported([(row[0], row[4]) for row in pending])
+        return written
+
+    def _write(self, dataset: str, frame: pl.DataFrame, run_id: str) -> None:
+        # Emails with a date that cannot be parsed go in year=0 rather than being dropped.
+        frame = frame.with_columns(year=pl.col("date").dt.year().fill_null(0))
+        for (year,), part in frame.partition_by("year", as_dict=True).items():
+            directory = os.path.join(self.root, dataset, f"year={year}")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{run_id}.parquet")
+            part.drop("year").write_parquet(path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+    def compact(self) -> dict[str, int]:
+        """Rewrite each year of each dataset as a single file, keeping only the latest row for every email.
+        Returns how many rows are left in each dataset. Run it when no export is running.
+        """
+        remaining = {}
+        for dataset, keys in KEYS.items():
+            remaining[dataset] = 0
+            directory = os.path.join(self.root, dataset)
+            if not os.path.isdir(directory):
+                continue
+            for year in sorted(os.listdir(directory)):
+                paths = sorted(
+                    os.path.join(directory, year, file)
+                    for file in os.listdir(os.path.join(directory, year))
+                    if file.endswith(".parquet")
+                )
+                if not paths:
+                    continue
+                # Run ids sort in the order they were written, so the last row for an email is its latest.
+                frame = (
+                    pl.concat([pl.read_parquet(path) for path in paths])
+                    .sort("run_id", maintain_order=True)
+                    .unique(subset=keys, keep="last", maintain_order=True)
+                )
+                remaining[dataset] += frame.height
+                if len(paths) == 1:
+                    continue
+                # The newest file's name is reused, so the files written after this still sort after it.
+                frame.write_parquet(paths[-1] + ".tmp")
+                os.replace(paths[-1] + ".tmp", paths[-1])
+                for path in paths[:-1]:
+                    os.remove(path)
+        return remaining
+
+    def scan(self, dataset: str) -> pl.LazyFrame:
+        """Scan a dataset across every year and run, with year as a column.
+        :param dataset: One of receipts, items or matches.
+        """
+        return pl.scan_parquet(
+            os.path.join(self.root, dataset, "**", "*.parquet"),
+            hive_partitioning=True,
+            schema=SCHEMAS[dataset],
+        )
+
+
+def _valid(
+    state: PipelineStateStore, rows: list[tuple], validated: list, kind: str
+) -> tuple[list[tuple], list]:
+    # Leave out the rows whose stored json no longer validates, keeping the rest aligned with their values.
+    kept_rows, kept = [], []
+    for row, value in zip(rows, validated, strict=True):
+        if value is None:
+            state.record_failure(row[0], f"Stored {kind} is no longer valid")
+            continue
+        kept_rows.append(row)
+        kept.append(value)
+    return kept_rows, kept
+
+
+def _date(date: str | None) -> datetime | None:
+    try:
+        return parsedate_to_datetime(date).astimezone(UTC)
+    except (TypeError, ValueError):
+        return None
+
+
+def _repeat(values: list, counts: list[int]) -> list:
+    return [value for value, count in zip(values, counts) for _ in range(count)]
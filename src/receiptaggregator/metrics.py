@@ -0,0 +1,213 @@
+import cProfile
+import functools
+import inspect
+import json
+import os
+import re
+import time
+from collections.abc import Callable, Iterator
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+
+# Upper bounds in seconds, wide enough to cover a regex pass through to a slow LLM call.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+_prometheus_name_regex = re.compile(r"[^a-zA-Z0-9_]")
+
+
+class Histogram:
+    """A latency histogram with fixed buckets."""
+
+    __slots__ = ("buckets", "counts", "count", "total", "min", "max")
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        """Initialize the Histogram.
+        :param buckets: The upper bound of every bucket, in seconds.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        """Record a single observation.
+        :param value: The observed value.
+        """
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> dict:
+        """Represent the Histogram as a dict."""
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+            "buckets": dict(
+                zip([*map(str, self.buckets), "+Inf"], self.counts, strict=True)
+            ),
+        }
+
+
+class Metrics:
+    """Timers and counters for every stage of the pipeline.
+
+    When disabled, timers hand back a shared no-op context and decorated functions are called straight through,
+    so the instrumentation can stay wired in permanently.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        """Initialize the Metrics.
+        :param enabled: If anything should be recorded.
+        """
+        self.enabled = enabled
+        self._histograms: dict[str, Histogram] = {}
+        self._counters: dict[str, float] = {}
+
+    def reset(self) -> None:
+        """Forget everything that has been recorded."""
+        self._histograms.clear()
+        self._counters.clear()
+
+    def increment(self, name: str, value: float = 1) -> None:
+        """Increment a counter.
+        :param name: The name of the counter.
+        :param value: How much to increment it by.
+        """
+        if self.enabled:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Record a duration.
+        :param name: The name of the timer.
+        :param seconds: The duration in seconds.
+        """
+        if self.enabled:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name: str) -> AbstractContextManager[None]:
+        """Time a block of code.
+        :param name: The name of the timer.
+        """
+        if not self.enabled:
+            return _null_timer
+        return self._timer(name)
+
+    @contextmanager
+    def _timer(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: str) -> Callable[[Callable], Callable]:
+        """Time every call to a function, works for both regular and async functions.
+        :param name: The name of the timer.
+        """
+
+        def decorator(func: Callable) -> Callable:
+            if inspect.iscoroutinefunction(func):
+
+                @functools.wraps(func)
+                async def async_wrapper(*args: object, **kwargs: object) -> object:
+                    if not self.enabled:
+                        return await func(*args, **kwargs)
+                    start = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self.observe(name, time.perf_counter() - start)
+
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args: object, **kwargs: object) -> object:
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start)
+
+            return wrapper
+
+        return decorator
+
+    @contextmanager
+    def profile(self, output_path: str) -> Iterator[None]:
+        """Run a block of code under cProfile and dump the stats, they can be viewed with snakeviz or pstats.
+        For a sampling profile of a whole run without touching the code, use `py-spy record -o profile.svg -- python testing.py`.
+        :param output_path: Where to write the profile.
+        """
+        if not self.enabled:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output_path)
+
+    def to_dict(self) -> dict:
+        """Represent everything that has been recorded as a dict."""
+        return {
+            "counters": dict(self._counters),
+            "timers": {
+                name: histogram.to_dict()
+                for name, histogram in self._histograms.items()
+            },
+        }
+
+    def to_json(self) -> str:
+        """Export everything that has been recorded as JSON."""
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix: str = "receiptaggregator") -> str:
+        """Export everything that has been recorded in the Prometheus text format.
+        :param prefix: The prefix to put on every metric name.
+        """
+        lines = []
+        for name, value in self._counters.items():
+            metric = _prometheus_name(prefix, name) + "_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        for name, histogram in self._histograms.items():
+            metric = _prometheus_name(prefix, name) + "_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(
+                [*map(str, histogram.buckets), "+Inf"], histogram.counts, strict=True
+            ):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [
+                f"{metric}_sum {histogram.total}",
+                f"{metric}_count {histogram.count}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+def _prometheus_name(prefix: str, name: str) -> str:
+    return _prometheus_name_regex.sub("_", f"{prefix}_{name}")
+
+
+_null_timer = nullcontext()
+
+# The instance the pipeline reports to, set RECEIPTAGGREGATOR_METRICS=1 to turn it on from the start.
+metrics = Metrics(enabled=os.getenv("RECEIPTAGGREGATOR_METRICS", "") not in {"", "0"})
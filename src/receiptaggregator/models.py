@@ -1,7 +1,67 @@
-from pydantic import BaseModel, Field
+import functools
+from array import array
+from collections.abc import Iterator
+from typing import Self
 
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 
-class ReceiptItem(BaseModel):
+
+def to_cents(amount: float) -> int:
+    """Convert a dollar amount to integer cents, so amounts can be compared exactly.
+    :param amount: The amount in dollars.
+    """
+    return round(amount * 100)
+
+
+class CachedModel(BaseModel):
+    """A model that builds its json schema and validators once instead of on every call."""
+
+    @classmethod
+    @functools.cache
+    def cached_json_schema(cls) -> dict:
+        """Get the json schema of the model, it is only generated the first time. Do not modify it."""
+        return cls.model_json_schema()
+
+    @classmethod
+    @functools.cache
+    def type_adapter(cls) -> TypeAdapter:
+        """Get a TypeAdapter for a list of the model, it is only built the first time."""
+        return TypeAdapter(list[cls])
+
+    @classmethod
+    def validate_many(cls, responses: list[str | bytes]) -> list[Self | None]:
+        """Validate a batch of json responses in a single pass.
+        If any response is invalid, or the batch does not split back into one receipt per response, it is validated one
+        by one instead and the invalid ones come back as None.
+        :param responses: The json responses to validate.
+        """
+        if not responses:
+            return []
+        joined = (
+            b"["
+            + b",".join(
+                response.encode() if isinstance(response, str) else response
+                for response in responses
+            )
+            + b"]"
+        )
+        try:
+            validated = cls.type_adapter().validate_json(joined)
+        except ValidationError:
+            validated = []
+        # A response that is not a single json value (empty, or several values) shifts everything after it.
+        if len(validated) == len(responses):
+            return validated
+        validated = []
+        for response in responses:
+            try:
+                validated.append(cls.model_validate_json(response))
+            except ValidationError:
+                validated.append(None)
+        return validated
+
+
+class ReceiptItem(CachedModel):
     """An item purchased in a receipt."""
 
     item_name: str = Field(description="The name of the item purchased.")
@@ -13,12 +73,17 @@ class ReceiptItem(BaseModel):
         description="The quantity of the item purchased.", default=1
     )
 
+    @property
+    def item_cost_cents(self) -> int:
+        """The cost of the item in cents."""
+        return to_cents(self.item_cost)
+
     def to_str(self) -> str:
         """Represent a str of the ReceiptItem."""
         return f"{self.item_quantity}x {self.item_name} - ${self.item_cost} "
 
 
-class ParsedReceipt(BaseModel):
+class ParsedReceipt(CachedModel):
     """Extracted data from a receipt."""
 
     merchant: str = Field(description="The merchant name of the receipt.")
@@ -36,10 +101,140 @@ class ParsedReceipt(BaseModel):
         description="A list of items purchased in the receipt."
     )
 
+    @property
+    def total_cost_cents(self) -> int:
+        """The total cost of the receipt in cents."""
+        return to_cents(self.total_cost)
+
+    @property
+    def total_billed_cents(self) -> int:
+        """The total billed amount of the receipt in cents."""
+        return to_cents(self.total_billed)
+
     def to_str(self) -> str:
         """Represent a str of the ParsedReceipt."""
-        res = f"Total Cost: {self.total_cost} - Total Billed: {self.total_billed} \n"
-        for item in self.items:
-            # TODO: Could be fancy here and handle things like discounts
-            res += item.to_str() + "\n"
-        return res
+        # TODO: Could be fancy here and handle things like discounts
+        return "".join(
+            [
+                f"Total Cost: {self.total_cost} - Total Billed: {self.total_billed} \n",
+                *(item.to_str() + "\n" for item in self.items),
+            ]
+        )
+
+
+class MatchResult(CachedModel):
+    """The outcome of matching a receipt to a transaction."""
+
+    transaction_id: str | None = Field(
+        description="The id of the transaction the receipt was matched to, if any.",
+        default=None,
+    )
+    score: float | None = Field(
+        description="The merchant similarity of the chosen transaction.", default=None
+    )
+    candidates: int = Field(
+        description="How many transactions were considered for the receipt.",
+        default=0,
+    )
+    tier: int | None = Field(
+        description="Which search tier found the match, 0 is the normal date window and later tiers are wider.",
+        default=None,
+    )
+
+
+class ReceiptBatch:
+    """A compact, column oriented store for a large number of parsed receipts.
+
+    Each ParsedReceipt is a pydantic object with a dict per item, which adds up when holding tens of thousands of them
+    for matching or export. Here every field is a flat array or list and items are stored back to back with offsets,
+    converting to and from ParsedReceipt without losing anything.
+    """
+
+    __slots__ = (
+        "merchants",
+        "total_costs",
+        "total_billed",
+        "payment_methods",
+        "item_offsets",
+        "item_names",
+        "item_costs",
+        "item_descriptions",
+        "item_quantities",
+    )
+
+    def __init__(self) -> None:
+        """Initialize an empty ReceiptBatch."""
+        self.merchants: list[str] = []
+        self.total_costs = array("d")
+        self.total_billed = array("d")
+        self.payment_methods: list[str | None] = []
+        # Receipt i's items are at item_offsets[i]:item_offsets[i + 1].
+        self.item_offsets = array("q", [0])
+        self.item_names: list[str] = []
+        self.item_costs = array("d")
+        self.item_descriptions: list[str | None] = []
+        self.item_quantities = array("q")
+
+    @classmethod
+    def from_receipts(cls, receipts: list[ParsedReceipt]) -> "ReceiptBatch":
+        """Build a ReceiptBatch from parsed receipts.
+        :param receipts: The receipts to store.
+        """
+        batch = cls()
+        for receipt in receipts:
+            batch.append(receipt)
+        return batch
+
+    def append(self, receipt: ParsedReceipt) -> None:
+        """Add a receipt to the end of the batch.
+        :param receipt: The receipt to add.
+        """
+        self.merchants.append(receipt.merchant)
+        self.total_costs.append(receipt.total_cost)
+        self.total_billed.append(receipt.total_billed)
+        self.payment_methods.append(receipt.payment_method)
+        for item in receipt.items:
+            self.item_names.append(item.item_name)
+            self.item_costs.append(item.item_cost)
+            self.item_descriptions.append(item.item_description)
+            self.item_quantities.append(item.item_quantity)
+        self.item_offsets.append(len(self.item_names))
+
+    def __len__(self) -> int:
+        """Get the number of receipts in the batch."""
+        return len(self.merchants)
+
+    def __getitem__(self, i: int) -> ParsedReceipt:
+        """Rebuild a single receipt.
+        :param i: The position of the receipt.
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("ReceiptBatch index out of range")
+        start, end = self.item_offsets[i], self.item_offsets[i + 1]
+        # The values were validated on the way in, so skip validating them again.
+        return ParsedReceipt.model_construct(
+            merchant=self.merchants[i],
+            total_cost=self.total_costs[i],
+            total_billed=self.total_billed[i],
+            payment_method=self.payment_methods[i],
+            items=[
+                ReceiptItem.model_construct(
+                    item_name=self.item_names[j],
+                    item_cost=self.item_costs[j],
+                    item_description=self.item_descriptions[j],
+                    item_quantity=self.item_quantities[j],
+                )
+                for j in range(start, end)
+            ],
+        )
+
+    def __iter__(self) -> Iterator[ParsedReceipt]:
+        """Rebuild every receipt in order."""
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_receipts(self) -> list[ParsedReceipt]:
+        """Rebuild every receipt."""
+        return list(self)
@@ -0,0 +1,171 @@
+from typing import Any
+
+from gql import gql
+from monarchmoney import MonarchMoney
+from monarchmoney.monarchmoney import DEFAULT_RECORD_LIMIT
+
+
+class OverLoadedMonarchApi(MonarchMoney):
+    async def get_transactions(
+        self,
+        limit: int = DEFAULT_RECORD_LIMIT,
+        offset: int | None = 0,
+        start_date: str | None = None,
+        end_date: str | None = None,
+        search: str = "",
+        category_ids: list[str] = [],
+        account_ids: list[str] = [],
+        tag_ids: list[str] = [],
+        has_attachments: bool | None = None,
+        has_notes: bool | None = None,
+        hidden_from_reports: bool | None = None,
+        is_split: bool | None = None,
+        is_recurring: bool | None = None,
+        imported_from_mint: bool | None = None,
+        synced_from_institution: bool | None = None,
+        amount_cents: int | None = None,
+        tolerance_cents: int = 0,
+    ) -> dict[str, Any]:
+        """Gets transaction data from the account.
+
+        :param limit: the maximum number of transactions to download, defaults to DEFAULT_RECORD_LIMIT.
+        :param offset: the number of transactions to skip (offset) before retrieving results.
+        :param start_date: the earliest date to get transactions from, in "yyyy-mm-dd" format.
+        :param end_date: the latest date to get transactions from, in "yyyy-mm-dd" format.
+        :param search: a string to filter transactions. use empty string for all results.
+        :param category_ids: a list of category ids to filter.
+        :param account_ids: a list of account ids to filter.
+        :param tag_ids: a list of tag ids to filter.
+        :param has_attachments: a bool to filter for whether the transactions have attachments.
+        :param has_notes: a bool to filter for whether the transactions have notes.
+        :param hidden_from_reports: a bool to filter for whether the transactions are hidden from reports.
+        :param is_split: a bool to filter for whether the transactions are split.
+        :param is_recurring: a bool to filter for whether the transactions are recurring.
+        :param imported_from_mint: a bool to filter for whether the transactions were imported from mint.
+        :param synced_from_institution: a bool to filter for whether the transactions were synced from an institution.
+        :param amount_cents: the absolute amount of the transactions to get, in cents.
+        :param tolerance_cents: how many cents the absolute amount may be off by.
+        """
+        query = gql(
+            """
+          query GetTransactionsList($offset: Int, $limit: Int, $filters: TransactionFilterInput, $orderBy: TransactionOrdering) {
+            allTransactions(filters: $filters) {
+              totalCount
+              results(offset: $offset, limit: $limit, orderBy: $orderBy) {
+                id
+                ...TransactionOverviewFields
+                __typename
+              }
+              __typename
+            }
+            transactionRules {
+              id
+              __typename
+            }
+          }
+
+          fragment TransactionOverviewFields on Transaction {
+            id
+            amount
+            pending
+            date
+            hideFromReports
+            plaidName
+            notes
+            isRecurring
+            reviewStatus
+            needsReview
+            attachments {
+              id
+              extension
+              filename
+              originalAssetUrl
+              publicId
+              sizeBytes
+              __typename
+            }
+            isSplitTransaction
+            createdAt
+            updatedAt
+            category {
+              id
+              name
+              __typename
+            }
+            merchant {
+              name
+              id
+              transactionsCount
+              __typename
+            }
+            account {
+              id
+              displayName
+              __typename
+            }
+            tags {
+              id
+              name
+              color
+              order
+              __typename
+            }
+            __typename
+          }
+        """
+        )
+
+        variables = {
+            "offset": offset,
+            "limit": limit,
+            "orderBy": "date",
+            "filters": {
+                "search": search,
+                "categories": category_ids,
+                "accounts": account_ids,
+                "tags": tag_ids,
+            },
+        }
+
+        # If bool filters are not defined (i.e. None), then it should not apply the filter
+        if has_attachments is not None:
+            variables["filters"]["hasAttachments"] = has_attachments
+
+        if has_notes is not None:
+            variables["filters"]["hasNotes"] = has_notes
+
+        if hidden_from_reports is not None:
+            variables["filters"]["hideFromReports"] = hidden_from_reports
+
+        if is_recurring is not None:
+            variables["filters"]["isRecurring"] = is_recurring
+
+        if is_split is not None:
+            variables["filters"]["isSplit"] = is_split
+
+        if imported_from_mint is not None:
+            variables["filters"]["importedFromMint"] = imported_from_mint
+
+        if synced_from_institution is not None:
+            variables["filters"]["syncedFromInstitution"] = synced_from_institution
+
+        if start_date and end_date:
+            variables["filters"]["startDate"] = start_date
+            variables["filters"]["endDate"] = end_date
+
+        if amount_cents:
+            variables["filters"]["absAmountLte"] = (
+                amount_cents + tolerance_cents
+            ) / 100
+            variables["filters"]["absAmountGte"] = (
+                amount_cents - tolerance_cents
+            ) / 100
+
+        elif bool(start_date) != bool(end_date):
+            raise Exception(
+                "You must specify both a startDate and endDate, not just one of them."
+            )
+
+        return await self.gql_call(
+            operation="GetTransactionsList", graphql_query=query, variables=variables
+        )
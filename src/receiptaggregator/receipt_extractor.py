@@ -1,13 +1,31 @@
-import ollama
-from google.genai import Client, types
+import re
+import time
+from typing import TYPE_CHECKING, Protocol
 
+from receiptaggregator.metrics import metrics
 from receiptaggregator.models import ParsedReceipt
 
+if TYPE_CHECKING:
+    import ollama
+    from google.genai import Client
+
+thousands_regex = re.compile(r"(?<=\d),(?=\d{3})")
+
+
+class ReceiptExtractor(Protocol):
+    """Anything that can extract a ParsedReceipt from a parsed email."""
+
+    def extract_data(self, receipt: dict) -> ParsedReceipt:
+        """Extract the data from a receipt.
+        :param receipt: The receipt to extract data from.
+        """
+        ...
+
 
 class OllamaReceiptExtractor:
     """Extract data from receipts using an Ollama model."""
 
-    def __init__(self, ollama_client: ollama.Client, model: str) -> None:
+    def __init__(self, ollama_client: "ollama.Client", model: str) -> None:
         """Initialize the OllamaReceiptExtractor.
         :param ollama_client: The ollama client to use.
         :param model: The model to use.
@@ -15,6 +33,7 @@ class OllamaReceiptExtractor:
         self.ollama_client = ollama_client
         self._model = model
 
+    @metrics.timed("extract.ollama")
     def extract_data(self, receipt: dict) -> ParsedReceipt:
         """Extract the data from a receipt using an Ollama model.
         :param receipt: The receipt to extract data from.
@@ -83,7 +102,7 @@ Now, extract the information from the following receipt. Your output MUST be a s
                     "content": f"Please extract the information from this receipt:\n\n{receipt}",
                 },
             ],
-            format=ParsedReceipt.model_json_schema(),
+            format=ParsedReceipt.cached_json_schema(),
         )
         return ParsedReceipt.model_validate_json(response["message"]["content"])
 
@@ -91,14 +110,22 @@ Now, extract the information from the following receipt. Your output MUST be a s
 class GeminiReceiptExtractor:
     """Extract data from receipts using a Gemini model."""
 
-    def __init__(self, api_key: str, model: str) -> None:
+    def __init__(
+        self, api_key: str, model: str, client: "Client | None" = None
+    ) -> None:
         """Initialize the GeminiReceiptExtractor.
-        :param gemini_client: The gemini client to use.
+        :param api_key: The api key to create a gemini client with.
         :param model: The model to use.
+        :param client: A gemini client to use instead of creating one.
         """
-        self._client = Client(api_key=api_key)
+        if client is None:
+            from google.genai import Client
+
+            client = Client(api_key=api_key)
+        self._client = client
         self._model = model
 
+    @metrics.timed("extract.gemini")
     def extract_data(self, receipt: dict) -> ParsedReceipt:
         """Extract the data from a receipt using an Gemini model.
         :param receipt: The receipt to extract data from.
@@ -156,11 +183,13 @@ Follow these rules precisely:
 
 Now, extract the information from the following receipt. Your output MUST be a single, valid JSON object and nothing else.
     """
+        from google.genai import types
+
         response = self._client.models.generate_content(
             model=self._model,
             config=types.GenerateContentConfig(
                 system_instruction=system_prompt,
-                response_schema=ParsedReceipt.model_json_schema(),
+                response_schema=ParsedReceipt.cached_json_schema(),
             ),
             contents=[
                 types.Part.from_text(
@@ -175,3 +204,101 @@ Now, extract the information from the following receipt. Your output MUST be a s
         except Exception:
             print(response.text)
             raise
+
+
+def failed_checks(
+    parsed: ParsedReceipt, body: str, max_amount_cents: int = 1_000_000
+) -> list[str]:
+    """Run cheap self-consistency checks on an extracted receipt and return the names of the ones it fails.
+    :param parsed: The extracted receipt.
+    :param body: The body of the email it was extracted from.
+    :param max_amount_cents: The largest amount that is plausible for a single purchase.
+    """
+    failed = []
+    if parsed.items:
+        # item_cost is sometimes the line total and sometimes the unit price, so either reconciling is fine.
+        line_totals = sum(
+            item.item_cost_cents * item.item_quantity for item in parsed.items
+        )
+        unit_totals = sum(item.item_cost_cents for item in parsed.items)
+        if (
+            abs(line_totals - parsed.total_cost_cents) > 1
+            and abs(unit_totals - parsed.total_cost_cents) > 1
+        ):
+            failed.append("items")
+    body = thousands_regex.sub("", body)
+    if f"{parsed.total_billed:.2f}" not in body:
+        failed.append("total_billed")
+    if not 0 < parsed.total_billed_cents <= max_amount_cents:
+        failed.append("amount")
+    if parsed.payment_method is not None and parsed.payment_method[-4:] not in body:
+        failed.append("payment_method")
+    return failed
+
+
+class RoutingReceiptExtractor:
+    """Extract data with a fast model first, escalating to slower ones only when the result fails a check.
+
+    Every receipt goes to the first extractor. Its result is checked against the email: the items should add up to
+    total_cost, total_billed and the card should appear in the body, and the amount should be one a transaction could
+    have. Only receipts that fail a check, or whose extraction raises, go on to the next extractor.
+    """
+
+    def __init__(
+        self, extractors: list[ReceiptExtractor], max_amount_cents: int = 1_000_000
+    ) -> None:
+        """Initialize the RoutingReceiptExtractor.
+        :param extractors: The extractors to try, from the fastest to the most capable.
+        :param max_amount_cents: The largest amount that is plausible for a single purchase.
+        """
+        if not extractors:
+            raise ValueError("At least one extractor is needed")
+        self.extractors = extractors
+        self._max_amount_cents = max_amount_cents
+        self.receipts = 0
+        self.escalations = 0
+        self.total_seconds = 0.0
+
+    def extract_data(self, receipt: dict) -> ParsedReceipt:
+        """Extract the data from a receipt, escalating until the result passes every check.
+        If no extractor passes, the result from the last one that returned anything is used.
+        :param receipt: The receipt to extract data from.
+        """
+        start = time.perf_counter()
+        best = None
+        error = None
+        for level, extractor in enumerate(self.extractors):
+            if level == 1:
+                self.escalations += 1
+                metrics.increment("extract.route.escalated")
+            try:
+                parsed = extractor.extract_data(receipt)
+            except Exception as err:
+                error = err
+                metrics.increment("extract.route.failed.error")
+                continue
+            best = parsed
+            failed = failed_checks(parsed, receipt["Body"], self._max_amount_cents)
+            for check in failed:
+                metrics.increment(f"extract.route.failed.{check}")
+            if not failed:
+                metrics.increment(f"extract.route.level{level}")
+                break
+        seconds = time.perf_counter() - start
+        self.receipts += 1
+        self.total_seconds += seconds
+        metrics.increment("extract.route.receipts")
+        metrics.observe("extract.route", seconds)
+        if best is None:
+            raise error
+        return best
+
+    @property
+    def escalation_rate(self) -> float:
+        """Get the share of receipts that needed more than the first extractor."""
+        return self.escalations / self.receipts if self.receipts else 0.0
+
+    @property
+    def average_seconds(self) -> float:
+        """Get the average time taken per receipt, in seconds."""
+        return self.total_seconds / self.receipts if self.receipts else 0.0
@@ -1,252 +1,140 @@
 import os
-from datetime import datetime, timedelta
-from typing import Any
+from datetime import date, datetime, timedelta
 
 import polars as pl
-from dotenv import load_dotenv
-from gql import gql
-from monarchmoney import MonarchMoney
-from monarchmoney.monarchmoney import DEFAULT_RECORD_LIMIT
 
-from receiptaggregator.models import ParsedReceipt
-from receiptaggregator.string_similarity import jaro_distance
+from receiptaggregator.batch_matcher import (
+    DEFAULT_TIERS,
+    RECEIPT_TAGS,
+    BatchReceiptMatcher,
+)
+from receiptaggregator.metrics import metrics
+from receiptaggregator.models import MatchResult, ParsedReceipt
+from receiptaggregator.transaction_index import TransactionIndex
 
 
 class CsvReceiptMatcher:
     """A class for matching receipts to existing transactions."""
 
-    def __init__(self, transaction_csv: str) -> None:
+    def __init__(
+        self,
+        transaction_csv: str,
+        tolerance_cents: int = 0,
+        tiers: tuple[tuple[int | None, float], ...] = DEFAULT_TIERS,
+    ) -> None:
         """Initialize the ReceiptMatcher.
         :param transaction_csv: The path to the csv file containing the transactions.
+        :param tolerance_cents: How many cents a transaction's amount may differ from the receipt by.
+        :param tiers: The windows of days to search in turn and the merchant similarity each needs.
         """
         self.df = pl.read_csv(transaction_csv, try_parse_dates=True).with_row_count(
             "temp_id"
         )
+        # temp_id is the row position, and rows are never reordered, so the index can hand back positions directly.
+        self.index = TransactionIndex.from_frame(self.df)
+        self._batch = BatchReceiptMatcher(
+            self.df, self.index, tolerance_cents=tolerance_cents, tiers=tiers
+        )
 
-    def match_receipt(self, receipt: ParsedReceipt, date_str: str) -> None:
+    @metrics.timed("match.csv")
+    def match_receipt(self, receipt: ParsedReceipt, date_str: str) -> MatchResult:
         """Attempt to match a receipt to an existing transaction.
+        If several transactions are close, the one with the nearest date, amount and merchant wins.
+        If none are close, the search widens a tier at a time.
         :param receipt: The receipt to match.
         :param date_str: The date of the receipt.
         """
-        # This all definitely isn't the most efficient way to do it - but in a real system you wouldn't be working with
-        # csv anyways
-        parsed_date = datetime.strptime(date_str, "%a, %d %b %Y %H:%M:%S %z").date()
-        date_start = parsed_date - timedelta(days=5)
-        date_end = parsed_date + timedelta(days=5)
+        return self.match_receipts([(receipt, date_str)])[0]
 
-        condition = (
-            (pl.col("Date").dt.date() >= date_start)
-            & (pl.col("Date").dt.date() <= date_end)
-            & (pl.col("Amount") == -receipt.total_billed)
+    def match_receipts(
+        self, receipts: list[tuple[ParsedReceipt, str]]
+    ) -> list[MatchResult]:
+        """Match a whole run of receipts at once, so no transaction is claimed by two receipts.
+        :param receipts: The receipts and the date of the email each came from.
+        """
+        with metrics.timer("match.csv.assign"):
+            results = self._batch.assign(receipts)
+        notes = {}
+        for (receipt, _), result in zip(receipts, results, strict=True):
+            metrics.increment("match.candidates", result.candidates)
+            if result.transaction_id is None:
+                metrics.increment("match.unmatched")
+                continue
+            metrics.increment("match.matched")
+            if result.tier is not None:
+                metrics.increment(f"match.tier{result.tier}")
+            notes[int(result.transaction_id)] = receipt.to_str()
+            self._batch.mark_written(int(result.transaction_id), receipt.to_str())
+        if notes:
+            self._annotate(notes)
+        return results
+
+    def _annotate(self, notes: dict[int, str]) -> None:
+        """Tag rows and append receipt notes to them in a single pass over the frame."""
+        updates = pl.DataFrame(
+            {"temp_id": list(notes), "receipt_note": list(notes.values())},
+            schema={"temp_id": self.df.schema["temp_id"], "receipt_note": pl.String},
         )
-        potential_matches_df = self.df.filter(condition)
-        high_similarity_matches = []
-        for row in potential_matches_df.iter_rows(named=True):
-            # Including the from email here as well may help improve results.
-            score = jaro_distance(receipt.merchant.lower(), row["Merchant"].lower())
-            if score >= 0.75:
-                high_similarity_matches.append(row["temp_id"])
-        if len(high_similarity_matches) == 0:
-            return
-        if len(high_similarity_matches) == 1:
-            row_id_to_update = high_similarity_matches[0]
-            receipt_classification_str = receipt.to_str()
-            self.df = self.df.with_columns(
-                pl.when(pl.col("temp_id") == row_id_to_update)
+        self.df = (
+            self.df.join(updates, on="temp_id", how="left", maintain_order="left")
+            .with_columns(
+                pl.when(pl.col("receipt_note").is_not_null())
                 .then(pl.lit("ReceiptAggregator"))
                 .otherwise(pl.col("Tags"))
                 .alias("Tags"),
-                pl.when(pl.col("temp_id") == row_id_to_update)
-                .then(
-                    pl.when(pl.col("Notes").is_null() | (pl.col("Notes") == ""))
-                    .then(pl.lit(receipt_classification_str))
-                    .otherwise(
-                        pl.col("Notes") + pl.lit("\n" + receipt_classification_str)
-                    )
+                pl.when(pl.col("receipt_note").is_null())
+                .then(pl.col("Notes"))
+                # A rerun over a csv that was saved before the run was recorded as written must not add it twice.
+                .when(
+                    pl.col("Notes")
+                    .str.contains(pl.col("receipt_note"), literal=True)
+                    .fill_null(False)
                 )
-                .otherwise(pl.col("Notes"))
+                .then(pl.col("Notes"))
+                .when(pl.col("Notes").is_null() | (pl.col("Notes") == ""))
+                .then(pl.col("receipt_note"))
+                .otherwise(pl.col("Notes") + pl.lit("\n") + pl.col("receipt_note"))
                 .alias("Notes"),
             )
-        else:
-            print()
+            .drop("receipt_note")
+        )
 
     def update_csv(self, csv_path: str) -> None:
         """Dump the dataframe to a csv file.
         :param csv_path: The path to the csv file.
         """
-        self.df.write_csv(csv_path)
-
-
-class OverLoadedMonarchApi(MonarchMoney):
-    async def get_transactions(
-        self,
-        limit: int = DEFAULT_RECORD_LIMIT,
-        offset: int | None = 0,
-        start_date: str | None = None,
-        end_date: str | None = None,
-        search: str = "",
-        category_ids: list[str] = [],
-        account_ids: list[str] = [],
-        tag_ids: list[str] = [],
-        has_attachments: bool | None = None,
-        has_notes: bool | None = None,
-        hidden_from_reports: bool | None = None,
-        is_split: bool | None = None,
-        is_recurring: bool | None = None,
-        imported_from_mint: bool | None = None,
-        synced_from_institution: bool | None = None,
-        amount: float | None = None,
-    ) -> dict[str, Any]:
-        """Gets transaction data from the account.
-
-        :param limit: the maximum number of transactions to download, defaults to DEFAULT_RECORD_LIMIT.
-        :param offset: the number of transactions to skip (offset) before retrieving results.
-        :param start_date: the earliest date to get transactions from, in "yyyy-mm-dd" format.
-        :param end_date: the latest date to get transactions from, in "yyyy-mm-dd" format.
-        :param search: a string to filter transactions. use empty string for all results.
-        :param category_ids: a list of category ids to filter.
-        :param account_ids: a list of account ids to filter.
-        :param tag_ids: a list of tag ids to filter.
-        :param has_attachments: a bool to filter for whether the transactions have attachments.
-        :param has_notes: a bool to filter for whether the transactions have notes.
-        :param hidden_from_reports: a bool to filter for whether the transactions are hidden from reports.
-        :param is_split: a bool to filter for whether the transactions are split.
-        :param is_recurring: a bool to filter for whether the transactions are recurring.
-        :param imported_from_mint: a bool to filter for whether the transactions were imported from mint.
-        :param synced_from_institution: a bool to filter for whether the transactions were synced from an institution.
-        """
-        query = gql(
-            """
-          query GetTransactionsList($offset: Int, $limit: Int, $filters: TransactionFilterInput, $orderBy: TransactionOrdering) {
-            allTransactions(filters: $filters) {
-              totalCount
-              results(offset: $offset, limit: $limit, orderBy: $orderBy) {
-                id
-                ...TransactionOverviewFields
-                __typename
-              }
-              __typename
-            }
-            transactionRules {
-              id
-              __typename
-            }
-          }
-
-          fragment TransactionOverviewFields on Transaction {
-            id
-            amount
-            pending
-            date
-            hideFromReports
-            plaidName
-            notes
-            isRecurring
-            reviewStatus
-            needsReview
-            attachments {
-              id
-              extension
-              filename
-              originalAssetUrl
-              publicId
-              sizeBytes
-              __typename
-            }
-            isSplitTransaction
-            createdAt
-            updatedAt
-            category {
-              id
-              name
-              __typename
-            }
-            merchant {
-              name
-              id
-              transactionsCount
-              __typename
-            }
-            account {
-              id
-              displayName
-              __typename
-            }
-            tags {
-              id
-              name
-              color
-              order
-              __typename
-            }
-            __typename
-          }
-        """
-        )
-
-        variables = {
-            "offset": offset,
-            "limit": limit,
-            "orderBy": "date",
-            "filters": {
-                "search": search,
-                "categories": category_ids,
-                "accounts": account_ids,
-                "tags": tag_ids,
-            },
-        }
-
-        # If bool filters are not defined (i.e. None), then it should not apply the filter
-        if has_attachments is not None:
-            variables["filters"]["hasAttachments"] = has_attachments
-
-        if has_notes is not None:
-            variables["filters"]["hasNotes"] = has_notes
-
-        if hidden_from_reports is not None:
-            variables["filters"]["hideFromReports"] = hidden_from_reports
-
-        if is_recurring is not None:
-            variables["filters"]["isRecurring"] = is_recurring
-
-        if is_split is not None:
-            variables["filters"]["isSplit"] = is_split
-
-        if imported_from_mint is not None:
-            variables["filters"]["importedFromMint"] = imported_from_mint
-
-        if synced_from_institution is not None:
-            variables["filters"]["syncedFromInstitution"] = synced_from_institution
-
-        if start_date and end_date:
-            variables["filters"]["startDate"] = start_date
-            variables["filters"]["endDate"] = end_date
-
-        if amount:
-            variables["filters"]["absAmountLte"] = amount
-            variables["filters"]["absAmountGte"] = amount
-
-        elif bool(start_date) != bool(end_date):
-            raise Exception(
-                "You must specify both a startDate and endDate, not just one of them."
-            )
-
-        return await self.gql_call(
-            operation="GetTransactionsList", graphql_query=query, variables=variables
-        )
+        # temp_id is recreated on load, so leave it out or a rerun on this csv would clash with it.
+        self.df.drop("temp_id").write_csv(csv_path)
 
 
 class ApiReceiptMatcher:
     """A class for matching receipts to existing transactions."""
 
-    def __init__(self) -> None:
-        """Initialize the ReceiptMatcher."""
+    def __init__(
+        self,
+        tolerance_cents: int = 0,
+        tiers: tuple[tuple[int | None, float], ...] = DEFAULT_TIERS,
+        horizon_days: int = 90,
+    ) -> None:
+        """Initialize the ReceiptMatcher.
+        :param tolerance_cents: How many cents a transaction's amount may differ from the receipt by.
+        :param tiers: The windows of days to search in turn and the merchant similarity each needs.
+        :param horizon_days: How far either side of a batch of receipts to fetch transactions, bounds the last tier.
+        """
+        # monarchmoney and gql are only needed here, so they are not imported until an api matcher is created.
+        from receiptaggregator.monarch_api import OverLoadedMonarchApi
+
         self.api = OverLoadedMonarchApi()
+        self._tolerance_cents = tolerance_cents
+        self._tiers = tiers
+        self._horizon_days = horizon_days
         self._receipt_aggregator_tag = None
         self._retail_sync_tag = None
 
     async def login(self) -> None:
         """Login to Monarch's api."""
+        from dotenv import load_dotenv
+
         load_dotenv()
         email = os.getenv("MONARCH_EMAIL")
         password = os.getenv("MONARCH_PASSWORD")
@@ -268,40 +156,140 @@ class ApiReceiptMatcher:
             res = await self.api.create_transaction_tag("ReceiptAggregator", "#008080")
             self._receipt_aggregator_tag = res["createTransactionTag"]["tag"]["id"]
 
-    async def match_receipt(self, receipt: ParsedReceipt, date_str: str) -> None:
+    @metrics.timed("match.api")
+    async def match_receipt(self, receipt: ParsedReceipt, date_str: str) -> MatchResult:
         """Attempt to match a receipt to an existing transaction.
+        If several transactions are close, the one with the nearest date, amount and merchant wins.
+        If none are close, the search widens a tier at a time.
         :param receipt: The receipt to match.
         :param date_str: The date of the receipt.
         """
-        parsed_date = datetime.strptime(date_str, "%a, %d %b %Y %H:%M:%S %z").date()
-        date_start = parsed_date - timedelta(days=5)
-        date_end = parsed_date + timedelta(days=5)
+        # A single query for the amount over the horizon serves every tier, so widening costs no extra calls.
+        day = datetime.strptime(date_str, "%a, %d %b %Y %H:%M:%S %z").date()
+        transactions = await self._fetch_transactions(
+            day - timedelta(days=self._horizon_days),
+            day + timedelta(days=self._horizon_days),
+            amount_cents=receipt.total_billed_cents,
+        )
+        return (await self._assign_and_write([(receipt, date_str)], transactions))[0]
+
+    @metrics.timed("match.api.batch")
+    async def match_receipts(
+        self, receipts: list[tuple[ParsedReceipt, str]]
+    ) -> list[MatchResult]:
+        """Match a whole run of receipts at once, so no transaction is claimed by two receipts.
+        The transactions for the whole run, plus the horizon either side, are fetched up front rather than queried
+        receipt by receipt.
+        :param receipts: The receipts and the date of the email each came from.
+        """
+        if not receipts:
+            return []
+        dates = [
+            datetime.strptime(date_str, "%a, %d %b %Y %H:%M:%S %z").date()
+            for _, date_str in receipts
+        ]
+        transactions = await self._fetch_transactions(
+            min(dates) - timedelta(days=self._horizon_days),
+            max(dates) + timedelta(days=self._horizon_days),
+        )
+        return await self._assign_and_write(receipts, transactions)
 
-        transactions = await self.api.get_transactions(
-            start_date=date_start.isoformat(),
-            end_date=date_end.isoformat(),
-            amount=receipt.total_billed,
+    async def _fetch_transactions(
+        self,
+        start: date | None = None,
+        end: date | None = None,
+        amount_cents: int | None = None,
+    ) -> list[dict]:
+        """Fetch every transaction in a date range and/or with an amount, paging through the results."""
+        transactions = []
+        while True:
+            with metrics.timer("monarch.get_transactions"):
+                response = await self.api.get_transactions(
+                    offset=len(transactions),
+                    start_date=start.isoformat() if start else None,
+                    end_date=end.isoformat() if end else None,
+                    amount_cents=amount_cents,
+                    tolerance_cents=self._tolerance_cents,
+                )
+            page = response["allTransactions"]["results"]
+            transactions += page
+            if (
+                not page
+                or len(transactions) >= response["allTransactions"]["totalCount"]
+            ):
+                return transactions
+
+    async def _assign_and_write(
+        self, receipts: list[tuple[ParsedReceipt, str]], transactions: list[dict]
+    ) -> list[MatchResult]:
+        """Assign receipts to the fetched transactions and push each match to Monarch."""
+        if not transactions:
+            return [MatchResult() for _ in receipts]
+        df = pl.DataFrame(
+            {
+                "temp_id": range(len(transactions)),
+                "Date": [transaction["date"] for transaction in transactions],
+                "Amount": [transaction["amount"] for transaction in transactions],
+                "Merchant": [
+                    (transaction["merchant"] or {}).get("name", "")
+                    for transaction in transactions
+                ],
+                "Account": [
+                    (transaction["account"] or {}).get("displayName")
+                    for transaction in transactions
+                ],
+                "Tags": [
+                    ",".join(tag["name"] for tag in transaction["tags"])
+                    for transaction in transactions
+                ],
+                "Notes": [transaction["notes"] or "" for transaction in transactions],
+            }
+        ).with_columns(pl.col("Date").str.to_date())
+        batch = BatchReceiptMatcher(
+            df, tolerance_cents=self._tolerance_cents, tiers=self._tiers
         )
-        high_similarity_matches = []
-        for transaction in transactions["allTransactions"]["results"]:
-            # Including the from email here as well may help improve results.
-            score = jaro_distance(
-                receipt.merchant.lower(), transaction["merchant"]["name"].lower()
+        results = batch.assign(receipts)
+        for i, (receipt, _) in enumerate(receipts):
+            if results[i].transaction_id is None:
+                metrics.increment("match.unmatched")
+                continue
+            match = transactions[int(results[i].transaction_id)]
+            if not await self._write_match(match, receipt):
+                results[i] = MatchResult(candidates=results[i].candidates)
+                metrics.increment("match.unmatched")
+                continue
+            results[i].transaction_id = match["id"]
+            if results[i].tier is not None:
+                metrics.increment(f"match.tier{results[i].tier}")
+        return results
+
+    async def _write_match(self, match: dict, receipt: ParsedReceipt) -> bool:
+        """Tag a transaction and add the receipt to its notes, unless a receipt is already on it.
+        Returns whether the receipt is on the transaction afterwards.
+        """
+        if receipt.to_str().strip() in (match["notes"] or ""):
+            return True
+        if any(tag["name"] in RECEIPT_TAGS for tag in match["tags"]):
+            return False
+        with metrics.timer("monarch.update_transaction"):
+            await self.api.set_transaction_tags(
+                match["id"],
+                [tag["id"] for tag in match["tags"]] + [self._receipt_aggregator_tag],
             )
-            if score >= 0.75:
-                high_similarity_matches.append(transaction)
-        if len(high_similarity_matches) == 1:
-            match = high_similarity_matches[0]
-            if match["tags"]:
-                for tag in match["tags"]:
-                    if tag["name"] in {"ReceiptAggregator", "Retail Sync"}:
-                        return
-            if self._receipt_aggregator_tag not in match["tags"]:
-                await self.api.set_transaction_tags(
-                    match["id"], match["tags"] + [self._receipt_aggregator_tag]
-                )
-                await self.api.update_transaction(
-                    match["id"],
-                    notes=match["notes"] if match["notes"] else "" + receipt.to_str(),
-                )
-                print(f"Updated {receipt.merchant}")
+            await self.api.update_transaction(
+                match["id"],
+                notes=(match["notes"] + "\n" if match["notes"] else "")
+                + receipt.to_str(),
+            )
+        metrics.increment("match.matched")
+        print(f"Updated {receipt.merchant}")
+        return True
+
+
+def __getattr__(name: str) -> object:
+    # OverLoadedMonarchApi moved to monarch_api so importing this module does not pull in monarchmoney.
+    if name == "OverLoadedMonarchApi":
+        from receiptaggregator.monarch_api import OverLoadedMonarchApi
+
+        return OverLoadedMonarchApi
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,404 @@
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+
+from receiptaggregator.models import MatchResult, ParsedReceipt
+
+_ADDED_COLUMNS = {
+    "duplicate_of": "TEXT",
+    "signature": "BLOB",
+    "amounts": "TEXT",
+    "exported": "INTEGER",
+}
+
+
+class Stage(IntEnum):
+    """The furthest pipeline stage an email has completed."""
+
+    PARSED = 1
+    CLASSIFIED = 2
+    EXTRACTED = 3
+    MATCHED = 4
+    WRITTEN = 5
+
+
+class PipelineStateStore:
+    """A durable record of how far each email has made it through the pipeline.
+
+    Backed by SQLite in WAL mode so a crash or a restarted Ollama host only loses the email that was in flight.
+    Stages only ever move forward, so a rerun can pick every email up exactly where it left off.
+    """
+
+    def __init__(self, db_path: str) -> None:
+        """Initialize the PipelineStateStore.
+        :param db_path: The path to the sqlite database, it is created if it does not exist.
+        """
+        self._conn = sqlite3.connect(db_path)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS emails (
+                email_id TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                stage INTEGER NOT NULL,
+                email TEXT,
+                is_receipt INTEGER,
+                receipt TEXT,
+                match TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS emails_path ON emails (path);
+            CREATE INDEX IF NOT EXISTS emails_stage ON emails (stage);
+            """
+        )
+        # Columns added after the first release, so databases from older runs get them too.
+        columns = {
+            row["name"] for row in self._conn.execute("PRAGMA table_info(emails)")
+        }
+        for column, column_type in _ADDED_COLUMNS.items():
+            if column not in columns:
+                self._conn.execute(
+                    f"ALTER TABLE emails ADD COLUMN {column} {column_type}"
+                )
+        self._conn.commit()
+
+    def close(self) -> None:
+        """Close the underlying database connection."""
+        self._conn.close()
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        """Hash the contents of a file, this is the id an email is stored under.
+        :param path: The path to the file.
+        """
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def new_files(self, directory: str) -> list[tuple[str, str]]:
+        """Find the eml files in a directory that have never been recorded.
+        Only files whose path is unknown are hashed, so daily runs over a growing mailbox stay cheap.
+        :param directory: The directory to look in.
+        """
+        known_paths = {row[0] for row in self._conn.execute("SELECT path FROM emails")}
+        new = []
+        for file in sorted(os.listdir(directory)):
+            path = os.path.join(directory, file)
+            if not file.endswith(".eml") or path in known_paths:
+                continue
+            email_id = self.hash_file(path)
+            if self.stage(email_id) is None:
+                new.append((email_id, path))
+        return new
+
+    def has_path(self, path: str) -> bool:
+        """Check if an email has been recorded from a path.
+        :param path: The path to the file.
+        """
+        return (
+            self._conn.execute(
+                "SELECT 1 FROM emails WHERE path = ? LIMIT 1", (path,)
+            ).fetchone()
+            is not None
+        )
+
+    def stage(self, email_id: str) -> Stage | None:
+        """Get the furthest stage an email has completed.
+        :param email_id: The id of the email.
+        """
+        row = self._conn.execute(
+            "SELECT stage FROM emails WHERE email_id = ?", (email_id,)
+        ).fetchone()
+        return None if row is None else Stage(row["stage"])
+
+    def record_parsed(self, email_id: str, path: str, email: dict | None) -> None:
+        """Record a parsed email. Emails that could not be parsed are recorded as not receipts.
+        :param email_id: The id of the email.
+        :param path: The path the email was loaded from.
+        :param email: The parsed email, or None if it had no body.
+        """
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO emails (email_id, path, stage, email, is_receipt, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    email_id,
+                    path,
+                    Stage.CLASSIFIED if email is None else Stage.PARSED,
+                    None if email is None else json.dumps(email),
+                    0 if email is None else None,
+                    _now(),
+                ),
+            )
+
+    def record_deduplicated(
+        self,
+        email_id: str,
+        signature: bytes,
+        money: str,
+        duplicate_of: str | None = None,
+    ) -> None:
+        """Record the dedup signature of an email, and the email it is a copy of if it is a duplicate.
+        Duplicates go no further through the pipeline. Their date is added to the original's Dates, and the original
+        takes the earliest one, so a forwarded copy seen first still ends up with the date of the purchase.
+        :param email_id: The id of the email.
+        :param signature: The MinHash signature of its body.
+        :param money: The amounts in its body.
+        :param duplicate_of: The id of the email it is a copy of.
+        """
+        with self._conn:
+            self._conn.execute(
+                "UPDATE emails SET signature = ?, amounts = ?, duplicate_of = ?, updated_at = ? WHERE email_id = ?",
+                (signature, money, duplicate_of, _now(), email_id),
+            )
+            if duplicate_of is None:
+                return
+            rows = self._conn.execute(
+                "SELECT email_id, email FROM emails WHERE email_id IN (?, ?)",
+                (email_id, duplicate_of),
+            ).fetchall()
+            emails = {row["email_id"]: json.loads(row["email"]) for row in rows}
+            original = emails[duplicate_of]
+            dates = original.get("Dates", [original["Date"]])
+            dates = list(dict.fromkeys([*dates, emails[email_id]["Date"]]))
+            original["Dates"] = dates
+            original["Date"] = min(dates, key=_date_key)
+            self._conn.execute(
+                "UPDATE emails SET email = ? WHERE email_id = ?",
+                (json.dumps(original), duplicate_of),
+            )
+
+    def signatures(self, limit: int | None = None) -> list[tuple[str, bytes, str]]:
+        """Get the dedup signatures and amounts of the emails that are the first of their group, oldest first.
+        :param limit: Only get this many of the most recently added ones.
+        """
+        rows = self._conn.execute(
+            "SELECT email_id, signature, amounts FROM emails "
+            "WHERE signature IS NOT NULL AND duplicate_of IS NULL ORDER BY rowid DESC LIMIT ?",
+            (-1 if limit is None else limit,),
+        ).fetchall()
+        return [
+            (row["email_id"], row["signature"], row["amounts"])
+            for row in reversed(rows)
+        ]
+
+    def record_classified(self, email_id: str, is_receipt: bool) -> None:
+        """Record the classification of an email.
+        :param email_id: The id of the email.
+        :param is_receipt: If the email is a receipt.
+        """
+        self._advance(email_id, Stage.CLASSIFIED, is_receipt=int(is_receipt))
+
+    def record_extracted(self, email_id: str, receipt: ParsedReceipt) -> None:
+        """Record the data extracted from a receipt.
+        :param email_id: The id of the email.
+        :param receipt: The extracted receipt.
+        """
+        self._advance(
+            email_id, Stage.EXTRACTED, receipt=receipt.model_dump_json(), error=None
+        )
+
+    def record_failure(self, email_id: str, error: str) -> None:
+        """Record that a stage failed for an email, it will be retried on the next run.
+        :param email_id: The id of the email.
+        :param error: A description of what went wrong.
+        """
+        with self._conn:
+            self._conn.execute(
+                "UPDATE emails SET error = ?, attempts = attempts + 1, updated_at = ? WHERE email_id = ?",
+                (error, _now(), email_id),
+            )
+
+    def record_matched(self, email_id: str, match: MatchResult) -> None:
+        """Record the outcome of matching a receipt.
+        A match moves the email on to MATCHED. An unmatched result is kept too, for analytics, and leaves the email at
+        EXTRACTED to be tried again. Either way, a result that differs from the last one is exported again.
+        :param email_id: The id of the email.
+        :param match: The result of the match.
+        """
+        match_json = match.model_dump_json()
+        stage = Stage.EXTRACTED if match.transaction_id is None else Stage.MATCHED
+        with self._conn:
+            self._conn.execute(
+                "UPDATE emails SET stage = MAX(stage, ?), match = ?, exported = MIN(exported, ?), updated_at = ? "
+                "WHERE email_id = ? AND stage <= ? AND match IS NOT ?",
+                (
+                    stage,
+                    match_json,
+                    Stage.EXTRACTED,
+                    _now(),
+                    email_id,
+                    stage,
+                    match_json,
+                ),
+            )
+
+    def record_written(self, email_ids: list[str]) -> None:
+        """Record that the matches for some emails have been written out.
+        :param email_ids: The ids of the emails.
+        """
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE emails SET stage = ?, updated_at = ? WHERE email_id = ? AND stage = ?",
+                [
+                    (Stage.WRITTEN, _now(), email_id, Stage.MATCHED)
+                    for email_id in email_ids
+                ],
+            )
+
+    def emails_at(self, stage: Stage, max_attempts: int = 3) -> list[tuple[str, dict]]:
+        """Get the parsed emails that have completed a stage but not gone any further.
+        Emails classified as not receipts, or that have failed too many times, are left out.
+        :param stage: The stage the emails are at.
+        :param max_attempts: Skip emails that have failed this many times.
+        """
+        rows = self._conn.execute(
+            "SELECT email_id, email FROM emails WHERE stage = ? AND attempts < ? "
+            "AND email IS NOT NULL AND duplicate_of IS NULL AND (is_receipt IS NULL OR is_receipt = 1) "
+            "ORDER BY path",
+            (stage, max_attempts),
+        )
+        return [(row["email_id"], json.loads(row["email"])) for row in rows]
+
+    def receipt(self, email_id: str) -> ParsedReceipt | None:
+        """Get the receipt that was extracted from an email.
+        :param email_id: The id of the email.
+        """
+        row = self._conn.execute(
+            "SELECT receipt FROM emails WHERE email_id = ?", (email_id,)
+        ).fetchone()
+        if row is None or row["receipt"] is None:
+            return None
+        return ParsedReceipt.model_validate_json(row["receipt"])
+
+    def receipts(self, email_ids: list[str]) -> list[ParsedReceipt | None]:
+        """Get the receipts that were extracted from many emails, validated in one pass.
+        :param email_ids: The ids of the emails.
+        """
+        stored = {}
+        for start in range(0, len(email_ids), 500):
+            chunk = email_ids[start : start + 500]
+            stored.update(
+                self._conn.execute(
+                    "SELECT email_id, receipt FROM emails WHERE receipt IS NOT NULL"
+                    f" AND email_id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+            )
+        found = [email_id for email_id in email_ids if email_id in stored]
+        by_id = dict(
+            zip(
+                found,
+                ParsedReceipt.validate_many([stored[email_id] for email_id in found]),
+                strict=True,
+            )
+        )
+        return [by_id.get(email_id) for email_id in email_ids]
+
+    def receipts_to_match(
+        self, emails: list[tuple[str, dict]]
+    ) -> tuple[list[str], list[tuple[ParsedReceipt, str]]]:
+        """Get the receipts of some emails paired with the date of each email, ready to match.
+        A stored receipt that no longer validates is left out and recorded as a failure, so it is not retried forever.
+        Returns the ids of the emails that were kept and their receipts.
+        :param emails: The ids and parsed emails, as returned by emails_at.
+        """
+        email_ids, receipts = [], []
+        for (email_id, email), receipt in zip(
+            emails, self.receipts([email_id for email_id, _ in emails]), strict=True
+        ):
+            if receipt is None:
+                self.record_failure(email_id, "Stored receipt is no longer valid")
+                continue
+            email_ids.append(email_id)
+            receipts.append((receipt, email["Date"]))
+        return email_ids, receipts
+
+    def to_export(self) -> list[tuple[str, dict, str | None, str | None, Stage]]:
+        """Get the receipts and matches that have not been exported yet, oldest first.
+        Each comes back as the email id, the email, the receipt json, the match json and the stage it was exported up
+        to. A receipt that was exported before its match comes back with no receipt, so only its match is new.
+        """
+        rows = self._conn.execute(
+            "SELECT email_id, email, receipt, match, exported FROM emails "
+            "WHERE receipt IS NOT NULL AND duplicate_of IS NULL "
+            "AND (exported IS NULL OR (match IS NOT NULL AND exported < ?)) ORDER BY rowid",
+            (Stage.MATCHED,),
+        )
+        return [
+            (
+                row["email_id"],
+                json.loads(row["email"]),
+                row["receipt"] if row["exported"] is None else None,
+                row["match"],
+                Stage.EXTRACTED if row["match"] is None else Stage.MATCHED,
+            )
+            for row in rows
+        ]
+
+    def record_exported(self, exported: list[tuple[str, Stage]]) -> None:
+        """Record how far some emails have been exported.
+        :param exported: The ids of the emails and the stage each was exported up to.
+        """
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE emails SET exported = ? WHERE email_id = ?",
+                [(stage, email_id) for email_id, stage in exported],
+            )
+
+    def dedup_summary(self) -> dict[str, float]:
+        """Summarize how many emails were skipped as duplicates.
+        Duplicates of receipts would each have cost an extraction call.
+        """
+        row = self._conn.execute(
+            "SELECT COUNT(*) AS emails, COUNT(copy.duplicate_of) AS duplicates, "
+            "COALESCE(SUM(original.is_receipt), 0) AS llm_calls_saved "
+            "FROM emails AS copy LEFT JOIN emails AS original ON original.email_id = copy.duplicate_of "
+            "WHERE copy.email IS NOT NULL"
+        ).fetchone()
+        return {
+            "emails": row["emails"],
+            "duplicates": row["duplicates"],
+            "dedup_ratio": row["duplicates"] / row["emails"] if row["emails"] else 0.0,
+            "llm_calls_saved": row["llm_calls_saved"],
+        }
+
+    def counts(self) -> dict[str, int]:
+        """Count how many emails are at each stage."""
+        counts = {stage.name.lower(): 0 for stage in Stage}
+        for row in self._conn.execute(
+            "SELECT stage, COUNT(*) AS n FROM emails GROUP BY stage"
+        ):
+            counts[Stage(row["stage"]).name.lower()] = row["n"]
+        return counts
+
+    def _advance(self, email_id: str, stage: Stage, **columns: object) -> None:
+        assignments = "".join(f", {column} = ?" for column in columns)
+        with self._conn:
+            self._conn.execute(
+                f"UPDATE emails SET stage = ?, updated_at = ?{assignments} "
+                "WHERE email_id = ? AND stage < ?",
+                (stage, _now(), *columns.values(), email_id, stage),
+            )
+
+
+def _now() -> str:
+    return datetime.now(UTC).isoformat()
+
+
+def _date_key(date: str) -> float:
+    try:
+        return parsedate_to_datetime(date).timestamp()
+    except (TypeError, ValueError):
+        # Dates that cannot be read never win over ones that can.
+        return float("inf")
@@ -0,0 +1,116 @@
+from datetime import date
+
+import numpy as np
+import polars as pl
+
+EPOCH = date(1970, 1, 1)
+
+
+def to_day(day: date) -> int:
+    """Convert a date to a day number, the number of days since 1970-01-01.
+    :param day: The date to convert.
+    """
+    return (day - EPOCH).days
+
+
+class TransactionIndex:
+    """Transactions held as compact arrays sorted by amount then date.
+
+    Amounts are int64 cents and dates are int32 day numbers, so lookups are exact integer comparisons done with binary
+    searches instead of float equality over the whole frame.
+    """
+
+    def __init__(
+        self, amount_cents: np.ndarray, days: np.ndarray, row_ids: np.ndarray
+    ) -> None:
+        """Initialize the TransactionIndex.
+        :param amount_cents: The amount of every transaction, in cents.
+        :param days: The day number of every transaction.
+        :param row_ids: The id of every transaction's row in the source frame.
+        """
+        order = np.lexsort((days, amount_cents))
+        self.amount_cents = np.ascontiguousarray(amount_cents[order], dtype=np.int64)
+        self.days = np.ascontiguousarray(days[order], dtype=np.int32)
+        self.row_ids = np.ascontiguousarray(row_ids[order])
+
+    @classmethod
+    def from_frame(
+        cls,
+        df: pl.DataFrame,
+        amount_column: str = "Amount",
+        date_column: str = "Date",
+        id_column: str = "temp_id",
+    ) -> "TransactionIndex":
+        """Build an index over a frame of transactions, such as a Monarch csv export.
+        :param df: The frame of transactions.
+        :param amount_column: The column holding the amount in dollars.
+        :param date_column: The column holding the date of the transaction.
+        :param id_column: The column identifying each row.
+        """
+        compact = df.select(
+            (pl.col(amount_column) * 100).round().cast(pl.Int64).alias("cents"),
+            pl.col(date_column).cast(pl.Date).cast(pl.Int32).alias("day"),
+            pl.col(id_column),
+        )
+        return cls(
+            compact["cents"].to_numpy(),
+            compact["day"].to_numpy(),
+            compact[id_column].to_numpy(),
+        )
+
+    def __len__(self) -> int:
+        """Get the number of transactions in the index."""
+        return len(self.row_ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Get the memory used by the index's arrays."""
+        return self.amount_cents.nbytes + self.days.nbytes + self.row_ids.nbytes
+
+    def lookup(
+        self,
+        amount_cents: int,
+        day: int,
+        window_days: int | None,
+        tolerance_cents: int = 0,
+    ) -> np.ndarray:
+        """Find the row ids of the transactions with an amount and within a window of days.
+        :param amount_cents: The amount to look for, in cents.
+        :param day: The day number the window is centered on.
+        :param window_days: How many days either side of the day to include, None for any date.
+        :param tolerance_cents: How many cents the amount may be off by.
+        """
+        return self.row_ids[
+            self.positions(amount_cents, day, window_days, tolerance_cents)
+        ]
+
+    def positions(
+        self,
+        amount_cents: int,
+        day: int,
+        window_days: int | None,
+        tolerance_cents: int = 0,
+    ) -> np.ndarray:
+        """Find where the transactions with an amount and within a window of days sit in the index's arrays.
+        :param amount_cents: The amount to look for, in cents.
+        :param day: The day number the window is centered on.
+        :param window_days: How many days either side of the day to include, None for any date.
+        :param tolerance_cents: How many cents the amount may be off by.
+        """
+        start = np.searchsorted(
+            self.amount_cents, amount_cents - tolerance_cents, "left"
+        )
+        end = np.searchsorted(
+            self.amount_cents, amount_cents + tolerance_cents, "right"
+        )
+        if window_days is None:
+            return np.arange(start, end)
+        if tolerance_cents == 0:
+            # Every transaction in the slice has the same amount, so the days within it are sorted too.
+            days = self.days[start:end]
+            first = start + np.searchsorted(days, day - window_days, "left")
+            last = start + np.searchsorted(days, day + window_days, "right")
+            return np.arange(first, last)
+        days = self.days[start:end]
+        mask = (days >= day - window_days) & (days <= day + window_days)
+        return start + np.flatnonzero(mask)
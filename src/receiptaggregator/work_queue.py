@@ -0,0 +1,435 @@
+import json
+import sqlite3
+import time
+import uuid
+from typing import Protocol
+
+from pydantic import BaseModel
+
+
+class Lease(BaseModel):
+    """A claim on a queued item, only the holder of the token can complete or fail it."""
+
+    item_id: str
+    payload: dict
+    token: str
+    attempts: int
+
+
+class WorkQueue(Protocol):
+    """A queue of items shared between a coordinator and any number of workers."""
+
+    def put(self, items: list[tuple[str, dict]]) -> int:
+        """Add items to the queue, items already in it are left alone."""
+        ...
+
+    def lease(self, worker_id: str, count: int = 1) -> list[Lease]:
+        """Claim up to count items that are ready to be worked on."""
+        ...
+
+    def extend(self, lease: Lease) -> bool:
+        """Keep holding a lease for another lease timeout."""
+        ...
+
+    def complete(self, lease: Lease, result: dict) -> bool:
+        """Store the result of an item, only if the lease is still held."""
+        ...
+
+    def fail(self, lease: Lease, error: str) -> None:
+        """Give an item back to be retried, or give up on it after too many attempts."""
+        ...
+
+    def collect(self, count: int = 500) -> list[tuple[str, dict, dict]]:
+        """Get the id, payload and result of items that are done but not yet collected."""
+        ...
+
+    def mark_collected(self, item_ids: list[str]) -> None:
+        """Record that the results of items have been written back."""
+        ...
+
+    def requeue_failed(self) -> int:
+        """Give every item that was given up on another max_attempts."""
+        ...
+
+    def counts(self) -> dict[str, int]:
+        """Count the items in each status."""
+        ...
+
+
+class SqliteWorkQueue:
+    """A work queue in a SQLite database, which can sit on a volume every node mounts.
+
+    Leasing happens in an immediate transaction so two workers never claim the same item. A lease that is not
+    completed within lease_seconds, because its worker died or its Ollama host hung, lets the item be leased again,
+    up to max_attempts times. A result is only accepted from the current lease holder, and only once.
+    """
+
+    def __init__(
+        self, db_path: str, lease_seconds: float = 600, max_attempts: int = 3
+    ) -> None:
+        """Initialize the SqliteWorkQueue.
+        :param db_path: The path to the sqlite database, it is created if it does not exist.
+        :param lease_seconds: How long a worker has to finish an item before it can be given to another worker.
+        :param max_attempts: How many times an item is leased before it is given up on.
+        """
+        self._conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        # WAL needs shared memory between the processes using it, which a network file system can not give, so the
+        # queue uses a rollback journal.
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS queue (
+                item_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_token TEXT,
+                lease_expires REAL,
+                worker_id TEXT,
+                result TEXT,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS queue_status ON queue (status, lease_expires);
+            """
+        )
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+
+    def close(self) -> None:
+        """Close the underlying database connection."""
+        self._conn.close()
+
+    def put(self, items: list[tuple[str, dict]]) -> int:
+        """Add items to the queue, items already in it are left alone.
+        Returns how many items were added.
+        :param items: The id and payload of each item.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        before = self._conn.total_changes
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO queue (item_id, payload) VALUES (?, ?)",
+            [(item_id, json.dumps(payload)) for item_id, payload in items],
+        )
+        self._conn.execute("COMMIT")
+        return self._conn.total_changes - before
+
+    def lease(self, worker_id: str, count: int = 1) -> list[Lease]:
+        """Claim up to count items that are pending or whose lease has run out.
+        :param worker_id: The id of the worker claiming the items.
+        :param count: The most items to claim.
+        """
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Items whose last lease ran out on their final attempt are given up on.
+            self._conn.execute(
+                "UPDATE queue SET status = 'failed', lease_token = NULL, error = 'lease expired' "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self._max_attempts),
+            )
+            rows = self._conn.execute(
+                "SELECT item_id, payload, attempts FROM queue "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY attempts, item_id LIMIT ?",
+                (now, count),
+            ).fetchall()
+            leases = [
+                Lease(
+                    item_id=row["item_id"],
+                    payload=json.loads(row["payload"]),
+                    token=uuid.uuid4().hex,
+                    attempts=row["attempts"] + 1,
+                )
+                for row in rows
+            ]
+            self._conn.executemany(
+                "UPDATE queue SET status = 'leased', attempts = ?, lease_token = ?, lease_expires = ?, worker_id = ? "
+                "WHERE item_id = ?",
+                [
+                    (
+                        lease.attempts,
+                        lease.token,
+                        now + self._lease_seconds,
+                        worker_id,
+                        lease.item_id,
+                    )
+                    for lease in leases
+                ],
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return leases
+
+    def extend(self, lease: Lease) -> bool:
+        """Keep holding a lease for another lease_seconds, for items that take longer than expected.
+        Returns False if the lease has already been lost.
+        :param lease: The lease to extend.
+        """
+        return self._update_leased(
+            lease, "lease_expires = ?", time.time() + self._lease_seconds
+        )
+
+    def complete(self, lease: Lease, result: dict) -> bool:
+        """Store the result of an item.
+        Returns False, and the result is dropped, if the lease was lost to another worker or the item is already done.
+        :param lease: The lease on the item.
+        :param result: The result of working on the item.
+        """
+        return self._update_leased(
+            lease,
+            "status = 'done', result = ?, error = NULL, lease_token = NULL",
+            json.dumps(result),
+        )
+
+    def fail(self, lease: Lease, error: str) -> None:
+        """Give an item back to be retried, or give up on it once it has had max_attempts.
+        :param lease: The lease on the item.
+        :param error: A description of what went wrong.
+        """
+        status = "failed" if lease.attempts >= self._max_attempts else "pending"
+        self._update_leased(
+            lease, "status = ?, error = ?, lease_token = NULL", status, error
+        )
+
+    def _update_leased(self, lease: Lease, assignments: str, *values: object) -> bool:
+        cursor = self._conn.execute(
+            f"UPDATE queue SET {assignments} WHERE item_id = ? AND lease_token = ? AND status = 'leased'",
+            (*values, lease.item_id, lease.token),
+        )
+        return cursor.rowcount == 1
+
+    def collect(self, count: int = 500) -> list[tuple[str, dict, dict]]:
+        """Get the id, payload and result of items that are done but not yet collected.
+        :param count: The most items to get.
+        """
+        rows = self._conn.execute(
+            "SELECT item_id, payload, result FROM queue WHERE status = 'done' ORDER BY item_id LIMIT ?",
+            (count,),
+        )
+        return [
+            (row["item_id"], json.loads(row["payload"]), json.loads(row["result"]))
+            for row in rows
+        ]
+
+    def mark_collected(self, item_ids: list[str]) -> None:
+        """Record that the results of items have been written back, they are never collected again.
+        :param item_ids: The ids of the items.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.executemany(
+            "UPDATE queue SET status = 'collected', result = NULL WHERE item_id = ? AND status = 'done'",
+            [(item_id,) for item_id in item_ids],
+        )
+        self._conn.execute("COMMIT")
+
+    def requeue_failed(self) -> int:
+        """Give every item that was given up on another max_attempts.
+        Returns how many items were put back.
+        """
+        cursor = self._conn.execute(
+            "UPDATE queue SET status = 'pending', attempts = 0, lease_token = NULL WHERE status = 'failed'"
+        )
+        return cursor.rowcount
+
+    def counts(self) -> dict[str, int]:
+        """Count the items in each status."""
+        counts = dict.fromkeys(("pending", "leased", "done", "collected", "failed"), 0)
+        for row in self._conn.execute(
+            "SELECT status, COUNT(*) AS n FROM queue GROUP BY status"
+        ):
+            counts[row["status"]] = row["n"]
+        return counts
+
+
+class RedisWorkQueue:
+    """A work queue in Redis, or anything that speaks the same commands.
+
+    Only plain commands are used (no Lua or transactions), so a local stand-in such as fakeredis can replace the
+    server. Items wait in a sorted set scored by when they may next be leased. A lease is a key set with NX and an
+    expiry, so only one worker wins each item and a dead worker's lease simply runs out. Results are stored with
+    HSETNX, so an item only ever has one result even if two workers race to finish it.
+    """
+
+    def __init__(
+        self,
+        client: object,
+        name: str = "receiptaggregator",
+        lease_seconds: float = 600,
+        max_attempts: int = 3,
+    ) -> None:
+        """Initialize the RedisWorkQueue.
+        :param client: A redis.Redis client, or a stand-in with the same methods.
+        :param name: The prefix of every key the queue uses.
+        :param lease_seconds: How long a worker has to finish an item before it can be given to another worker.
+        :param max_attempts: How many times an item is leased before it is given up on.
+        """
+        self._client = client
+        self._name = name
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+
+    def _key(self, *parts: str) -> str:
+        return ":".join((self._name, *parts))
+
+    def put(self, items: list[tuple[str, dict]]) -> int:
+        """Add items to the queue, items already in it are left alone.
+        Returns how many items were added.
+        :param items: The id and payload of each item.
+        """
+        added = 0
+        for item_id, payload in items:
+            if self._client.hsetnx(self._key("payloads"), item_id, json.dumps(payload)):
+                self._client.zadd(self._key("queue"), {item_id: 0})
+                added += 1
+        return added
+
+    def lease(self, worker_id: str, count: int = 1) -> list[Lease]:
+        """Claim up to count items that are pending or whose lease has run out.
+        :param worker_id: The id of the worker claiming the items.
+        :param count: The most items to claim.
+        """
+        now = time.time()
+        leases = []
+        # Other workers may win some of the ready items, so look at a few more than are needed.
+        ready = self._client.zrangebyscore(
+            self._key("queue"), "-inf", now, start=0, num=count * 4
+        )
+        for item_id in map(_decode, ready):
+            if len(leases) == count:
+                break
+            token = uuid.uuid4().hex
+            if not self._client.set(
+                self._key("lease", item_id),
+                token,
+                nx=True,
+                px=int(self._lease_seconds * 1000),
+            ):
+                continue
+            attempts = self._client.hincrby(self._key("attempts"), item_id, 1)
+            if attempts > self._max_attempts:
+                self._give_up(item_id, "lease expired")
+                self._client.delete(self._key("lease", item_id))
+                continue
+            # Hide the item until the lease runs out, then it is ready to be leased again.
+            self._client.zadd(self._key("queue"), {item_id: now + self._lease_seconds})
+            self._client.hset(self._key("workers"), item_id, worker_id)
+            payload = self._client.hget(self._key("payloads"), item_id)
+            leases.append(
+                Lease(
+                    item_id=item_id,
+                    payload=json.loads(payload),
+                    token=token,
+                    attempts=attempts,
+                )
+            )
+        return leases
+
+    def _holds(self, lease: Lease) -> bool:
+        token = self._client.get(self._key("lease", lease.item_id))
+        return token is not None and _decode(token) == lease.token
+
+    def extend(self, lease: Lease) -> bool:
+        """Keep holding a lease for another lease_seconds, for items that take longer than expected.
+        Returns False if the lease has already been lost.
+        :param lease: The lease to extend.
+        """
+        if not self._holds(lease):
+            return False
+        self._client.pexpire(
+            self._key("lease", lease.item_id), int(self._lease_seconds * 1000)
+        )
+        self._client.zadd(
+            self._key("queue"), {lease.item_id: time.time() + self._lease_seconds}
+        )
+        return True
+
+    def complete(self, lease: Lease, result: dict) -> bool:
+        """Store the result of an item.
+        Returns False, and the result is dropped, if the lease was lost to another worker or the item is already done.
+        :param lease: The lease on the item.
+        :param result: The result of working on the item.
+        """
+        if not self._holds(lease):
+            return False
+        if not self._client.hsetnx(
+            self._key("results"), lease.item_id, json.dumps(result)
+        ):
+            return False
+        self._client.zrem(self._key("queue"), lease.item_id)
+        self._client.delete(self._key("lease", lease.item_id))
+        return True
+
+    def fail(self, lease: Lease, error: str) -> None:
+        """Give an item back to be retried, or give up on it once it has had max_attempts.
+        :param lease: The lease on the item.
+        :param error: A description of what went wrong.
+        """
+        if not self._holds(lease):
+            return
+        self._client.hset(self._key("errors"), lease.item_id, error)
+        if lease.attempts >= self._max_attempts:
+            self._give_up(lease.item_id, error)
+        else:
+            self._client.zadd(self._key("queue"), {lease.item_id: 0})
+        self._client.delete(self._key("lease", lease.item_id))
+
+    def _give_up(self, item_id: str, error: str) -> None:
+        self._client.zrem(self._key("queue"), item_id)
+        self._client.hset(self._key("failed"), item_id, error)
+
+    def collect(self, count: int = 500) -> list[tuple[str, dict, dict]]:
+        """Get the id, payload and result of items that are done but not yet collected.
+        :param count: The most items to get.
+        """
+        collected = []
+        for item_id, result in self._client.hgetall(self._key("results")).items():
+            # Collected results are blanked rather than deleted, so HSETNX keeps refusing late duplicates.
+            if not result:
+                continue
+            item_id = _decode(item_id)
+            payload = self._client.hget(self._key("payloads"), item_id)
+            collected.append((item_id, json.loads(payload), json.loads(result)))
+            if len(collected) == count:
+                break
+        return sorted(collected, key=lambda item: item[0])
+
+    def mark_collected(self, item_ids: list[str]) -> None:
+        """Record that the results of items have been written back, they are never collected again.
+        :param item_ids: The ids of the items.
+        """
+        if item_ids:
+            self._client.hset(self._key("results"), mapping=dict.fromkeys(item_ids, ""))
+
+    def requeue_failed(self) -> int:
+        """Give every item that was given up on another max_attempts.
+        Returns how many items were put back.
+        """
+        item_ids = [
+            _decode(item_id) for item_id in self._client.hkeys(self._key("failed"))
+        ]
+        for item_id in item_ids:
+            self._client.hdel(self._key("attempts"), item_id)
+            self._client.zadd(self._key("queue"), {item_id: 0})
+            self._client.hdel(self._key("failed"), item_id)
+        return len(item_ids)
+
+    def counts(self) -> dict[str, int]:
+        """Count the items in each status."""
+        results = self._client.hgetall(self._key("results")).values()
+        collected = sum(1 for result in results if not result)
+        queued = self._client.zcard(self._key("queue"))
+        pending = self._client.zcount(self._key("queue"), "-inf", time.time())
+        return {
+            "pending": pending,
+            "leased": queued - pending,
+            "done": len(results) - collected,
+            "collected": collected,
+            "failed": self._client.hlen(self._key("failed")),
+        }
+
+
+def _decode(value: str | bytes) -> str:
+    return value.decode() if isinstance(value, bytes) else value
@@ -0,0 +1,313 @@
+import os
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from typing import TYPE_CHECKING
+
+from receiptaggregator.attachments import AttachmentExtractor
+from receiptaggregator.dedup import EmailDeduplicator, amounts
+from receiptaggregator.eml_loader import parse_eml, parse_emls
+from receiptaggregator.invoice_classification import RuleBasedClassifier
+from receiptaggregator.metrics import metrics
+from receiptaggregator.models import MatchResult, ParsedReceipt
+from receiptaggregator.receipt_extractor import ReceiptExtractor
+from receiptaggregator.state_store import PipelineStateStore, Stage
+from receiptaggregator.work_queue import Lease, WorkQueue
+
+if TYPE_CHECKING:
+    from receiptaggregator.receipt_matcher import ApiReceiptMatcher, CsvReceiptMatcher
+
+
+class PipelineWorker:
+    """Lease emails from a shared queue and parse, classify and extract them.
+
+    Each worker talks to its own extractor, usually an Ollama host of its own, so a backfill scales with the number of
+    machines. Workers never touch the state store or the transactions, they only hand results back through the queue.
+    While an email is being worked on its lease is extended every heartbeat, so a slow extraction is not handed to a
+    second worker, but only for up to max_process_seconds: after that a hung Ollama host is given up on and the email
+    goes back in the queue for another worker.
+    """
+
+    def __init__(
+        self,
+        queue: WorkQueue,
+        extractor: ReceiptExtractor,
+        classifier: object | None = None,
+        worker_id: str | None = None,
+        batch_size: int = 1,
+        attachments: AttachmentExtractor | None = None,
+        heartbeat_seconds: float = 60,
+        max_process_seconds: float = 1800,
+    ) -> None:
+        """Initialize the PipelineWorker.
+        :param queue: The queue to lease emails from.
+        :param extractor: The extractor to run on receipts.
+        :param classifier: Anything with a classify_email method, a RuleBasedClassifier by default.
+        :param worker_id: The name the worker leases under, the host name and process id by default.
+        :param batch_size: How many emails to lease at a time.
+        :param attachments: Add the text of pdf attachments to the bodies of items queued with only a path.
+        :param heartbeat_seconds: How often to extend the lease on the email being worked on, well under lease_seconds.
+        :param max_process_seconds: Stop extending the lease and fail the email once it has been worked on this long.
+        """
+        self.queue = queue
+        self._extractor = extractor
+        self._classifier = classifier or RuleBasedClassifier()
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self._batch_size = batch_size
+        self._attachments = attachments
+        self._heartbeat_seconds = heartbeat_seconds
+        self._max_process_seconds = max_process_seconds
+        self.processed = 0
+        self.failed = 0
+
+    def process(self, payload: dict) -> dict:
+        """Classify and extract a single email, parsing it first if the coordinator did not.
+        :param payload: The queued item, with the absolute path of the eml file and usually the parsed email.
+        """
+        email = (
+            payload["email"]
+            if "email" in payload
+            else parse_eml(payload["path"], self._attachments)
+        )
+        if email is None:
+            return {"email": None}
+        if not self._classifier.classify_email(email):
+            return {"email": email, "is_receipt": False}
+        receipt = self._extractor.extract_data(email)
+        return {"email": email, "is_receipt": True, "receipt": receipt.model_dump()}
+
+    def run_once(self) -> int:
+        """Lease a batch of emails and work through it.
+        Returns how many emails were leased.
+        """
+        leases = self.queue.lease(self.worker_id, self._batch_size)
+        for lease in leases:
+            self._work(lease)
+        return len(leases)
+
+    def _work(self, lease: Lease) -> None:
+        try:
+            with metrics.timer("worker.process"):
+                result = self._process_with_heartbeat(lease)
+        except Exception as err:
+            self.failed += 1
+            metrics.increment("worker.failed")
+            self.queue.fail(lease, repr(err))
+            return
+        if self.queue.complete(lease, result):
+            self.processed += 1
+            metrics.increment("worker.completed")
+        else:
+            # Another worker took over after our lease ran out and its result is the one kept.
+            metrics.increment("worker.lease_lost")
+
+    def _process_with_heartbeat(self, lease: Lease) -> dict:
+        # The queue is only used from this thread, sqlite connections can not be shared, so the email is worked on in
+        # another one. It is a daemon thread, a hung call that is given up on can not hold up the process exiting.
+        future: Future = Future()
+
+        def process() -> None:
+            try:
+                future.set_result(self.process(lease.payload))
+            except Exception as err:
+                future.set_exception(err)
+
+        threading.Thread(target=process, daemon=True).start()
+        deadline = time.monotonic() + self._max_process_seconds
+        while True:
+            try:
+                return future.result(
+                    timeout=min(self._heartbeat_seconds, deadline - time.monotonic())
+                )
+            except TimeoutError:
+                if time.monotonic() >= deadline:
+                    metrics.increment("worker.timed_out")
+                    raise TimeoutError(
+                        f"Gave up after {self._max_process_seconds} seconds"
+                    ) from None
+                metrics.increment("worker.heartbeat")
+                self.queue.extend(lease)
+
+    def run(
+        self,
+        stop: threading.Event | None = None,
+        idle_seconds: float = 5,
+        exit_when_empty: bool = False,
+    ) -> None:
+        """Keep working until stopped.
+        :param stop: Set this to stop the worker after the email it is on.
+        :param idle_seconds: How long to wait before asking again when the queue has nothing ready.
+        :param exit_when_empty: Return as soon as the queue has nothing ready, for one-off backfills.
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            if self.run_once():
+                continue
+            if exit_when_empty:
+                return
+            stop.wait(idle_seconds)
+
+
+class WorkCoordinator:
+    """Feed a shared queue from a mailbox and write the workers' results back exactly once.
+
+    The coordinator is the only process that writes to the state store and the matcher. Emails are parsed and
+    deduplicated before they are queued, so copies of a receipt never reach a worker's extractor. Queued emails are
+    keyed by their content hash, the queue only keeps the first result for each, and the state store only moves an
+    email forward, so a result that is collected twice after a crash changes nothing the second time. Receipts reach
+    the matcher from the state store, and are marked written as the matcher writes them.
+    """
+
+    def __init__(
+        self,
+        state: PipelineStateStore,
+        queue: WorkQueue,
+        attachments: AttachmentExtractor | None = None,
+    ) -> None:
+        """Initialize the WorkCoordinator.
+        :param state: The state store that holds the pipeline's progress.
+        :param queue: The queue the workers lease from.
+        :param attachments: Add the text of pdf attachments to the bodies with this.
+        """
+        self.state = state
+        self.queue = queue
+        self._attachments = attachments
+        self._dedup = EmailDeduplicator()
+        for email_id, signature, money in state.signatures():
+            self._dedup.remember(email_id, signature, money)
+
+    def enqueue(self, directory: str, batch_size: int = 500) -> int:
+        """Parse every eml file in a directory that the state store has never seen and queue the ones that are not
+        copies of an email seen before. Items the workers gave up on in an earlier run are given another round of
+        attempts, the way the state store retries failed emails on the next run.
+        Returns how many were added, files still waiting in the queue are not added twice.
+        :param directory: The mailbox directory, it must be at the same path on every worker.
+        :param batch_size: How many files to parse before queueing them.
+        """
+        requeued = self.queue.requeue_failed()
+        metrics.increment("coordinator.requeued", requeued)
+        new = self.state.new_files(directory)
+        added = 0
+        for start in range(0, len(new), batch_size):
+            chunk = new[start : start + batch_size]
+            parsed = parse_emls([path for _, path in chunk], self._attachments)
+            items, records = [], []
+            for (email_id, path), email in zip(chunk, parsed, strict=True):
+                dedup = None if email is None else self._signature(email_id, email)
+                records.append((email_id, path, email, dedup))
+                if email is not None and dedup is not None and dedup[2] is None:
+                    items.append(
+                        (
+                            email_id,
+                            {
+                                "path": os.path.abspath(path),
+                                "source": path,
+                                "email": email,
+                            },
+                        )
+                    )
+            # Queue first, so an email the state store knows about is never missing from the queue after a crash.
+            added += self.queue.put(items)
+            for email_id, path, email, dedup in records:
+                self.state.record_parsed(email_id, path, email)
+                if dedup is not None:
+                    self.state.record_deduplicated(email_id, *dedup)
+        metrics.increment("coordinator.queued", added)
+        return added
+
+    def collect(self, count: int = 500) -> int:
+        """Record the results the workers have finished in the state store.
+        Returns how many results were recorded.
+        :param count: The most results to record at once.
+        """
+        results = self.queue.collect(count)
+        for email_id, payload, result in results:
+            email = result["email"]
+            self.state.record_parsed(email_id, payload["source"], email)
+            if email is None:
+                continue
+            # Emails queued with only a path were not deduplicated when they were queued.
+            dedup = self._signature(email_id, email)
+            if dedup is not None:
+                self.state.record_deduplicated(email_id, *dedup)
+            self.state.record_classified(email_id, result["is_receipt"])
+            if result["is_receipt"]:
+                self.state.record_extracted(
+                    email_id, ParsedReceipt.model_validate(result["receipt"])
+                )
+        self.queue.mark_collected([email_id for email_id, _, _ in results])
+        return len(results)
+
+    def _signature(
+        self, email_id: str, email: dict
+    ) -> tuple[bytes, str, str | None] | None:
+        """Add an email to the deduplicator, returning what to record for it or None if it was already there."""
+        if email_id in self._dedup:
+            return None
+        signature, money = self._dedup.signature(email["Body"]), amounts(email["Body"])
+        original = self._dedup.add(email_id, email["Body"], signature, money)
+        return signature.tobytes(), money, None if original == email_id else original
+
+    def _to_match(self) -> tuple[list[str], list[tuple[ParsedReceipt, str]]]:
+        # Matches that never made it into a write are redone, unmatched receipts are retried every time.
+        to_match = self.state.emails_at(Stage.EXTRACTED) + self.state.emails_at(
+            Stage.MATCHED
+        )
+        return self.state.receipts_to_match(to_match)
+
+    def _record_matches(
+        self, email_ids: list[str], matches: list[MatchResult]
+    ) -> list[str]:
+        matched = []
+        for email_id, match in zip(email_ids, matches, strict=True):
+            # Unmatched results are recorded too, so the matches dataset sees every outcome.
+            self.state.record_matched(email_id, match)
+            if match.transaction_id is not None:
+                matched.append(email_id)
+        return matched
+
+    def write_back_csv(self, matcher: "CsvReceiptMatcher", csv_path: str) -> list[str]:
+        """Match every receipt that has not been written yet, save the csv and record them as written.
+        If this is interrupted after the csv is saved, the rerun finds the notes already there and does not add them
+        again. Returns the ids of the emails that were matched.
+        :param matcher: The csv matcher, loaded from csv_path if it exists.
+        :param csv_path: Where to save the updated csv.
+        """
+        email_ids, receipts = self._to_match()
+        matched = self._record_matches(email_ids, matcher.match_receipts(receipts))
+        matcher.update_csv(csv_path)
+        self.state.record_written(matched)
+        return matched
+
+    async def write_back_api(self, matcher: "ApiReceiptMatcher") -> list[str]:
+        """Match every receipt that has not been written yet against Monarch and record them as written.
+        The api matcher skips transactions it has already tagged, so a rerun after an interruption writes nothing twice.
+        Returns the ids of the emails that were matched.
+        :param matcher: The api matcher, logged in and set up.
+        """
+        email_ids, receipts = self._to_match()
+        matched = self._record_matches(
+            email_ids, await matcher.match_receipts(receipts)
+        )
+        self.state.record_written(matched)
+        return matched
+
+    def wait(
+        self, poll_seconds: float = 5, timeout: float | None = None
+    ) -> dict[str, int]:
+        """Collect results until nothing is left pending or leased.
+        Returns the final counts of the queue.
+        :param poll_seconds: How long to wait between collections.
+        :param timeout: Give up waiting after this many seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            while self.collect():
+                pass
+            counts = self.queue.counts()
+            if not counts["pending"] and not counts["leased"] and not counts["done"]:
+                return counts
+            if deadline is not None and time.monotonic() > deadline:
+                return counts
+            time.sleep(poll_seconds)
@@ -1,45 +1,102 @@
 import asyncio
+import os
 
 import ollama
 
-from receiptaggregator import ParsedReceipt
-from receiptaggregator.eml_loader import parse_directory
+from receiptaggregator.attachments import AttachmentExtractor
+from receiptaggregator.dedup import EmailDeduplicator, amounts
+from receiptaggregator.eml_loader import parse_emls
+from receiptaggregator.export import ReceiptExporter
 from receiptaggregator.invoice_classification import (
     RuleBasedClassifier,
 )
-from receiptaggregator.receipt_extractor import OllamaReceiptExtractor
-from receiptaggregator.receipt_matcher import ReceiptMatcher
+from receiptaggregator.metrics import metrics
+from receiptaggregator.receipt_extractor import (
+    OllamaReceiptExtractor,
+    RoutingReceiptExtractor,
+)
+from receiptaggregator.receipt_matcher import CsvReceiptMatcher
+from receiptaggregator.state_store import PipelineStateStore, Stage
 
 
 async def main() -> None:
-    """Run the entire pipeline."""
-    email_files = parse_directory("eml_files")
+    """Run the entire pipeline, resuming from wherever the last run stopped."""
+    state = PipelineStateStore("pipeline_state.db")
+    # Only mail that has never been seen before gets parsed, so daily runs just pick up the new files.
+    new_files = state.new_files("eml_files")
+    # The text of pdf invoices goes into the body too, when pypdf is installed.
+    try:
+        attachments = AttachmentExtractor("attachment_cache")
+    except ImportError:
+        attachments = None
+    emails = parse_emls([path for _, path in new_files], attachments)
+    for (email_id, path), email in zip(new_files, emails, strict=True):
+        state.record_parsed(email_id, path, email)
+    if attachments is not None:
+        attachments.close()
+    # Forwarded, CC'd and re-sent copies of an email are grouped so only the first of each group gets classified and
+    # extracted, and the group keeps the earliest date.
+    dedup = EmailDeduplicator()
+    for email_id, signature, money in state.signatures():
+        dedup.remember(email_id, signature, money)
+    for email_id, email in state.emails_at(Stage.PARSED):
+        if email_id in dedup:
+            continue
+        signature, money = dedup.signature(email["Body"]), amounts(email["Body"])
+        original = dedup.add(email_id, email["Body"], signature, money)
+        state.record_deduplicated(
+            email_id,
+            signature.tobytes(),
+            money,
+            None if original == email_id else original,
+        )
     # gemini_classifier = GeminiClassifier("my_api")
     # classifications = await asyncio.gather(
     #     *(gemini_classifier.gemini_classification(email) for email in email_files)
     # )
     rule_classifier = RuleBasedClassifier()
-    rule_classification = [
-        rule_classifier.classify_email(email) for email in email_files
-    ]
-    receipts = []
-    for email, rule_class in zip(email_files, rule_classification):
-        if rule_class:
-            receipts.append(email)
-    ollama_client = ollama.Client(host="OLLAMA_URL")
-    rec_extract = OllamaReceiptExtractor(ollama_client, "gemma3:4b")
+    for email_id, email in state.emails_at(Stage.PARSED):
+        state.record_classified(email_id, rule_classifier.classify_email(email))
 
-    parsed_receipts: list[ParsedReceipt | None] = []
-    for receipt in receipts:
+    ollama_client = ollama.Client(host="OLLAMA_URL")
+    # The small model handles most receipts, anything that fails a consistency check is retried on the larger one.
+    rec_extract = RoutingReceiptExtractor(
+        [
+            OllamaReceiptExtractor(ollama_client, "gemma3:4b"),
+            OllamaReceiptExtractor(ollama_client, "qwen3:30b-a3b"),
+        ]
+    )
+    for email_id, email in state.emails_at(Stage.CLASSIFIED):
         try:
-            parsed_receipts.append(rec_extract.extract_data(receipt))
-        except Exception:
-            parsed_receipts.append(None)
-    rm = ReceiptMatcher("monarch_csv.csv")
-    for receipt, email in zip(parsed_receipts, receipts):
-        if receipt is not None:
-            rm.match_receipt(receipt, email["Date"])
-    rm.update_csv("monarch_csv_updated.csv")
+            state.record_extracted(email_id, rec_extract.extract_data(email))
+        except Exception as err:
+            state.record_failure(email_id, repr(err))
+    print(
+        f"Escalated {rec_extract.escalation_rate:.1%} of receipts, "
+        f"{rec_extract.average_seconds:.2f}s per receipt"
+    )
+
+    # Start from the last csv we wrote so notes from earlier runs are kept.
+    output_csv = "monarch_csv_updated.csv"
+    rm = CsvReceiptMatcher(
+        output_csv if os.path.exists(output_csv) else "monarch_csv.csv"
+    )
+    # Matches that never made it into a written csv are redone, unmatched receipts are retried every run.
+    to_match = state.emails_at(Stage.EXTRACTED) + state.emails_at(Stage.MATCHED)
+    email_ids, receipts = state.receipts_to_match(to_match)
+    matches = rm.match_receipts(receipts)
+    for email_id, match in zip(email_ids, matches, strict=True):
+        state.record_matched(email_id, match)
+    rm.update_csv(output_csv)
+    state.record_written([email_id for email_id, _ in state.emails_at(Stage.MATCHED)])
+    # Add this run's receipts, items and matches to the parquet datasets used for analytics.
+    print(ReceiptExporter("receipt_dataset").export(state))
+    print(state.counts())
+    print(state.dedup_summary())
+    state.close()
+    if metrics.enabled:
+        with open("metrics.json", "w") as f:
+            f.write(metrics.to_json())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import os
+import signal
+
+import ollama
+from dotenv import load_dotenv
+
+from receiptaggregator.attachments import AttachmentExtractor
+from receiptaggregator.daemon import DirectorySource, ImapSource, ReceiptDaemon
+from receiptaggregator.metrics import metrics
+from receiptaggregator.receipt_extractor import (
+    OllamaReceiptExtractor,
+    RoutingReceiptExtractor,
+)
+from receiptaggregator.receipt_matcher import ApiReceiptMatcher
+from receiptaggregator.state_store import PipelineStateStore
+
+
+async def main(args: argparse.Namespace) -> None:
+    """Watch for new mail and write each receipt to Monarch shortly after it arrives."""
+    load_dotenv()
+    state = PipelineStateStore("pipeline_state.db")
+    sources = [DirectorySource(args.mailbox, poll_seconds=args.poll_seconds)]
+    if os.getenv("IMAP_HOST"):
+        # New mail is saved into the mailbox directory, so it is also there for the next batch run.
+        sources.append(
+            ImapSource(
+                os.getenv("IMAP_HOST"),
+                os.getenv("IMAP_USER"),
+                os.getenv("IMAP_PASSWORD"),
+                args.mailbox,
+                mailbox=args.imap_mailbox,
+                poll_seconds=args.poll_seconds,
+            )
+        )
+    client = ollama.Client(host=args.ollama_url)
+    extractor = RoutingReceiptExtractor(
+        [OllamaReceiptExtractor(client, model) for model in args.models.split(",")]
+    )
+    try:
+        attachments = AttachmentExtractor("attachment_cache")
+    except ImportError:
+        attachments = None
+    daemon = ReceiptDaemon(
+        state,
+        sources,
+        extractor,
+        ApiReceiptMatcher(),
+        debounce_seconds=args.debounce_seconds,
+        attachments=attachments,
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await daemon.run(stop)
+    print(state.counts())
+    if metrics.enabled:
+        with open("metrics.json", "w") as f:
+            f.write(metrics.to_json())
+    state.close()
+
+
+parser = argparse.ArgumentParser(description="Process new mail as it arrives.")
+parser.add_argument("--mailbox", default="eml_files")
+parser.add_argument("--imap-mailbox", default="INBOX")
+parser.add_argument("--poll-seconds", type=float, default=30)
+parser.add_argument("--debounce-seconds", type=float, default=2)
+parser.add_argument("--ollama-url", default=os.getenv("OLLAMA_URL"))
+parser.add_argument("--models", default="gemma3:4b,qwen3:30b-a3b")
+
+if __name__ == "__main__":
+    asyncio.run(main(parser.parse_args()))